@@ -4,9 +4,11 @@
 import cloudy.CloudyClass as cc #class with all methods needed to operate with cloudy
 from skirt import pigs #source code that generates the .ski file
 from skirt.ski_params import SkiParams #class that contains all the data to generate the .ski file
+from skirt.parallel import SkirtJobs #splits skirt simulations in wavelength bands and/or seeds
+from skirt.scheduler import PhotonScheduler #chooses photon packets of each iteration
 import utils.convergence as conv
-from utils.unkeep import move #utility functions
-import os
+from utils.unkeep import move, copy, makedir #utility functions
+from utils.runner import StageRunner #launches skirt and cloudy as managed subprocesses
 import time
 
 # Other options
@@ -49,25 +51,100 @@ Options = {
         #Speed options
         'n_threads': 6, #Number of logical cores you want to run for a SINGLE simulation in skirt
         'n_cpus': 2, #Number of simulations to be run at once in CLOUDY
+        'CloudyReuse':{
+            'active': False, #If True, cloudy does not run again in zones whose incident field barely changed since their last cloudy run.
+                # Their previous cloudy outputs (and the files derived from them) are used instead.
+            'bands': [(10.0,91.2),(91.2,3.0e5)], #nm. Fields are compared integrating 4π*λ*J in each of these ranges
+            'threshold': 0.02 #Relative change, in every band, below which previous results are reused
+        },
+        'CloudyStore':{
+            'active': False, #If True, every cloudy result is kept in a store and identical cloudy models are never run twice
+                # (same chemistry, density, dust, thickness and incident field). Useful if you repeat runs with small changes.
+            'folder': 'cloudy_store', #Where the store is. Use the same (absolute) path in different runs to share results between them
+            'max_size_MB': 5000 #Oldest used results are removed when the store grows above this size
+        },
+        'CloudyClustering':{
+            'active': False, #If True, cloudy only runs in one zone (the representative) of each group of similar zones.
+                # The other zones take its results, rescaled to their own thickness and volume. Zones approximated in each iteration are listed in cloudy_clusters.txt
+            'tolerance': 0.05, #Maximum relative difference with the representative, in any parameter (density, thickness, chemistry, dust) or band below
+            'bands': [(10.0,91.2),(91.2,3.0e5)] #nm. Fields are compared integrating 4π*λ*J in each of these ranges
+        },
+        'CloudyEmulator':{
+            'active': False, #If True, cloudy is NOT run. Skirt inputs of each zone are interpolated in a table of cloudy models instead.
+                # Much faster, but only as accurate as the table. Useful for exploratory runs (e.g.: parameter scans).
+                # See cloudy/Emulator.py to build the table.
+            'table': 'input_data/cloudy_emulator.npz',
+            'report': False #If True (and 'active' is False), each iteration compares cloudy with the table in 'emulator_accuracy.dat'
+        },
+        'SkirtBands':{
+            'active': False, #If True, each skirt simulation is split into independent simulations (one per wavelength band) that run at once, sharing 'n_threads'.
+                # Skirt runs in 'ExtinctionOnly' mode, so photons of different wavelengths do not interact, and results are the same (within noise).
+            'edges': [91.2], #nm. Limits between bands (minWavelength and maxWavelength are the outer limits). Moved to the nearest border between wavelength bins
+            'photon_weights': None #Share of 'photon_packets' of each band (one value per band, e.g.: [2,1] gives twice photons to the first band).
+                # None gives each band the same photons per wavelength bin, on average.
+        },
+        'SkirtEnsemble':{
+            'active': False, #If True, skirt runs as several simulations at once with different seeds, sharing 'photon_packets' and 'n_threads'.
+                # Their fields are averaged, and the standard error of the mean is written in skirt_file_nuJnu_J_noise.dat (Monte Carlo noise of each iteration)
+                # Useful when skirt does not scale with more threads. Can be combined with 'SkirtBands'
+            'members': 4 #Number of simulations (seeds)
+        },
+        'SpatialGrid':{
+            'type': 'Linear', #Grid of skirt where the media are discretized. Available options: 'Linear','Geometry'
+                # 'Linear': cylinder of 200 x 200 cells of the same size, up to the largest zone
+                # 'Geometry': cells follow the gas zones (borders of every zone are cell borders, empty space gets few cells).
+                #   Spherical (1D) if every gas zone is a shell. The number of cells is printed. See skirt/spatial_grid.py
+            'cells_per_zone': 20, #Cells along the width (and height) of the thinnest zone at each place
+            'cells_per_decade': 10 #Logarithmic cells per factor 10 in radius (or z) where there is no gas
+        },
         'photon_packets':1e7, #This number determines the number of photons launched in each skirt run.
             # One important thing to bear in mind that this mainly affects resolution. Less photons more noise in the results (but skirt runs are faster)
+        'PhotonScheduler':{
+            'active': False, #If True, 'photon_packets' is ignored. Each iteration chooses its photon packets from the noise measured in the 'Convergence' keys.
+                # Packets only increase when the changes between iterations are due to Monte Carlo noise (not to the field still evolving). See photon_schedule.log
+            'initial_packets': 1e6,
+            'max_packets': 1e8,
+            'max_increase': 4.0, #Max factor between the packets of consecutive iterations
+            'noise_to_tolerance': 0.5 #Target Monte Carlo noise of each key, relative to its 'tolerance'
+        },
             # Below you find options related to the probability of launching photons, allowing you some control to adapt the output resolution.
         'PhotonProbability':{
-            'per_region':'logWavelength', # Available options:'logWavelength','Custom'
+            'per_region':'logWavelength', # Available options:'logWavelength','Custom','Adaptive'
                 # This option modifies, inside each region, the probability distribution of which a photon of certain wavelength is launched
                 # Available options are:
                 # 'logWavelength': p(λ) ~ 1/λ -> Follows the Logarithmic distribution option given in Skirt
                 # 'Custom': p(λ) ~ f(λ) -> Given by the user below (used for ALL regions)
+                # 'Adaptive': p(λ) follows the Monte Carlo noise of the field measured in the previous skirt simulation at the zone of each region
+                #   (more photons where the noise is higher). Regions use 'logWavelength' until the noise has been measured. See skirt/adaptive.py
             'customDistributionFile': 'input_data/probability_distributions/YourFile.stab',
-            'wavelengthBias': 0.5 #Between 0 and 1. It controls how many photons launched per region follow above distribution.
+            'Adaptive':{ #Only used if 'per_region' is 'Adaptive'
+                'focus': 4.0, #Extra weight of the wavelengths inside the 'wavelengthRange' of 'Convergence' keys
+                'floor': 0.1 #Minimum probability, relative to the mean (so no wavelength is left without photons)
+            },
+            'wavelengthBias': 0.5, #Between 0 and 1. It controls how many photons launched per region follow above distribution.
                 # 0 makes above option without effect.
                 # 1 makes regions to strictly follow the distribution
                 #   (you risk having some wavelength ranges without photons, so the output will be zero there,
                 #       because the probability was too low to even launch one photon)
+            'per_source':'Luminosity', # Available options: 'Luminosity','Contribution'
+                # This option modifies how photons are shared between regions (sources)
+                # 'Luminosity': proportional to the luminosity of each region -> Skirt default
+                # 'Contribution': proportional to the contribution of each region to the radiation field at the zones, updated every iteration.
+                #   Faint regions far from every zone get fewer photons. See skirt/allocation.py
+            'sourceBias': 0.5 #Between 0 and 1. Fraction of photons shared equally between all regions, whatever the above option.
+                # It is the minimum share of each region: sourceBias/number of regions
         }
     },
     'Technical':{
         'cloudy_path':'/path/to/your/cloudy/exe',
+        # Time limits (in seconds) of each skirt and cloudy run. None means no limit.
+        # If a run takes longer, it is stopped and Mixclask raises an error instead of hanging forever.
+        'skirt_timeout': None,
+        'cloudy_timeout': None,
+        # Mixclask remembers some things about each cloudy zone between iterations and runs (e.g.: if cloudy crashed there with qheat).
+        'cloudy_zone_memory': 'cloudy_zones.json', #File where this memory is stored. Remove it to start from scratch.
+        'qheat_retry_every': 0, #Zones that crashed with qheat are run with 'no qheat' since then.
+            # If > 0, they will try again with qheat after this number of iterations. 0 never tries again.
         # Do we start from the beginning?
         'is_iteration0': True,
             # If true, mixclask will do a skirt simulation with only 'star_params' data before running cloudy
@@ -86,26 +163,51 @@ Options = {
 ### MAIN ROUTINE ###
 
 t_start = time.time()
+runner = StageRunner(timeout=Options['Technical']['skirt_timeout'])
+skirt_jobs = None
+if Options['AccuracyAndSpeed']['SkirtBands']['active'] or Options['AccuracyAndSpeed']['SkirtEnsemble']['active']:
+    skirt_jobs = SkirtJobs(Options)
+def make_ski_file(iteration0=False):
+    if skirt_jobs is not None:
+        skirt_jobs.makeSkiFiles(skirt_params,iteration0)
+        return
+    skirt_params.prepareSkiFile(iteration0)
+    pigs.SkirtFile(skirt_params, output_path='skirt_file')
+def run_skirt():
+    if skirt_jobs is not None:
+        skirt_jobs.run()
+        skirt_jobs.combine() #skirt_file_nuJnu_J.dat, as if skirt had run once
+        return
+    result = runner.run(["skirt","-t",str(Options['AccuracyAndSpeed']['n_threads']),"skirt_file.ski"], stdout="tmp.txt") #Make sure you followed skirt instructions
+    if not result.ok:
+        raise RuntimeError("Skirt failed (exit status "+str(result.returncode)+", "+str(result.elapsed)+" s). Check tmp.txt for more details.")
+
 cloudy = cc.CloudyObject(Options)
 skirt_params = SkiParams(Options)
 program = conv.ConvergenceObject(cloudy.giveSEDfiles(),Options)
+scheduler = None
+if Options['AccuracyAndSpeed']['PhotonScheduler']['active']:
+    scheduler = PhotonScheduler(Options)
+    skirt_params.setPhotonPackets(scheduler.packets())
 
 ### ITERATION 0 ###
 if Options['Technical']['is_iteration0']:
     last_iteration = 0
     t_it = time.time()
     print("iteration 0 ("+str(t_it-t_start)+" s):")
-    skirt_params.prepareSkiFile(Options['Technical']['is_iteration0'])
-    pigs.SkirtFile(skirt_params, output_path='skirt_file')
+    make_ski_file(Options['Technical']['is_iteration0'])
 
-    os.system("skirt -t "+str(Options['AccuracyAndSpeed']['n_threads'])+" skirt_file.ski > tmp.txt") #Make sure you followed skirt instructions
+    t_skirt = time.time()
+    run_skirt()
+    if scheduler is not None: scheduler.log(last_iteration,time.time()-t_skirt)
+    skirt_params.measureNoise(last_iteration,"skirt_file_nuJnu_J.dat")
 
     cloudy.GenerateCloudyFiles("skirt_file_nuJnu_J.dat")
     folder = "iteration0"
-    os.system("mkdir "+folder)
-    os.system("mv *.dat -t "+folder)
-    os.system("cp *.sed -t "+folder) #copy because I need these files in the root folder
-    os.system("mv *.ski -t "+folder)
+    makedir(folder)
+    move("*.dat",folder)
+    copy("*.sed",folder) #copy because I need these files in the root folder
+    move("*.ski",folder)
 
 ### FOLLOWING ITERATIONS ###
 t_it = time.time()
@@ -119,17 +221,15 @@ while(not program.stop()):
     #TESTING COMMENT
     cloudy.make_input()
     
-    cloudy.run_input()
-    
-    cloudy.GenerateSkirtInput()
+    cloudy.run_input() #This also converts cloudy outputs into skirt inputs, zone by zone
     
     #Save the data in a separate folder
     print("Moving cloudy data to "+folder)
-    os.system("mkdir "+folder)
-    os.system("mv *.txt -t "+folder)
-    os.system("cp *.stab -t "+folder) #copy and then move
-    os.system("mv *.in -t "+folder)
-    os.system("mv *.out -t"+folder)
+    makedir(folder)
+    move("*.txt",folder)
+    copy("*.stab",folder) #copy and then move
+    move("*.in",folder)
+    move("*.out",folder)
     #Move the relevant data to 'input_data' folder
     move("MeanFileGasMix_*.stab","input_data/gas_props")
     move("GasSource_*.stab","input_data/gas_sources")
@@ -138,18 +238,20 @@ while(not program.stop()):
     # Create skirt
     # =============================================================================
 
-    skirt_params.prepareSkiFile()
-    pigs.SkirtFile(skirt_params, output_path='skirt_file')
+    if scheduler is not None: skirt_params.setPhotonPackets(scheduler.update(program))
+    make_ski_file()
     
-    #print("skirt -t "+str(n_threads)+" skirt_file.ski > tmp.txt")
-    os.system("skirt -t "+str(Options['AccuracyAndSpeed']['n_threads'])+" skirt_file.ski > tmp.txt") #Make sure you followed skirt instructions
+    t_skirt = time.time()
+    run_skirt()
+    if scheduler is not None: scheduler.log(program.n_iterations,time.time()-t_skirt)
+    skirt_params.measureNoise(program.n_iterations,"skirt_file_nuJnu_J.dat")
     
     cloudy.GenerateCloudyFiles("skirt_file_nuJnu_J.dat")
 
     print("Moving skirt data to "+folder+" \n")
-    os.system("mv *.dat -t "+folder)
-    os.system("cp *.sed -t "+folder) #copy because I need these files in the root folder
-    os.system("mv *.ski -t "+folder)
+    move("*.dat",folder)
+    copy("*.sed",folder) #copy because I need these files in the root folder
+    move("*.ski",folder)
     
     t_it = time.time()
     
@@ -8,10 +8,16 @@ Mario Romero            July 2021
 '''
 
 import os
+import asyncio
+import shutil
+import time
 #import glob
-from utils.unkeep import relist
+from utils.unkeep import relist, readColumn, integrate
+from utils.runner import StageRunner
 import cloudy.ConverterMethods as converter
-from multiprocessing import Process
+from cloudy.ZoneMemory import ZoneMemory
+from cloudy.ResultStore import ResultStore
+from cloudy.Emulator import CloudyEmulator
 import numpy as np
 
 class CloudyObject(converter.CloudyToSkirt):
@@ -20,8 +26,17 @@ class CloudyObject(converter.CloudyToSkirt):
         self.__initChemistry()
         self.__initWavelengths(options_dict['Wavelength'])
         self.__initDetails()
+        self.__initReuse(options_dict['AccuracyAndSpeed']['CloudyReuse'])
+        self.__initClustering(options_dict['AccuracyAndSpeed']['CloudyClustering'])
         self.__parseData(options_dict['FileParameters']['ISM'])
         self.__ExePath = options_dict['Technical']['cloudy_path']
+        self.__runner = StageRunner(self._n_cpus,options_dict['Technical']['cloudy_timeout'])
+        self.__memory = ZoneMemory(options_dict['Technical']['cloudy_zone_memory'],options_dict['Technical']['qheat_retry_every'])
+        store_dict = options_dict['AccuracyAndSpeed']['CloudyStore']
+        self.__store = ResultStore(store_dict['folder'],store_dict['max_size_MB']) if store_dict['active'] else None
+        emulator_dict = options_dict['AccuracyAndSpeed']['CloudyEmulator']
+        self.__emulate  = emulator_dict['active'] #If True, cloudy is not run, see run_input()
+        self.__emulator = CloudyEmulator(emulator_dict['table']) if emulator_dict['active'] or emulator_dict['report'] else None
         self.__defineConstants() #Needed for ConvertedMethods
         
         self.__checkIssues()
@@ -111,6 +126,24 @@ class CloudyObject(converter.CloudyToSkirt):
         self._wavelength_norm = wavelength_dict['normalization']
         self._wavelength_res  = wavelength_dict['resolution']
     
+    def __initReuse(self,reuse_dict):
+        #Cloudy results of a zone are reused if its incident field barely changed since its last cloudy run
+        self._reuse_active    = reuse_dict['active']
+        self._reuse_bands     = reuse_dict['bands'] #nm, 4pi*nu*J is integrated in each band to compare fields
+        self._reuse_threshold = reuse_dict['threshold'] #Maximum relative change in any band to reuse results
+        #Folders. As in SkiParams, they are hardcoded
+        self._last_run_folder     = "input_data/cloudy_last_run" #Inputs, outputs and skirt inputs of the last cloudy run of each zone
+        self._reusedZones = set() #Zones that have not run cloudy in this iteration
+        if self._reuse_active:
+            os.makedirs(self._last_run_folder,exist_ok=True)
+    
+    def __initClustering(self,clustering_dict):
+        #Similar zones take the cloudy results of one of them (their representative), rescaled to their thickness and volume
+        self._clustering_active    = clustering_dict['active']
+        self._clustering_tolerance = clustering_dict['tolerance'] #Maximum relative difference of any parameter with the representative
+        self._clustering_bands     = clustering_dict['bands'] #nm, 4pi*nu*J is integrated in each band to compare fields
+        self._clusteredZones = {} #{zone: representative}, zones that have not run cloudy in this iteration
+    
     def __massNumbersArray(self):
         result = []
         for symbol in self._param_element:
@@ -198,14 +231,22 @@ class CloudyObject(converter.CloudyToSkirt):
         #IOextensions is a dictionary
         prefix = outfile
         self.__inputs = []
+        self.__noQheat = [] #True if the zone is run with 'no qheat'
         for z in range(0,self._n_zones):
             sed_filename  = self._sedFiles[z]
             
             filename = prefix+str(z)+".in"
             
+            #Zones that crashed with qheat in previous runs start directly without it
+            no_qheat = self._disable_qheat or self.__memory.useNoQheat(sed_filename)
+            self.__noQheat.append(no_qheat)
+            
             outfile = open(filename,'w')
-            outfile.write("title cloudy zone "+str(z)+" \n")
-            self.__writeChemistry(outfile,z,self._disable_qheat)
+            if no_qheat and not self._disable_qheat:
+                outfile.write("title cloudy zone "+str(z)+" no qheat run \n")
+            else:
+                outfile.write("title cloudy zone "+str(z)+" \n")
+            self.__writeChemistry(outfile,z,no_qheat)
             self.__writeRadiation(outfile, sed_filename)
             self.__writeGeometry(outfile,z)
             self.__writeOptions(outfile)
@@ -217,7 +258,8 @@ class CloudyObject(converter.CloudyToSkirt):
             outfile.close()
             self.__inputs.append(filename.replace('.in','')) #Will be needed for running cloudy
     
-    def run_input(self):
+    def run_input(self,convert=True):
+        #Runs cloudy in all zones. If convert is False, cloudy outputs are not converted into skirt inputs
         #Old code
         '''
         for zone in range(0,len(self.__inputs)):
@@ -227,27 +269,192 @@ class CloudyObject(converter.CloudyToSkirt):
                 self.__errorHandleInput(zone,currInput)
             #else do nothing
         '''
-        def execute_input(input,region):
-            os.system(self.__ExePath + " -r " + input)
-            if self.__problemDisaster(input):
-                self.__errorHandleInput(region, input)
+        async def execute_input(input,region):
+            #Was this model computed before (in this or another run)?
+            if self.__store is not None:
+                key = self.__store.key(input+".in",self._sedFiles[region])
+                if self.__store.fetch(key,self._zoneOutputs(region)):
+                    if self._reuse_active: self.__storeLastRun(region)
+                    if convert: await self.__convert(region,store=self._reuse_active)
+                    return
+            t_zone = time.time()
+            result = await self.__runCloudy(input,region)
+            if result.stopped: #Cloudy crashed, and it was stopped as soon as it told us
+                await self.__errorHandleInput(region, input)
             # else do nothing
+            self.__memory.ranWith(self._sedFiles[region], self.__noQheat[region], crashed=result.stopped)
+            self.__memory.setRuntime(self._sedFiles[region], time.time() - t_zone)
+            if self._reuse_active: self.__storeLastRun(region)
+            if self.__store is not None:
+                #Label with the input actually used (it changes if qheat had to be removed)
+                self.__store.store(self.__store.key(input+".in",self._sedFiles[region]),self._zoneOutputs(region))
+            if convert: await self.__convert(region,store=self._reuse_active)
+        
+        #Skirt inputs are interpolated from a table of previous cloudy models, instead of running cloudy
+        self._reusedZones = set()
+        if self.__emulate:
+            self.__emulator.writeZones(self)
+            return
+        
+        #Zones similar to another one (within the tolerance) do not run cloudy in this iteration
+        self._clusteredZones = self.__clusterZones() if self._clustering_active else {}
+        
+        #Zones whose field has not changed (within the tolerance) do not run cloudy again
+        if self._reuse_active:
+            for zone in range(0,len(self.__inputs)):
+                if zone in self._clusteredZones: continue
+                if self.__canReuse(zone):
+                    self.__restoreLastRun(zone)
+                    self._reusedZones.add(zone)
+            if len(self._reusedZones) > 0:
+                print("Reusing cloudy results of zones "+str(sorted(self._reusedZones))+": their incident field barely changed.")
+        
+        def last_runtime(zone):
+            runtime = self.__memory.runtime(self._sedFiles[zone])
+            return runtime if runtime is not None else np.inf
+        
+        #Zones are pulled from a queue as soon as a cpu is free, instead of running them in fixed batches.
+        #The slowest zones of the previous iteration go first, so no long run is left alone at the end.
+        #Zones without a measured runtime (i.e.: first iteration) keep their original order.
         n_inputs = len(self.__inputs)
-        n_cpus = self._n_cpus
-        for zone in range(0,n_inputs,n_cpus):
-            currPrograms = []
-            for s in range(0,n_cpus):
-                try: currInput = self.__inputs[zone+s]
-                except IndexError: break #No more inputs
-                p = Process(target=execute_input,args=(currInput,zone+s))
-                currPrograms.append(p)
-                p.start()
-
-            #Do not start next iteration until above processes finish!
-            for program in currPrograms:
-                program.join()
+        order = sorted([zone for zone in range(0,n_inputs) if zone not in self._reusedZones and zone not in self._clusteredZones], key=last_runtime, reverse=True)
+        #Each zone is converted into skirt inputs (GasSource and MeanFileGasMix files) as soon as it finishes,
+        #while cloudy keeps running in other zones. So GenerateSkirtInput() is not needed after this method.
+        #Do not continue until all zones have finished! (this also raises any error found in a zone)
+        try:
+            self.__runner.run_all([execute_input(self.__inputs[zone],zone) for zone in order])
+        finally:
+            self.__memory.save()
+            if self.__store is not None: self.__store.report()
+        if convert:
+            #Representatives have finished, so their outputs are ready for their clustered zones
+            zones = sorted(self._clusteredZones)
+            self._convertZones(zones,[self._clusteredZones[zone] for zone in zones])
+        if self.__emulator is not None: self.__emulator.accuracyReport(self) #Compare with the emulator, zone by zone
+    
+    async def __convert(self,zone,store=False):
+        #Conversion runs in another thread, so the next zones are launched meanwhile
+        #If store is True, the skirt inputs are kept with the last run of the zone (see __storeLastRun())
+        def convert():
+            with np.errstate(all='raise'): #numpy error options are not shared between threads, see utils/unkeep.py
+                self._convertZone(zone)
+            if store: self.__storeLastConversion(zone)
+        await asyncio.get_running_loop().run_in_executor(None,convert)
+    
+    async def __runCloudy(self,filename,zone):
+        #Same as 'cloudy -r filename': reads filename.in and writes filename.out
+        #The output is checked while cloudy runs, and cloudy is stopped as soon as it crashes (result.stopped = True)
+        result = await self.__runner.launch(self.__ExePath, stdin=filename+".in", stdout=filename+".out", watch=self.__problemDisaster)
+        if result.timed_out:
+            raise RuntimeError("Cloudy took too long in zone "+str(zone)+" ("+str(result.elapsed)+" s) and it was stopped. Check "+filename+".out for more details.")
+        elif result.returncode != 0 and not result.stopped:
+            print("Warning: Cloudy exited with status "+str(result.returncode)+" in zone "+str(zone)+".")
+        return result
 
     
+    ### REUSE PREVIOUS RESULTS ###
+    
+    def __deckPhysics(self,filename):
+        #Lines of a cloudy input that define the model (title, comments and the normalization of the field are skipped)
+        result = []
+        with open(filename,'r') as file:
+            for line in file:
+                if line.startswith(('title','#','nuf(nu)','intensity')): continue
+                result.append(line.strip())
+        return result
+    
+    def __bandIntegrals(self,sedname):
+        #sed files are sorted from highest to lowest wavelength, see GenerateCloudyFiles()
+        all_data = np.flipud(readColumn(sedname,[0,1]))
+        return np.array([integrate(band,all_data[:,0],all_data[:,1]) for band in self._reuse_bands])
+    
+    def __canReuse(self,zone):
+        last_run = lambda filename : self._last_run_folder+'/'+filename
+        deck = self.__inputs[zone]+".in"
+        #Skirt inputs must be those converted from this same run. Those in input_data may come from
+        #another conversion (e.g.: the zone was clustered or emulated since then)
+        stored  = [deck,self._sedFiles[zone]] + self._zoneOutputs(zone) + self._zoneSkirtFiles(zone)
+        if not all([os.path.isfile(last_run(f)) for f in stored]):
+            return False #Nothing to reuse
+        if self.__deckPhysics(deck) != self.__deckPhysics(last_run(deck)):
+            return False #Different model (e.g.: qheat has changed)
+        new_field = self.__bandIntegrals(self._sedFiles[zone])
+        old_field = self.__bandIntegrals(last_run(self._sedFiles[zone]))
+        return bool(np.all(np.abs(new_field-old_field) <= self._reuse_threshold*np.abs(old_field)))
+    
+    ### CLUSTER SIMILAR ZONES ###
+    
+    def __zoneFeatures(self,zone):
+        #Parameters compared between zones. None (not given) must match exactly, numbers must be within the tolerance
+        features = [self._param_nH[zone], self._getThickness(zone), self._param_Y[zone], self._param_Z[zone], self._param_DTG[zone], self._param_qpah[zone]]
+        for symbol in self._param_element:
+            if symbol not in ['H','He','Z']: features.append(self._param_element[symbol]['abundance'][zone])
+        #sed files are sorted from highest to lowest wavelength, see GenerateCloudyFiles()
+        all_data = np.flipud(readColumn(self._sedFiles[zone],[0,1]))
+        features += [integrate(band,all_data[:,0],all_data[:,1]) for band in self._clustering_bands]
+        return features
+    
+    def __featureDistance(self,features,representative):
+        #Maximum relative difference. Infinite if they cannot be compared
+        distance = 0.0
+        for value,reference in zip(features,representative):
+            if value == None or reference == None:
+                if value != reference: return np.inf
+            elif reference != 0.0:
+                distance = max(distance,abs(value-reference)/abs(reference))
+            elif value != 0.0:
+                return np.inf
+        return distance
+    
+    def __clusterZones(self,filename="cloudy_clusters.txt"):
+        #Each zone joins the first representative within the tolerance, or becomes a new representative
+        #Returns {zone: representative} for the zones that joined one
+        representatives = [] #[zone,features]
+        clusters = {}
+        distances = {}
+        for zone in range(0,self._n_zones):
+            features = self.__zoneFeatures(zone)
+            for representative,representative_features in representatives:
+                if self.__noQheat[zone] != self.__noQheat[representative]: continue #Different cloudy inputs
+                distance = self.__featureDistance(features,representative_features)
+                if distance <= self._clustering_tolerance:
+                    clusters[zone] = representative
+                    distances[zone] = distance
+                    break
+            else:
+                representatives.append([zone,features])
+        
+        #Report
+        output = open(filename,'w')
+        output.write("# Column 1: zone \n")
+        output.write("# Column 2: representative zone, whose cloudy results are used \n")
+        output.write("# Column 3: maximum relative difference with the representative \n")
+        for zone in sorted(clusters):
+            output.write(str(zone)+" "+str(clusters[zone])+" "+str(distances[zone])+" \n")
+        output.close()
+        if len(clusters) > 0:
+            print("Cloudy clustering: zones "+str(sorted(clusters))+" are approximated with the results of "
+                  +str(len(representatives))+" representatives (see "+filename+").")
+        return clusters
+    
+    def __storeLastRun(self,zone):
+        #Keep the input, the field and the outputs of this run to compare with following iterations
+        #Skirt inputs of the previous run are removed, they are stored again once these outputs are converted (__storeLastConversion())
+        for filename in self._zoneSkirtFiles(zone):
+            if os.path.isfile(self._last_run_folder+'/'+filename): os.remove(self._last_run_folder+'/'+filename)
+        for filename in [self.__inputs[zone]+".in",self._sedFiles[zone]] + self._zoneOutputs(zone):
+            shutil.copy(filename,self._last_run_folder)
+    
+    def __storeLastConversion(self,zone):
+        #Skirt inputs (GasSource and MeanFileGasMix files) converted from the outputs of the last run
+        for filename in self._zoneSkirtFiles(zone):
+            shutil.copy(filename,self._last_run_folder)
+    
+    def __restoreLastRun(self,zone):
+        #Place the results of the last run of this zone (and the skirt inputs converted from them) as if cloudy had just run
+        for filename in self._zoneOutputs(zone) + self._zoneSkirtFiles(zone):
+            shutil.copy(self._last_run_folder+'/'+filename,filename)
+    
     def __writeChemistry(self,file,zone,no_qheat):
         #Mandatory parameters
         hden = np.log10(self._param_nH[zone]) #cloudy prefers the logarithm
@@ -547,27 +754,15 @@ class CloudyObject(converter.CloudyToSkirt):
     
     ### ERROR HANDLING ###       
     
-    def __problemDisaster(self,filename):
-        # Checks if 'PROBLEM DISASTER' (phrase that appears when cloudy crashes) appears in the output
-        outfile = open(filename+'.out','r')
-        
-        disaster_found = False
-        while True:
-            line = outfile.readline()
-            if not line:
-                break #EoF
-            elif 'PROBLEM DISASTER' in line:
-                disaster_found = True
-                break #cloudy crashed, no need for more reading
-        
-        outfile.close()
-        return disaster_found
+    def __problemDisaster(self,line):
+        # Checks if 'PROBLEM DISASTER' (phrase that appears when cloudy crashes) appears in a line of the output
+        return 'PROBLEM DISASTER' in line
     
-    def __errorHandleInput(self,zone,filename):
+    async def __errorHandleInput(self,zone,filename):
         #This method is used to avoid this script for crashing when cloudy crashes (if possible).
         #Something, the crash is avoid by removing some options by the input.
         
-        if self._disable_qheat == False:
+        if self._disable_qheat == False and not self.__noQheat[zone]:
             '''
             qheat error:
                 self._disable_qheat = False enables quantum heating in cloudy.
@@ -575,7 +770,6 @@ class CloudyObject(converter.CloudyToSkirt):
                 This is solved by disabling qheat with 'no qheat' in the cloudy inputs
             '''
             #Rewrite the input
-            os.system("rm "+filename+".in")
             outfile = open(filename+".in",'w')
             outfile.write("title cloudy zone "+str(zone)+" no qheat run \n")
             self.__writeChemistry(outfile,zone,True) #I'm disabling qheat here
@@ -588,9 +782,9 @@ class CloudyObject(converter.CloudyToSkirt):
             outfile.close()
             
             #Rerun input
-            os.system(self.__ExePath+" -r "+filename)
+            result = await self.__runCloudy(filename,zone)
             #And recheck if problem is solved
-            if self.__problemDisaster(filename):
+            if result.stopped:
                 #Not solved
                 raise RuntimeError("Cloudy crashed in zone "+str(zone)+". Removing qheat did not solve the issue. Check "+filename+".out for more details.")
             else:
@@ -21,54 +21,70 @@ import utils.unkeep as unk
 
 class CloudyToSkirt(object): #I need read_config
     def GenerateSkirtInput(self):
-        #Capture Outputs
-        extension = ".txt"
+        #Converts all zones at once. Note that run_input() already converts each zone as soon as cloudy finishes it
+        zones = [z for z in range(0,self._n_zones) if z not in self._reusedZones] #Files of reused zones from the previous iteration are still valid
+        self._convertZones(zones,[self._clusteredZones.get(z) for z in zones])
+    
+    def _convertZone(self,z,source=None):
+        self._convertZones([z],[source])
+    
+    def _convertZones(self,zones,sources=None):
+        #Writes the skirt inputs of a list of zones. All zones are converted together, as arrays with a row per zone
+        if len(zones) == 0: return
         #Get wavelength array (Common for all zones)
         wavelength_array = np.logspace(np.log10(self._wavelength_min),np.log10(self._wavelength_max),self._wavelength_res+1)
-        for z in range(0,self._n_zones):
-            #Get mean density
-            #print(z)
-            overview_name = "overview_zone"+str(z)+extension
-            composition_name = "composition_zone"+str(z)+extension
-            rho = self._meanDensity(overview_name,composition_name,self._param_DTG[z])
-            M   = self._param_mass[z] #remember, in solar masses
+        rho, tau_shell, extinction, albedo, nuLnu = self._zonesProperties(zones,wavelength_array,sources)
             
-            #Get opacities and corrections
-            tau_name = "tau_zone"+str(z)+extension
-            optical_depth_data = self._getOpacities(tau_name,rho,z,wavelength_array)
-            #Get luminosity, and correct it
-            spectra_name = 'spectra_zone'+str(z)+extension
-            nuLnu = self._getLuminosity(spectra_name, rho, z, wavelength_array)
-            #unk.testDownsample(unk.mean(self.__lambda),nuLnu,unk.mean(self.__lambda),nuLnu*optical_depth_data[3])
-            tau_shell = optical_depth_data[0]
-            try:
-                #Correct for self-absorption.
-                nuLnu_corrected = nuLnu * tau_shell / ( 1. - np.exp(-tau_shell) ) #optical_depth_data[3]
-                nuLnu = nuLnu_corrected
-            except FloatingPointError:
-                #print("Warning: undeflow encountered in exp(-tau) in zone "+str(z))
-                nuLnu_corrected = np.empty(len(tau_shell))
-                for t in range(0,len(tau_shell)):
-                    exp_order_of_magnitude = -tau_shell[t] / np.log(10.0) # =log10(exp(-tau))
-                    if exp_order_of_magnitude <= -250.0:
-                        #exp(-tau) = 0, avoid the underflow!
-                        nuLnu_corrected[t] = nuLnu[t] * tau_shell[t]
-                    else:
-                        nuLnu_corrected[t] = nuLnu[t] * tau_shell[t] / ( 1. - np.exp(-tau_shell[t]) )
-                nuLnu = nuLnu_corrected
-                
-            #Find normalization
-            # I need two per zone: total optical depth and luminosity
-            wv_norm = self._wavelength_norm
-            norm_values = unk.findNormalization(wv_norm,unk.mean(wavelength_array),np.array([4.0*tau_shell,nuLnu]))
-            #print(norm_values)
-            
-            #Write the files
-            self._writeOpacityFile(z,M,unk.mean(wavelength_array),optical_depth_data[1],optical_depth_data[2])
+        #Find normalization
+        # I need one per zone: luminosity
+        wv_norm = self._wavelength_norm
+        norm_values = unk.findNormalization(wv_norm,unk.mean(wavelength_array),nuLnu) #[wavelength, value of each zone]
+        #print(norm_values)
+        
+        #Write the files
+        for k in range(0,len(zones)):
+            M = self._param_mass[zones[k]] #remember, in solar masses
+            self._writeOpacityFile(zones[k],M,unk.mean(wavelength_array),extinction[k],albedo[k])
             #self._writeOpacityFile_tauNormalization(z,[norm_values[0],norm_values[1]],unk.mean(self.__lambda),optical_depth_data[1],optical_depth_data[2])
-            self._writeEmissionFile(z,[norm_values[0],norm_values[2]],unk.mean(wavelength_array),nuLnu)
-            
-            #break #Testing for the first zone only
+            self._writeEmissionFile(zones[k],[norm_values[0],norm_values[k+1]],unk.mean(wavelength_array),nuLnu[k])
+    
+    def _zoneProperties(self,z,wavelength_array,source=None):
+        #Same as _zonesProperties(), for one zone
+        rho, tau_shell, extinction, albedo, nuLnu = self._zonesProperties([z],wavelength_array,[source])
+        return [rho[0], tau_shell[0], extinction[0], albedo[0], nuLnu[0]]
+    
+    def _zonesProperties(self,zones,wavelength_array,sources=None):
+        '''
+        Reads the cloudy outputs of the zones. Returns [rho, tau, extinction, albedo, nuLnu corrected for self-absorption],
+        with a row per zone (one value per zone for rho).
+        If sources[k] is given, the outputs of zone sources[k] are used for zones[k], rescaled to its thickness and volume
+        '''
+        if sources == None: sources = [None]*len(zones)
+        sources = [z if s == None else s for z,s in zip(zones,sources)]
+        #Capture Outputs
+        overview_names, spectra_names, composition_names, tau_names = zip(*[self._zoneOutputs(s) for s in sources])
+        #Get mean density
+        rho = np.array([self._meanDensity(overview_names[k],composition_names[k],self._param_DTG[sources[k]]) for k in range(0,len(zones))])
+        ds_source = np.array([self._getThickness(s) for s in sources]) * self.pc
+        ds        = np.array([self._getThickness(z) for z in zones]) * self.pc
+        V_source  = np.array([self._getVolume(rho[k],sources[k]) for k in range(0,len(zones))])
+        V         = np.array([self._getVolume(rho[k],zones[k]) for k in range(0,len(zones))])
+        
+        #Get opacities and corrections
+        total_tau, scatt_tau = self._getOpacities(tau_names,wavelength_array)
+        #Get albedo
+        albedo = scatt_tau/total_tau
+        #Add extinction coefficient
+        extinction = total_tau / (rho*ds_source)[:,np.newaxis] #MASS extinction coefficient, in cm2/g
+        #Get luminosity, and correct it
+        FourPi_nuJnu = self._getLuminosity(spectra_names,wavelength_array)
+        nuLnu = FourPi_nuJnu*V_source[:,np.newaxis]/ds_source[:,np.newaxis]
+        #Extinction and emissivity are intrinsic, tau scales with thickness and nuLnu with volume (both ratios are 1 if zone = source)
+        tau_shell = total_tau * (ds/ds_source)[:,np.newaxis]
+        nuLnu = nuLnu * (V/V_source)[:,np.newaxis]
+        #Correct for self-absorption.
+        nuLnu = nuLnu * unk.selfAbsorptionCorrection(tau_shell)
+        return [rho, tau_shell, extinction, albedo, nuLnu]
     
     def _meanDensity(self,overview_name,composition_name,DTG):
         #Here we get the density from overview and composition files
@@ -77,20 +93,11 @@ class CloudyToSkirt(object): #I need read_config
         
         #Get depth s
         s   = unk.readColumn(overview_name,0)
-        #Get density rho, this is more complex as we have to read rows
-        abundances = open(composition_name,'r')
-        rho = []
-        while True:
-            line = abundances.readline()
-            if not line: break #EoF
-            elif line[0] == '#': continue #Commented line
-            
-            line_data = line.split()
-            ni = np.array([10.**float(line_data[i]) for i in range(0,len(line_data))])
-            rho.append(self.mH*np.dot(self.Ai,ni))
-        
-        abundances.close()
-        rho_region = np.array(rho)
+        #Get density rho, each row has log10 of number densities of all elements, from H to Zn
+        #Very low abundances underflow to 0, as they did with float() one by one (errors are raised otherwise, see utils/unkeep.py)
+        with np.errstate(under='ignore'):
+            ni = 10.**unk.readColumn(composition_name,list(range(0,len(self.Ai))))
+            rho_region = self.mH*(ni @ self.Ai)
         
         #Get gas mass density
         rho_gas = np.trapz(rho_region,s) / (s[-1]-s[0]) #Taking the mean of the zone...
@@ -100,45 +107,48 @@ class CloudyToSkirt(object): #I need read_config
         else:
             return rho_gas #DTG = 0
     
-    def _getOpacities(self,tau_name,rho,zone,wavelengths):
-        #Return is [total optical depth, extinction coefficient (cm2/g), albedo]
-        #Each element is an array of len = len(self.__lambda) - 1
-        #Each element is an array
+    def _rebinZones(self,data,wavelengths):
+        '''
+        data is a list of arrays (one per zone), with cloudy wavelengths in the first column and functions to rebin in the rest.
+        Returns an array of shape (zones, functions, len(wavelengths)-1), conserving the integral (see unk.downsample).
+        Zones with the same cloudy wavelengths (usually all of them) are rebinned together, in a single matrix product.
+        '''
+        n_functions = data[0].shape[1]-1
+        result = np.empty((len(data),n_functions,len(wavelengths)-1))
+        groups = {}
+        for k in range(0,len(data)):
+            groups.setdefault(data[k][:,0].tobytes(),[]).append(k)
+        for members in groups.values():
+            Y = np.concatenate([data[k][:,1:] for k in members],axis=1) #Columns: zone 1 functions, zone 2 functions...
+            y = unk.downsample(wavelengths,data[members[0]][:,0],Y)
+            result[members] = y.T.reshape(len(members),n_functions,len(wavelengths)-1)
+        return result
+    
+    def _getOpacities(self,tau_names,wavelengths):
+        #Return is [total optical depth, scattering optical depth]
+        #Each element is an array with a row per zone, of len = len(wavelengths) - 1
         
         #get all data
-        all_tau_data = np.flipud(unk.readColumn(tau_name,[0,1,3]))
+        all_tau_data = [np.flipud(unk.readColumn(tau_name,[0,1,3])) for tau_name in tau_names]
         #Downgrade the data. We conserve the integral of tau in wavelengths
-        total_tau = unk.downsample(wavelengths,all_tau_data[:,0],all_tau_data[:,1])
-        scatt_tau = unk.downsample(wavelengths,all_tau_data[:,0],all_tau_data[:,2])
-        #Get albedo
-        albedo = scatt_tau/total_tau
-        #Add extinction coefficient
-        ds = self._getThickness(zone) * self.pc
-        extinction = total_tau / (rho*ds) #MASS extinction coefficient, in cm2/g
+        tau = self._rebinZones(all_tau_data,wavelengths)
         #done
-        return np.array([total_tau,extinction,albedo])
+        return [tau[:,0,:],tau[:,1,:]]
     
-    def _getLuminosity(self,spectra_name,rho,zone,wavelengths):
-        #This returns nu*L_nu (erg/s). It is supposed to have the same
+    def _getLuminosity(self,spectra_names,wavelengths):
+        #This returns 4pi*nu*J_nu (erg/cm2/s) emitted by each zone (a row per zone). It is supposed to have the same
         #wavelengths as extracted before in _getOpacities()
         #This also assumes that cloudy run in the intensity case
         
-        #Get emitted spectra
-        all_data = np.flipud(unk.readColumn(spectra_name,[0,3]))
-        #To make clear what I am using here
-        wavelen_data = all_data[:,0]
-        FourPi_nuJnu_data = all_data[:,1]
-        #Use the wavelengths to degrade the spectra conserving J, not nu*J
-        #FourPi_Jlambda = unk.downsample(wavelengths,all_data[:,0],all_data[:,1]/all_data[:,0])
-        FourPi_Jlambda = unk.downsample(wavelengths,wavelen_data,FourPi_nuJnu_data/wavelen_data)
+        all_data = []
+        for spectra_name in spectra_names:
+            #Get emitted spectra
+            data = np.flipud(unk.readColumn(spectra_name,[0,3]))
+            #Use the wavelengths to degrade the spectra conserving J, not nu*J
+            all_data.append(np.column_stack([data[:,0],data[:,1]/data[:,0]]))
+        FourPi_Jlambda = self._rebinZones(all_data,wavelengths)[:,0,:]
         FourPi_nuJnu = unk.mean(wavelengths)*FourPi_Jlambda
-        
-        #Get luminosity
-        ds = self._getThickness(zone) * self.pc
-        V  = self._getVolume(rho,zone)
-        
-        nu_Lnu = FourPi_nuJnu*V/ds #To make clear what I'm returning here
-        return nu_Lnu
+        return FourPi_nuJnu
     
     def _getVolume(self,rho,zone):
         return (self._param_mass[zone]*self.Msun) / rho #in cm3
@@ -213,6 +223,15 @@ class CloudyToSkirt(object): #I need read_config
         filename.write("# Column 4: scattering asymmetry parameter (1) \n")
         filename.write("# region mass "+str(mass)+" \n")
     
+    def _zoneOutputs(self,zone,extension=".txt"):
+        #Files saved by cloudy for each zone (see __writeOutputs() in CloudyClass.py)
+        return ["overview_zone"+str(zone)+extension, "spectra_zone"+str(zone)+extension,
+                "composition_zone"+str(zone)+extension, "tau_zone"+str(zone)+extension]
+    
+    def _zoneSkirtFiles(self,zone):
+        #Files generated here for each zone
+        return ["GasSource_"+self._writeNumeric(zone)+".stab", "MeanFileGasMix_"+self._writeNumeric(zone)+".stab"]
+    
     def _writeNumeric(self,zone):
         if len(str(zone)) > 3:
             raise RuntimeError("Too many zones!")
@@ -246,55 +265,32 @@ class CloudyToSkirt(object): #I need read_config
         and generates a readable input for cloudy
         '''
         
-        #I keep these variables due to compatibility with previous code
-        n_digits = self._n_digits
-        useIntensity = self._use_intensity_command_in_cloudy 
-                                #If True, it will use the cloudy intensity at range
-                                #Otherwise, it will use nuf(nu) X at Y (Ryd)
-        wl_nuF = self._wavelength_norm # used if above is false
-        
         #Read file
-        file = open(Jfilename,'r')
+        #Here we colect the wavelengths, from the header.
+        #The structure of the skirt output is
+        #Column 1: lambda*J_lambda at lambda = 0.0001 micron (W/m2/sr)
+        #If we split line in line_data, the only element that can be
+        #converted to a float is 0.0001, which is the wavelength
         wavelength = []
-        x = []
-        y = []
-        z = []
-        nuJnu = []
-        while True:
-            line = file.readline()
-            if not line: #EoF
-                break
-            line_data = line.split()
-            
-            if line_data[0] == '#':
-                #Here we colect the wavelengths.
-                #The structure of the skirt output is
-                #Column 1: lambda*J_lambda at lambda = 0.0001 micron (W/m2/sr)
-                #If we split line in line_data, the only element that can be
-                #converted to a float is 0.0001, which is the wavelength
+        with open(Jfilename,'r') as file:
+            for line in file:
+                line_data = line.split()
+                if len(line_data) == 0 or line_data[0] != '#': break #End of the header
                 for element in line_data:
                     try:
                         wavelength.append(float(element))
-                    except:
+                    except ValueError:
                         continue
-            else:
-                nuJnu.append([])
-                #First 3 columns are x,y,z
-                x.append(float(line_data[0]))
-                y.append(float(line_data[1]))
-                z.append(float(line_data[2]))
-                for i in range(3,len(line_data)):
-                    nuJnu[-1].append(float(line_data[i]))
-        file.close()
-        
-        x = np.array(x)
-        y = np.array(y)
-        z = np.array(z)
+        #Then the data, in one go. First 3 columns are x,y,z
+        data = np.loadtxt(Jfilename,comments='#',ndmin=2)
+        x = data[:,0]
+        y = data[:,1]
+        z = data[:,2]
         #Also flip next arrays, as cloudy wants it in opposite order
         #wavelength = np.flip(np.array(wavelength)) * microns_TO_nm #in nm
         #nuJnu = np.fliplr(np.array(nuJnu))
         wavelength = np.array(wavelength) * self.microns_TO_nm #in nm
-        nuJnu = np.array(nuJnu) * self.W_per_m2_TO_erg_per_cm2
+        nuJnu = data[:,3:] * self.W_per_m2_TO_erg_per_cm2
         
         #Create the sed files
         outputfiles = self._sedFiles
@@ -309,45 +305,56 @@ class CloudyToSkirt(object): #I need read_config
         if len(nuJnu) < len(outputfiles):
             raise RuntimeError("Number of outputs does not match!")
         for i in range(0,len(nuJnu)):
-            R = np.sqrt(x[i]*x[i] + y[i]*y[i] + z[i]*z[i])
-            fluxfile = None
             if i < len(outputfiles):
-                fluxfile = open(outputfiles[i],'w')
+                fluxname = outputfiles[i]
             else:
                 #W.I.P. Change 'extra' for the same name as outputfiles, but with the different R
                 r = np.sqrt(x[i]*x[i] + y[i]*y[i]) / 1000.0 #kpc
-                fluxfile = open("output_R"+str(r)+"_z"+str(z[i]/1000.0)+"kpc.sed",'w')
-            #fluxfile.write("# nuFnu at "+str(R)+" pc \n")
-            fluxfile.write("# column 1: wavelength (nm) \n")
-            fluxfile.write("# column 2: 4pi*nu*J_nu (erg/cm2/s) \n")
-            if useIntensity:
-                #Control_value is the integral at wavelengths of intensity
-                total_J = np.trapz(nuJnu[i]/wavelength,wavelength)
-                fluxfile.write("# intensity "+str(self.round_to(n_digits,np.log10(4.0*np.pi*total_J)))+" range "+str(wavelength[0])+" to "+str(wavelength[-1])+" nm \n")
-            else:
-                #Control value is nu*F at wl_nuF
-                fixed_values = unk.findNormalization(wl_nuF,wavelength,nuJnu[i])
-                fixed_wavelength = fixed_values[0]
-                fixed_nuF = fixed_values[1]*4.0*np.pi #nuf(nu) command in cloudy actually asks for 4pi*nuJnu, see hazy 1
-                #Above line may make coudy to fail. If that happens, cut the decimals in the respective cloudy input and repeat
-                photon_energy = self.nm_to_Ryd(fixed_wavelength)
-                try:
-                    fluxfile.write("# nuf(nu) "+str(self.round_to(n_digits,np.log10(fixed_nuF)))+" at "+str(photon_energy)+" #("+str(fixed_wavelength)+" nm) \n")
-                except OverflowError:
-                    print(R,fixed_wavelength,fixed_nuF)
-                    raise RuntimeError("Overflow error. Have you checked that skirt grid boundaries are higher than your wanted output positions?")
-                
-            options_written = False
-            for j in range(len(nuJnu[i])-1,0,-1):
-                nuJnu_write = nuJnu[i][j]
-                if nuJnu_write < 1e-300: nuJnu_write = 1e-300 #Cloudy cannot read 0.0
-                fluxfile.write(str(self.round_to(n_digits,wavelength[j]))+" "+str(self.round_to(n_digits,4.0*np.pi*nuJnu_write)))
-                if not options_written:
-                    fluxfile.write(" nuFnu units nm \n")
-                    options_written = True
-                else:
-                    fluxfile.write(" \n")
-            fluxfile.close()
+                fluxname = "output_R"+str(r)+"_z"+str(z[i]/1000.0)+"kpc.sed"
+            self._writeSedFile(fluxname,wavelength,nuJnu[i])
+    
+    def _writeSedFile(self,filename,wavelength,nuJnu):
+        #Writes a cloudy 'table sed' file with nu*J_nu (erg/cm2/s/sr) at wavelength (nm, increasing order)
+        #I keep these variables due to compatibility with previous code
+        n_digits = self._n_digits
+        useIntensity = self._use_intensity_command_in_cloudy 
+                                #If True, it will use the cloudy intensity at range
+                                #Otherwise, it will use nuf(nu) X at Y (Ryd)
+        wl_nuF = self._wavelength_norm # used if above is false
+        fluxfile = open(filename,'w')
+        #fluxfile.write("# nuFnu at "+str(R)+" pc \n")
+        fluxfile.write("# column 1: wavelength (nm) \n")
+        fluxfile.write("# column 2: 4pi*nu*J_nu (erg/cm2/s) \n")
+        if useIntensity:
+            #Control_value is the integral at wavelengths of intensity
+            total_J = np.trapz(nuJnu/wavelength,wavelength)
+            fluxfile.write("# intensity "+str(self.round_to(n_digits,np.log10(4.0*np.pi*total_J)))+" range "+str(wavelength[0])+" to "+str(wavelength[-1])+" nm \n")
+        else:
+            #Control value is nu*F at wl_nuF
+            fixed_values = unk.findNormalization(wl_nuF,wavelength,nuJnu)
+            fixed_wavelength = fixed_values[0]
+            fixed_nuF = fixed_values[1]*4.0*np.pi #nuf(nu) command in cloudy actually asks for 4pi*nuJnu, see hazy 1
+            #Above line may make coudy to fail. If that happens, cut the decimals in the respective cloudy input and repeat
+            photon_energy = self.nm_to_Ryd(fixed_wavelength)
+            try:
+                fluxfile.write("# nuf(nu) "+str(self.round_to(n_digits,np.log10(fixed_nuF)))+" at "+str(photon_energy)+" #("+str(fixed_wavelength)+" nm) \n")
+            except OverflowError:
+                print(filename,fixed_wavelength,fixed_nuF)
+                raise RuntimeError("Overflow error. Have you checked that skirt grid boundaries are higher than your wanted output positions?")
+            
+        #Cloudy wants it from highest to lowest wavelength (the shortest wavelength is left out)
+        nuJnu_write = nuJnu[:0:-1]
+        zeros = nuJnu_write < 1e-300 #Cloudy cannot read 0.0
+        wavelength_write = unk.roundArray(n_digits,wavelength[:0:-1])
+        FourPi_nuJnu_write = unk.roundArray(n_digits,4.0*np.pi*np.where(zeros,1.0,nuJnu_write))
+        FourPi_nuJnu_write[zeros] = self.round_to(n_digits,4.0*np.pi*1e-300)
+        wavelength_write = wavelength_write.tolist()
+        FourPi_nuJnu_write = FourPi_nuJnu_write.tolist()
+        rows = [str(wavelength_write[j])+" "+str(FourPi_nuJnu_write[j]) for j in range(0,len(wavelength_write))]
+        if len(rows) > 0:
+            fluxfile.write(rows[0]+" nuFnu units nm \n")
+            fluxfile.write("".join([row+" \n" for row in rows[1:]]))
+        fluxfile.close()
     
     #DEPRECIATED
     def _writeOpacityHeader_tauNormalization(self,filename,wv,tau): #DEPRECIATED
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Emulator of cloudy, for exploratory runs (e.g.: parameter scans) where calling cloudy is too slow.
+Cloudy is run once over a grid of zone parameters, and the intrinsic properties of each model
+(density, emissivity, extinction coefficient and albedo, in the wavelengths of skirt) are kept
+in a binary table (a numpy .npz file). Then, CloudyObject interpolates this table in place of run_input().
+
+Each zone is described by these quantities (the axes of the table):
+    'log_hden'         : log10 of hydrogen density (cm-3)
+    'helium'           : He mass fraction
+    'metallicity'      : metals mass fraction
+    'DTG'              : dust-to-gas ratio
+    'qpah'             : pah-to-dust ratio
+    'log_thickness'    : log10 of the thickness of the zone (pc), see _getThickness() in ConverterMethods
+    'log_intensity'    : log10 of the integral of 4pi*nu*J_nu over ln(wavelength), of the incident field (erg/cm2/s)
+    'ionizing_fraction': fraction of the above integral below 91.2 nm
+The shape of the incident field is only described by the last one, so the table is built scaling
+a template sed (below and above 91.2 nm). Zones whose field is very different from the template will be poorly emulated.
+Zones outside the table are clamped to its borders (a warning is given).
+
+To build a table, fill the variables at the end of this file and run, from the root folder (as Main.py):
+    python3 -m cloudy.Emulator
+To check a table, use it with 'active': False and 'report': True (see 'CloudyEmulator' in Main.py).
+Then cloudy runs as usual and 'emulator_accuracy.dat' compares both results, zone by zone.
+'''
+
+import itertools
+import numpy as np
+from utils.unkeep import readColumn, findNormalization, mean
+
+def fieldIntegrals(wavelength,FourPi_nuJnu):
+    #Returns the integral of 4pi*nu*J_nu over ln(wavelength), in total and below 91.2 nm (ionizing)
+    ionizing = wavelength < 91.2
+    total_field    = np.trapz(FourPi_nuJnu/wavelength,wavelength)
+    ionizing_field = np.trapz(np.where(ionizing,FourPi_nuJnu,0.0)/wavelength,wavelength)
+    return total_field, ionizing_field
+
+class CloudyEmulator(object):
+    #Same order as the axes of the table
+    axes = ['log_hden','helium','metallicity','DTG','qpah','log_thickness','log_intensity','ionizing_fraction']
+
+    def __init__(self,table_path):
+        table = np.load(table_path)
+        self.__grid = [table['axis_'+name] for name in self.axes]
+        self.__wavelengths    = table['wavelengths'] #nm, bin centers used by skirt
+        self.__log_rho        = table['log_rho'] #g/cm3, shape = grid shape
+        self.__log_emissivity = table['log_emissivity'] #nuLnu per unit volume (erg/s/cm3), shape = grid shape + (n_wavelengths,)
+        self.__log_extinction = table['log_extinction'] #cm2/g
+        self.__albedo         = table['albedo']
+
+    ### DESCRIPTORS ###
+
+    @staticmethod
+    def descriptors(cloudy,zone):
+        #Values of the axes for a zone of a CloudyObject, as a list
+        Y = cloudy._param_Y[zone]
+        Z = cloudy._param_Z[zone]
+        if Y == None: #Default options
+            Y = cloudy._cloudy_default_Y
+            Z = cloudy._cloudy_default_Z
+        elif Z == None:
+            raise RuntimeError("The emulator cannot reproduce custom abundances (zone "+str(zone)+"). Give the metallicity instead.")
+        DTG  = cloudy._param_DTG[zone]
+        qpah = cloudy._param_qpah[zone]
+        if DTG == None: #'grains ism' and 'grains pah' with their default abundances
+            DTG  = cloudy._cloudy_default_DTG
+            qpah = cloudy._cloudy_default_qpah if cloudy._enable_PAH else 0.0
+        elif DTG <= 0.0:
+            DTG  = 0.0
+            qpah = 0.0
+        elif qpah == None or qpah < 0.0:
+            qpah = 0.0
+
+        #sed files are sorted from highest to lowest wavelength, see GenerateCloudyFiles()
+        sed = np.flipud(readColumn(cloudy._sedFiles[zone],[0,1]))
+        total_field, ionizing_field = fieldIntegrals(sed[:,0],sed[:,1])
+        return [np.log10(cloudy._param_nH[zone]), Y, Z, DTG, qpah, np.log10(cloudy._getThickness(zone)),
+                np.log10(total_field), ionizing_field/total_field]
+
+    ### INTERPOLATION ###
+
+    def interpolate(self,point):
+        '''
+        Multilinear interpolation of the table at 'point' (a list of descriptors).
+        Density, emissivity and extinction are interpolated in logarithm.
+        Returns [rho, emissivity, extinction, albedo] and the list of axes where point was outside the table.
+        '''
+        corners = []
+        outside = []
+        for name,axis,value in zip(self.axes,self.__grid,point):
+            if len(axis) == 1: #Fixed in the whole table
+                if not np.isclose(value,axis[0]): outside.append(name)
+                corners.append([(0,1.0)])
+                continue
+            if value < axis[0] or value > axis[-1]: outside.append(name)
+            value = min(max(value,axis[0]),axis[-1])
+            i = min(np.searchsorted(axis,value,side='right')-1,len(axis)-2)
+            t = (value-axis[i])/(axis[i+1]-axis[i])
+            corners.append([(i,1.0-t),(i+1,t)])
+
+        log_rho = 0.0
+        log_emissivity = 0.0
+        log_extinction = 0.0
+        albedo = 0.0
+        for corner in itertools.product(*corners):
+            index  = tuple([c[0] for c in corner])
+            weight = np.prod([c[1] for c in corner])
+            if weight == 0.0: continue
+            log_rho        += weight*self.__log_rho[index]
+            log_emissivity += weight*self.__log_emissivity[index]
+            log_extinction += weight*self.__log_extinction[index]
+            albedo         += weight*self.__albedo[index]
+        return [10.**log_rho, 10.**log_emissivity, 10.**log_extinction, albedo], outside
+
+    def __checkWavelengths(self,cloudy):
+        wavelengths = mean(np.logspace(np.log10(cloudy._wavelength_min),np.log10(cloudy._wavelength_max),cloudy._wavelength_res+1))
+        if len(wavelengths) != len(self.__wavelengths) or not np.allclose(wavelengths,self.__wavelengths):
+            raise RuntimeError("The emulator table was built with other wavelengths. Build it again with the 'Wavelength' options of Main.py")
+        return wavelengths
+
+    ### PUBLIC METHODS ###
+
+    def writeZones(self,cloudy):
+        #Same files that cloudy and GenerateSkirtInput() would give (GasSource and MeanFileGasMix)
+        wavelengths = self.__checkWavelengths(cloudy)
+        for z in range(0,cloudy._n_zones):
+            [rho,emissivity,extinction,albedo], outside = self.interpolate(self.descriptors(cloudy,z))
+            if len(outside) > 0:
+                print("Warning: zone "+str(z)+" is outside the emulator table in "+str(outside)+". Values at the border are used.")
+            nuLnu = emissivity*cloudy._getVolume(rho,z)
+            norm_values = findNormalization(cloudy._wavelength_norm,wavelengths,nuLnu)
+            cloudy._writeOpacityFile(z,cloudy._param_mass[z],wavelengths,extinction,albedo)
+            cloudy._writeEmissionFile(z,norm_values,wavelengths,nuLnu)
+        print("Cloudy emulated in "+str(cloudy._n_zones)+" zones.")
+
+    def accuracyReport(self,cloudy,filename="emulator_accuracy.dat"):
+        '''
+        Compares the emulator with the cloudy outputs of the current iteration (so call it after run_input()).
+        For each zone it writes the relative error of rho and of the total nuLnu,
+        and the median over wavelengths of |log10(ratio)| of extinction and of |difference| of albedo.
+        Zones approximated by cloudy clustering did not run cloudy (their outputs are not there), so they are left out.
+        '''
+        wavelengths = self.__checkWavelengths(cloudy)
+        wavelength_bins = np.logspace(np.log10(cloudy._wavelength_min),np.log10(cloudy._wavelength_max),cloudy._wavelength_res+1)
+        errors = []
+        output = open(filename,'w')
+        output.write("# Column 1: zone \n")
+        output.write("# Column 2: relative error of density (1) \n")
+        output.write("# Column 3: relative error of total luminosity (1) \n")
+        output.write("# Column 4: median |log10(emulated/cloudy)| of extinction (dex) \n")
+        output.write("# Column 5: median |emulated-cloudy| of albedo (1) \n")
+        output.write("# Column 6: axes where the zone is outside the table \n")
+        clustered = sorted(cloudy._clusteredZones)
+        if len(clustered) > 0:
+            output.write("# Clustered zones (not compared): "+" ".join([str(z) for z in clustered])+" \n")
+        zones = [z for z in range(0,cloudy._n_zones) if z not in cloudy._clusteredZones]
+        if len(zones) == 0:
+            output.close()
+            return
+        #Rows of these arrays follow 'zones'
+        rho, tau_shell, extinction, albedo, nuLnu = cloudy._zonesProperties(zones,wavelength_bins)
+        for i,z in enumerate(zones):
+            [rho_e,emissivity_e,extinction_e,albedo_e], outside = self.interpolate(self.descriptors(cloudy,z))
+            nuLnu_e = emissivity_e*cloudy._getVolume(rho_e,z)
+            total   = np.trapz(nuLnu[i]/wavelengths,wavelengths)
+            total_e = np.trapz(nuLnu_e/wavelengths,wavelengths)
+            zone_errors = [abs(rho_e-rho[i])/rho[i], abs(total_e-total)/total,
+                           np.median(np.abs(np.log10(extinction_e/extinction[i]))), np.median(np.abs(albedo_e-albedo[i]))]
+            errors.append(zone_errors)
+            output.write(str(z)+" "+" ".join([str(e) for e in zone_errors])+" "+(",".join(outside) if len(outside) > 0 else "-")+" \n")
+        output.close()
+        if len(errors) > 0:
+            errors = np.array(errors)
+            print("Emulator accuracy (median, max): density "+str(np.median(errors[:,0]))+", "+str(np.max(errors[:,0]))
+                  +"; luminosity "+str(np.median(errors[:,1]))+", "+str(np.max(errors[:,1]))
+                  +". See "+filename+" for details.")
+
+### TABLE BUILDER ###
+
+def buildTable(options_dict,grid,template_sed,output="cloudy_emulator.npz",prefix="emulator"):
+    '''
+    Runs cloudy over the grid (a dictionary with a list of values for each axis, see CloudyEmulator.axes)
+    and saves the table in 'output'.
+    options_dict is the same dictionary as Options in Main.py. 'FileParameters' is not used.
+    template_sed is a cloudy sed file (e.g.: one of a previous run) whose shape is used for all incident fields.
+    Note that the number of cloudy runs is the product of the lengths of the lists in grid!
+    '''
+    from cloudy.CloudyClass import CloudyObject
+    axes = [np.sort(np.array(grid[name],dtype=float)) for name in CloudyEmulator.axes]
+    shape = tuple([len(axis) for axis in axes])
+    points = list(itertools.product(*axes))
+
+    template = np.flipud(readColumn(template_sed,[0,1]))
+    template_wl = template[:,0]
+    ionizing = template_wl < 91.2
+    total_field, ionizing_field = fieldIntegrals(template_wl,template[:,1])
+    non_ionizing_field = total_field - ionizing_field
+    if ionizing_field <= 0.0 and np.any(axes[CloudyEmulator.axes.index('ionizing_fraction')] > 0.0):
+        raise RuntimeError("The template sed has no ionizing photons, it cannot be scaled to the ionizing fractions of the grid.")
+
+    #Zones of the grid, written as an ISM parameters file
+    gas_file = prefix+"_gas.dat"
+    gas = open(gas_file,'w')
+    gas.write("# Column 1 : SedFile \n")
+    gas.write("# Column 2 : Mass (Msun) \n")
+    gas.write("# Column 3 : HydrogenDensity (cm-3) \n")
+    gas.write("# Column 4 : Geometry ['type',params](pc) \n")
+    gas.write("# Column 5 : Helium fraction (1) \n")
+    gas.write("# Column 6 : Metallicity (1) \n")
+    gas.write("# Column 7 : Dust-to-gas ratio (1) \n")
+    gas.write("# Column 8 : PAH-to-dust ratio (1) \n")
+    for p in range(0,len(points)):
+        log_hden, Y, Z, DTG, qpah, log_thickness, log_intensity, ionizing_fraction = points[p]
+        thickness = 10.**log_thickness
+        #A ring, so the thickness is its whole width. Mass is irrelevant, the table stores intrinsic quantities
+        gas.write(prefix+"_"+str(p)+".sed 1.0 "+str(10.**log_hden)+" ['ring',"+str(thickness)+","+str(thickness)+","+str(thickness)+"] "
+                  +str(Y)+" "+str(Z)+" "+str(DTG)+" "+str(qpah)+" \n")
+    gas.close()
+
+    options = dict(options_dict)
+    options['FileParameters'] = dict(options_dict['FileParameters'],ISM=gas_file)
+    options['AccuracyAndSpeed'] = dict(options_dict['AccuracyAndSpeed'],
+                                       CloudyReuse=dict(options_dict['AccuracyAndSpeed']['CloudyReuse'],active=False),
+                                       CloudyClustering=dict(options_dict['AccuracyAndSpeed']['CloudyClustering'],active=False),
+                                       CloudyEmulator=dict(options_dict['AccuracyAndSpeed']['CloudyEmulator'],active=False,report=False))
+    options['Technical'] = dict(options_dict['Technical'],cloudy_zone_memory=prefix+"_zones.json")
+    cloudy = CloudyObject(options)
+
+    #Incident fields
+    for p in range(0,len(points)):
+        intensity = 10.**points[p][6]
+        ionizing_fraction = points[p][7]
+        field = np.where(ionizing, template[:,1]*ionizing_fraction*intensity/ionizing_field if ionizing_field > 0.0 else 0.0,
+                                   template[:,1]*(1.0-ionizing_fraction)*intensity/non_ionizing_field)
+        cloudy._writeSedFile(cloudy._sedFiles[p],template_wl,field/(4.0*np.pi))
+
+    cloudy.make_input(prefix+"Input")
+    cloudy.run_input(convert=False)
+
+    wavelength_bins = np.logspace(np.log10(cloudy._wavelength_min),np.log10(cloudy._wavelength_max),cloudy._wavelength_res+1)
+    n_wavelengths = len(wavelength_bins)-1
+    zones = list(range(0,len(points)))
+    rho, tau_shell, extinction, albedo, nuLnu = cloudy._zonesProperties(zones,wavelength_bins)
+    V = np.array([cloudy._getVolume(rho[p],p) for p in zones])
+    log_rho = np.log10(rho)
+    #Zeros are kept as a very low number, so logarithms can be interpolated
+    log_emissivity = np.log10(np.maximum(nuLnu/V[:,np.newaxis],1e-300))
+    log_extinction = np.log10(np.maximum(extinction,1e-300))
+
+    np.savez_compressed(output, wavelengths=mean(wavelength_bins),
+                        log_rho=log_rho.reshape(shape), log_emissivity=log_emissivity.reshape(shape+(n_wavelengths,)),
+                        log_extinction=log_extinction.reshape(shape+(n_wavelengths,)), albedo=albedo.reshape(shape+(n_wavelengths,)),
+                        **{'axis_'+name:axis for name,axis in zip(CloudyEmulator.axes,axes)})
+    print("Emulator table with "+str(len(points))+" cloudy models saved in "+output)
+
+if __name__ == '__main__':
+    '''
+    Fill these variables and run 'python3 -m cloudy.Emulator' from the root folder.
+    Wavelength options must be the same as in Main.py, or the table cannot be used.
+    Axes with one value are fixed, zones with other values are emulated with that value.
+    '''
+    Options = {
+        'FileParameters':{},
+        'Wavelength':{'maxWavelength':3.0e5, 'minWavelength':10.0, 'resolution':200, 'normalization':550.0},
+        'AccuracyAndSpeed':{
+            'n_cpus': 2,
+            'CloudyReuse':{'active':False, 'bands':[], 'threshold':0.0},
+            'CloudyClustering':{'active':False, 'tolerance':0.0, 'bands':[]},
+            'CloudyStore':{'active':False, 'folder':'cloudy_store', 'max_size_MB':5000},
+            'CloudyEmulator':{'active':False, 'table':'', 'report':False}
+        },
+        'Technical':{'cloudy_path':'/path/to/your/cloudy/exe', 'cloudy_timeout':None, 'qheat_retry_every':0}
+    }
+    grid = {
+        'log_hden': [-1.0, 0.0, 1.0],
+        'helium': [0.25],
+        'metallicity': [0.004, 0.02],
+        'DTG': [0.001, 0.01],
+        'qpah': [0.07],
+        'log_thickness': [1.0, 2.0],
+        'log_intensity': [-5.0, -4.0, -3.0],
+        'ionizing_fraction': [0.05, 0.3]
+    } #144 cloudy runs
+    template_sed = 'iteration1/YourGasRegion.sed'
+    buildTable(Options, grid, template_sed, output='input_data/cloudy_emulator.npz')
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Persistent store of cloudy results, shared between iterations and runs.
+Each entry contains the four files saved by cloudy that GenerateSkirtInput() needs
+(overview, spectra, composition and tau), and it is labelled with a hash of the cloudy
+input (the model lines of the deck plus the content of its incident 'table sed').
+Therefore, a model that was already computed is never run again, no matter the zone or run it comes from.
+
+The store is a folder with one subfolder per entry. The oldest used entries are
+removed when the store is bigger than its maximum size (LRU eviction).
+Eviction is done once per iteration, in report().
+Hits and misses are counted, and the totals are kept in 'stats.json' inside the store.
+'''
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+class ResultStore(object):
+    def __init__(self,folder,max_size_MB):
+        self.__folder = os.path.expanduser(folder)
+        self.__max_size = max_size_MB*1024*1024 #bytes
+        self.__entry_files = ['overview.txt','spectra.txt','composition.txt','tau.txt'] #Same order as _zoneOutputs() in ConverterMethods
+        os.makedirs(self.__folder,exist_ok=True)
+        #Statistics
+        self.hits = 0 #Of this iteration
+        self.misses = 0
+        self.__stats_file = os.path.join(self.__folder,'stats.json')
+
+    def __entry(self,key):
+        return os.path.join(self.__folder,key[:2],key)
+
+    ### KEYS ###
+
+    def key(self,deck_name,sed_name):
+        #The title, comments, outputs and sed filename do not change the model, so they are skipped
+        model = []
+        with open(deck_name,'r') as deck:
+            for line in deck:
+                if line.startswith(('title','#','save','table sed')): continue
+                model.append(line.strip())
+        label = hashlib.sha256("\n".join(model).encode())
+        with open(sed_name,'rb') as sed:
+            label.update(sed.read())
+        return label.hexdigest()
+
+    ### ENTRIES ###
+
+    def fetch(self,key,outputs):
+        #Copies the stored files of 'key' as 'outputs' (filenames). Returns False if the entry is not found
+        entry = self.__entry(key)
+        try:
+            for stored,output in zip(self.__entry_files,outputs):
+                shutil.copy(os.path.join(entry,stored),output)
+            os.utime(entry) #Mark as recently used
+        except OSError:
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+
+    def store(self,key,outputs):
+        entry = self.__entry(key)
+        if os.path.isdir(entry): return
+        #Write in a temporary folder and rename it, so other runs never see half-written entries
+        tmp_entry = entry+'.tmp'+str(os.getpid())
+        os.makedirs(tmp_entry,exist_ok=True)
+        for stored,output in zip(self.__entry_files,outputs):
+            shutil.copy(output,os.path.join(tmp_entry,stored))
+        try:
+            os.rename(tmp_entry,entry)
+        except OSError:
+            shutil.rmtree(tmp_entry,ignore_errors=True) #Another run stored it first
+
+    def __evict(self):
+        entries = []
+        total_size = 0
+        for subfolder in os.scandir(self.__folder):
+            if not subfolder.is_dir(): continue
+            for entry in os.scandir(subfolder.path):
+                if not entry.is_dir() or '.tmp' in entry.name: continue
+                size = sum([f.stat().st_size for f in os.scandir(entry.path)])
+                entries.append((entry.stat().st_mtime,size,entry.path))
+                total_size += size
+        #Oldest used first
+        entries.sort()
+        for last_used,size,path in entries:
+            if total_size <= self.__max_size: break
+            shutil.rmtree(path,ignore_errors=True)
+            total_size -= size
+
+    ### STATISTICS ###
+
+    def report(self):
+        #Prints hits and misses of this iteration, adds them to the totals and resets the counters
+        #Old entries are removed here, once per iteration
+        self.__evict()
+        stats = {'hits':0,'misses':0}
+        if os.path.isfile(self.__stats_file):
+            with open(self.__stats_file,'r') as file:
+                stats = json.load(file)
+        stats['hits'] += self.hits
+        stats['misses'] += self.misses
+        stats['last_update'] = time.ctime()
+        with open(self.__stats_file,'w') as file:
+            json.dump(stats,file,indent=1)
+        print("Cloudy store: "+str(self.hits)+" hits and "+str(self.misses)+" misses in this iteration ("
+              +str(stats['hits'])+" hits and "+str(stats['misses'])+" misses in total).")
+        self.hits = 0
+        self.misses = 0
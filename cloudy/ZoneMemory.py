@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+This class remembers what happened to each cloudy zone in previous iterations
+(and previous runs), so CloudyObject does not have to learn it again.
+For each zone it stores:
+    'runtime'  : wall time (s) of its last cloudy run. Used to launch slowest zones first.
+    'no_qheat' : True if cloudy crashed with quantum heating, so 'no qheat' must be used.
+    'runs_since_crash': number of runs done in 'no qheat' mode since the last crash.
+Zones are identified by their sed filename, so the memory survives if zones are reordered.
+Data is saved in a json file at the root folder.
+'''
+
+import json
+import os
+
+class ZoneMemory(object):
+    def __init__(self,filename,retry_every=0):
+        self.__filename = filename
+        self.__retry_every = retry_every #If > 0, 'no qheat' zones try again with qheat after this number of runs
+        self.__zones = {}
+        if os.path.isfile(filename):
+            with open(filename,'r') as file:
+                self.__zones = json.load(file)
+
+    def __zone(self,key):
+        return self.__zones.setdefault(key,{'runtime':None,'no_qheat':False,'runs_since_crash':0})
+
+    ### RUNTIMES ###
+
+    def runtime(self,key):
+        return self.__zone(key)['runtime']
+
+    def setRuntime(self,key,seconds):
+        self.__zone(key)['runtime'] = seconds
+
+    ### DECK VARIANTS ###
+
+    def useNoQheat(self,key):
+        #Tells if the deck of this zone should be written with 'no qheat' in the next run
+        zone = self.__zone(key)
+        if not zone['no_qheat']:
+            return False
+        if self.__retry_every > 0 and zone['runs_since_crash'] >= self.__retry_every:
+            return False #Probe the original deck again, maybe the zone does not crash anymore
+        return True
+
+    def ranWith(self,key,no_qheat,crashed=False):
+        #Called once per zone after each cloudy run (without counting the error handling rerun)
+        zone = self.__zone(key)
+        if crashed:
+            zone['no_qheat'] = True
+            zone['runs_since_crash'] = 0
+        elif no_qheat:
+            zone['runs_since_crash'] += 1
+        else:
+            #qheat worked
+            zone['no_qheat'] = False
+            zone['runs_since_crash'] = 0
+
+    def save(self):
+        with open(self.__filename,'w') as file:
+            json.dump(self.__zones,file,indent=1)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+'Adaptive' photon probability (AccuracyAndSpeed->PhotonProbability->per_region).
+After each skirt simulation, the relative Monte Carlo noise of the radiation field is measured at every
+output position and wavelength:
+    - From skirt_file_nuJnu_J_noise.dat, if skirt runs as an ensemble of seeds (see skirt/parallel.py).
+    - Otherwise, from the change between the last two radiation fields. That change also contains any real change
+      of the field between iterations (not only noise), so wavelengths still evolving get more photons too.
+      Iteration 0 has no gas, so its field is not compared with the next one (as in skirt/scheduler.py).
+Then, the wavelength distribution of the photons launched in each region is moved towards the noisiest wavelengths
+(photons needed to reach the same noise scale as noise^2), and wavelengths inside the 'Convergence' ranges are favoured.
+Region N uses the noise measured at position N (its zone), as in the positions file.
+'''
+
+import os
+import numpy as np
+from utils.unkeep import writeProbabilityFile
+
+class AdaptiveDistribution(object):
+    def __init__(self,options_dict,folder='input_data/probability_distributions'):
+        adaptive_dict = options_dict['AccuracyAndSpeed']['PhotonProbability']['Adaptive']
+        self.__focus = adaptive_dict['focus'] #Extra weight of wavelengths inside 'Convergence' ranges
+        self.__floor = adaptive_dict['floor'] #Minimum probability density, relative to the mean
+        self.__smoothing = 5 #Bins of the running mean applied to the noise
+        self.__folder = folder
+        self.__ranges = [conv_dict['wavelengthRange'] for key,conv_dict in options_dict['Convergence'].items() if key != 'Criteria']
+        self.__previous = None #Last field read
+        self.__density = None #Current probability density per log(wavelength), per position
+        self.__files = dict()
+
+    def file(self,position):
+        #Distribution of the region at 'position', or None if there is no measurement yet (skirt default is used)
+        return self.__files.get(position)
+
+    def __readProbe(self,probe):
+        #Same format as the file read by cloudy.GenerateCloudyFiles()
+        wavelength = []
+        with open(probe,'r') as file:
+            for line in file:
+                line_data = line.split()
+                if len(line_data) == 0 or line_data[0] != '#': break #End of the header
+                for element in line_data:
+                    try:
+                        wavelength.append(float(element))
+                    except ValueError:
+                        continue
+        data = np.loadtxt(probe,comments='#',ndmin=2)
+        return 1.0e3*np.array(wavelength), data[:,3:] #nm
+
+    def __weights(self,wavelength):
+        #'focus' inside the convergence ranges (or at the closest wavelength, if a single wavelength is given), 1 outside
+        weights = np.ones(len(wavelength))
+        for wl_range in self.__ranges:
+            if isinstance(wl_range,(tuple,list,np.ndarray)):
+                inside = (wavelength >= min(wl_range)) & (wavelength <= max(wl_range))
+            else:
+                inside = np.zeros(len(wavelength),dtype=bool)
+                inside[np.argmin(np.abs(np.log(wavelength/wl_range)))] = True
+            weights[inside] = self.__focus
+        return weights
+
+    def update(self,iteration,probe='skirt_file_nuJnu_J.dat'):
+        '''
+        Measures the noise of the last skirt simulation (of 'iteration') and writes the distributions of the next one.
+        Call it after each skirt simulation (before its files are moved).
+        '''
+        wavelength, field = self.__readProbe(probe)
+        noise_probe = probe.replace('.dat','_noise.dat')
+        with np.errstate(divide='ignore',invalid='ignore'):
+            if os.path.isfile(noise_probe):
+                #Its first header line has a number (of seeds) that is not a wavelength, only the data is read
+                noise = np.loadtxt(noise_probe,comments='#',ndmin=2)[:,3:]/field
+            elif self.__previous is not None and self.__previous.shape == field.shape:
+                #Both fields have noise, so their difference has sqrt(2) times the noise of one
+                noise = np.abs(field-self.__previous)/field/np.sqrt(2.0)
+            else:
+                noise = None
+        #The change from iteration 0 to 1 is mostly gas emission appearing, not noise
+        self.__previous = field if iteration > 0 else None
+        if noise is None: return
+
+        if self.__density is None or self.__density.shape != field.shape:
+            self.__density = np.ones(field.shape) #Same as skirt logWavelength
+        weights = self.__weights(wavelength)
+        kernel = np.ones(self.__smoothing)/self.__smoothing
+        for position in range(0,len(field)):
+            relative = noise[position]
+            valid = np.isfinite(relative)
+            if not np.any(valid): continue #No field at this position
+            #Wavelengths without field get the highest noise
+            relative = np.where(valid,relative,np.max(relative[valid]))
+            relative = np.convolve(relative,kernel,mode='same')
+            density = self.__density[position]*relative**2*weights
+            if not np.sum(density) > 0.0: continue
+            density = density/np.mean(density)
+            #Half-way (in log) between the old and the new distribution, so it does not oscillate between iterations
+            density = np.sqrt(self.__density[position]*np.maximum(density,self.__floor))
+            self.__density[position] = density/np.mean(density)
+
+            #skirt wants the density per wavelength
+            filename = os.path.join(self.__folder,'Adaptive_'+str(position).zfill(3)+'_probability.stab')
+            writeProbabilityFile(filename,wavelength,self.__density[position]/wavelength)
+            self.__files[position] = filename
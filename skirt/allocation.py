@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+'Contribution' photon allocation between sources (AccuracyAndSpeed->PhotonProbability->per_source).
+Skirt launches from each source a share of the photon packets proportional to sourceWeight*luminosity
+(plus 'sourceBias', the fraction shared equally between all sources).
+Here sourceWeight is chosen so that share follows the contribution of each source to the field at the zone centres:
+    contribution_j = mean over zones p of J_j(p)/J(p)
+where J_j(p) = L_j*<1/d^2>, averaged over points sampled in the source (d is softened by the size of the source).
+So faint sources far from every zone get few packets, and sources dominating the field of some zone get many of them.
+The geometric part does not change between iterations, only luminosities do.
+'''
+
+import numpy as np
+
+class SourceAllocation(object):
+    def __init__(self,star_table,gas_table,min_size=0.01):
+        #Tables as in SkiParams: [kinds, (n,3) parameters], in the same units (pc)
+        self.__n_samples = 64 #Points per ring or shell
+        self.__min_size = min_size #Softening of points, so zones at the same place do not diverge
+        zones = self.__zoneCentres(gas_table)
+        self.__star_coupling = self.__coupling(star_table,zones)
+        self.__gas_coupling = self.__coupling(gas_table,zones)
+
+    def __zoneCentres(self,table):
+        #Rings are axisymmetric and shells spherical, so any point at their middle radius (and z = 0) is the same
+        kind, params = table
+        radius = np.where(kind == 'shell', (params[:,0]+params[:,1])/2.0, params[:,0])
+        return np.column_stack([radius,np.zeros(len(radius)),np.zeros(len(radius))])
+
+    def __coupling(self,table,zones):
+        #<1/d^2> from each source (rows) to each zone (columns)
+        kind, params = table
+        n = self.__n_samples
+        phi = 2.0*np.pi*np.arange(0,n)/n
+        #Unit sphere (Fibonacci lattice)
+        cos_theta = 1.0-(2.0*np.arange(0,n)+1.0)/n
+        sin_theta = np.sqrt(1.0-cos_theta**2)
+        golden = np.pi*(3.0-np.sqrt(5.0))*np.arange(0,n)
+        circle = np.column_stack([np.cos(phi),np.sin(phi),np.zeros(n)])
+        sphere = np.column_stack([sin_theta*np.cos(golden),sin_theta*np.sin(golden),cos_theta])
+
+        samples = np.zeros((len(kind),n,3))
+        size2 = np.zeros(len(kind))
+        ring = kind == 'ring'
+        shell = kind == 'shell'
+        point = kind == 'point'
+        samples[ring] = params[ring,0,np.newaxis,np.newaxis]*circle
+        size2[ring] = params[ring,1]**2+params[ring,2]**2
+        samples[shell] = ((params[shell,0]+params[shell,1])/2.0)[:,np.newaxis,np.newaxis]*sphere
+        size2[shell] = ((params[shell,1]-params[shell,0])/2.0)**2
+        samples[point] = params[point,np.newaxis,:]
+        size2 = np.maximum(size2,self.__min_size**2)
+
+        distance2 = np.sum((samples[:,np.newaxis,:,:]-zones[np.newaxis,:,np.newaxis,:])**2,axis=3)
+        return np.mean(1.0/(distance2+size2[:,np.newaxis,np.newaxis]),axis=2)
+
+    def weights(self,star_luminosity,gas_luminosity=None):
+        '''
+        sourceWeight of stars and gas zones (same order as their luminosities, erg/s in the source wavelength range).
+        Without gas luminosities (iteration0), only stars are used.
+        '''
+        if len(star_luminosity) != len(self.__star_coupling):
+            raise RuntimeError("Found "+str(len(star_luminosity))+" stellar seds for "+str(len(self.__star_coupling))+" stellar zones")
+        if gas_luminosity is not None and len(gas_luminosity) != len(self.__gas_coupling):
+            raise RuntimeError("Found "+str(len(gas_luminosity))+" gas seds for "+str(len(self.__gas_coupling))+" gas zones")
+        luminosity = np.asarray(star_luminosity,dtype=float)
+        coupling = self.__star_coupling
+        if gas_luminosity is not None:
+            luminosity = np.concatenate([luminosity,np.asarray(gas_luminosity,dtype=float)])
+            coupling = np.concatenate([coupling,self.__gas_coupling])
+        field = np.sum(luminosity[:,np.newaxis]*coupling,axis=0)
+        #contribution_j/L_j, so skirt (share ~ weight*L) follows the contribution
+        with np.errstate(divide='ignore',invalid='ignore'):
+            weights = np.mean(np.where(field > 0.0, coupling/field, 0.0),axis=1)
+        weights = weights/np.max(weights)
+        return weights[:len(star_luminosity)], weights[len(star_luminosity):]
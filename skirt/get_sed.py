@@ -6,7 +6,10 @@ Created on Fri Jul  2 17:17:45 2021
 @author: pablo
 """
 from glob import glob
+from itertools import islice
 from numpy import sort
+import numpy as np
+import os
 
 
 def get_from_folder(path,files=None):
@@ -20,62 +23,97 @@ def get_from_folder(path,files=None):
         paths = [path+'/'+files[i] for i in range(0,len(files))]
     return paths
 
+#Header lines of the files, with the (mtime, size) of the file when they were read
+_header_cache = {}
+_header_lines = 6 #Every value below is in the first lines of the files
+
+def read_header(path_i):
+    #Only the first lines are read, and only if the file changed since the last time
+    stat = os.stat(path_i)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    key = os.path.abspath(path_i)
+    cached = _header_cache.get(key)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    with open(path_i, 'r') as f:
+        lines = [line for line in islice(f, _header_lines)]
+    _header_cache[key] = (stamp, lines)
+    return lines
+
+#Same for the whole sed: (mtime, size) and (wavelength, specific luminosity) columns
+_sed_cache = {}
+
+def read_sed(path_i):
+    stat = os.stat(path_i)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    key = os.path.abspath(path_i)
+    cached = _sed_cache.get(key)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    data = np.loadtxt(path_i, comments='#', usecols=(0,1), ndmin=2)
+    data = data[np.argsort(data[:,0])]
+    _sed_cache[key] = (stamp, data)
+    return data
+
+class FolderIndex(object):
+    """
+    Files of a folder (same as get_from_folder) and their header lines.
+    The folder is listed once when the index is created, so create one per iteration.
+    """
+    def __init__(self, path, files=None):
+        self.paths = get_from_folder(path, files)
+        self.headers = [read_header(path_i) for path_i in self.paths]
+
+    def __field(self, line, position, units=None):
+        values = [header[line].split(' ')[position] for header in self.headers]
+        if units is not None:
+            values = [value+' '+units for value in values]
+        return values
+
+    def norm(self, units):
+        return self.__field(3, 2, units)
+
+    def norm_wavelength(self, units):
+        return self.__field(2, 3, units)
+
+    def optdepth_wavelength(self, units):
+        return self.__field(4, 3, units)
+
+    def optdepth_norm(self):
+        return [float(value) for value in self.__field(5, 2)]
+
+    #Mario: I add this function to allow mass normalization
+    def mass_norm(self, units):
+        return self.__field(4, 3, units)
+
+    def luminosity(self, wl_min, wl_max):
+        '''
+        Luminosity (erg/s) of each sed between wl_min and wl_max (nm), as skirt sees it:
+        the shape of the file (column 2 is nu*L_nu) scaled to the normalization in its header.
+        '''
+        norm_wavelength = [float(value) for value in self.__field(2, 3)]
+        norm_value = [float(value) for value in self.__field(3, 2)]
+        result = np.zeros(len(self.paths))
+        for ii in range(0, len(self.paths)):
+            data = read_sed(self.paths[ii])
+            inside = (data[:,0] >= wl_min) & (data[:,0] <= wl_max)
+            shape_at_norm = np.exp(np.interp(np.log(norm_wavelength[ii]), np.log(data[:,0]), np.log(np.maximum(data[:,1], 1e-300))))
+            #L = integral of L_lambda dlambda = integral of nu*L_nu dln(lambda)
+            result[ii] = norm_value[ii]*np.trapz(data[inside,1], np.log(data[inside,0]))/shape_at_norm
+        return result
+
 def get_norm(path, units, files=None):
-    paths = get_from_folder(path,files)
-    all_norms = []
-    for path_i in paths:
-        with open(path_i, 'r') as f:
-                all_lines = f.readlines()                                
-                normalization = all_lines[3].split(' ')[2]
-                normalization += ' '+units
-        f.close()
-        all_norms.append(normalization)
-    return all_norms
+    return FolderIndex(path, files).norm(units)
+
 def get_norm_wavelength(path, units, files=None):
-    paths = get_from_folder(path,files)
-    all_wave_norms = []
-    for path_i in paths:
-        with open(path_i, 'r') as f:
-                all_lines = f.readlines()                
-                norm_wavelength = all_lines[2].split(' ')[3]
-                norm_wavelength += ' '+units
-        f.close()
-        all_wave_norms.append(norm_wavelength)
-    return all_wave_norms
+    return FolderIndex(path, files).norm_wavelength(units)
 
 def get_optdepth_wavelength(path, units, files=None):
-    paths = get_from_folder(path,files)
-    all_wave_norms = []
-    for path_i in paths:
-        with open(path_i, 'r') as f:
-                all_lines = f.readlines()                
-                norm_wavelength = all_lines[4].split(' ')[3]
-                norm_wavelength += ' '+units
-        f.close()
-        all_wave_norms.append(norm_wavelength)
-    return all_wave_norms
+    return FolderIndex(path, files).optdepth_wavelength(units)
                 
 def get_optdepth_norm(path, files=None):
-    paths = get_from_folder(path,files)
-    all_norms = []
-    for path_i in paths:
-        with open(path_i, 'r') as f:
-                all_lines = f.readlines()                
-                norm = float(all_lines[5].split(' ')[2])
-        f.close()
-        all_norms.append(norm)
-    return all_norms                       
+    return FolderIndex(path, files).optdepth_norm()
                 
 #Mario: I add this function to allow mass normalization
 def get_mass_norm(path, units, files=None):
-    paths = get_from_folder(path,files)
-    all_mass_norms = []
-    for path_i in paths:
-        with open(path_i, 'r') as f:
-                all_lines = f.readlines()                
-                norm_wavelength = all_lines[4].split(' ')[3]
-                norm_wavelength += ' '+units
-        f.close()
-        all_mass_norms.append(norm_wavelength)
-    return all_mass_norms
-
+    return FolderIndex(path, files).mass_norm(units)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Skirt runs in 'ExtinctionOnly' mode, so photon packets of different wavelengths never interact.
+Therefore, a skirt simulation can be split into independent simulations that run at the same time sharing the threads:
+    - Wavelength bands ('SkirtBands'): each simulation covers a band. Their radiation fields (nuJnu probe) are
+      stitched back into the single file that cloudy.GenerateCloudyFiles() reads.
+    - Seed ensembles ('SkirtEnsemble'): several simulations with different seeds, sharing the photon packets.
+      Their radiation fields are averaged (weighted by photons), and the standard error of that mean
+      is written next to it (_noise.dat) as an estimate of the Monte Carlo noise.
+Both can be used at once (each band is run by every member of the ensemble).
+
+Bands are made of whole bins of the wavelength grid of the full simulation
+(LogWavelengthGrid of 'resolution' points between 'minWavelength' and 'maxWavelength'),
+so stitched files have the same wavelengths that one simulation would give.
+'''
+
+import re
+import numpy as np
+from skirt import pigs
+from utils.runner import StageRunner
+
+class SkirtJobs(object):
+    def __init__(self,options_dict,prefix='skirt_file'):
+        self.__prefix = prefix
+        self.__n_threads = options_dict['AccuracyAndSpeed']['n_threads']
+        self.__initBands(options_dict['Wavelength'],options_dict['AccuracyAndSpeed']['SkirtBands'])
+        self.__initMembers(options_dict['AccuracyAndSpeed']['SkirtEnsemble'])
+        self.__initJobs()
+        self.__runner = StageRunner(max_parallel=self.__n_parallel,timeout=options_dict['Technical']['skirt_timeout'])
+
+    def __initBands(self,wavelength_dict,bands_dict):
+        wl_min = wavelength_dict['minWavelength']
+        wl_max = wavelength_dict['maxWavelength']
+        n_wl   = wavelength_dict['resolution']
+        self.__split_bands = bands_dict['active']
+        if not self.__split_bands:
+            #The whole range in one band
+            self.bands = [{'index':0,'sourceRange':(wl_min,wl_max),'grid':(wl_min,wl_max,n_wl),'photonShare':1.0}]
+            return
+        grid = np.logspace(np.log10(wl_min),np.log10(wl_max),n_wl)
+        grid[0], grid[-1] = wl_min, wl_max #Exact, without rounding errors
+        #A grid point belongs to the band whose range contains it. The edge between bands is moved to the border between two bins
+        #(geometric mean of the points), so each bin is simulated in exactly one band
+        inner_edges = sorted(bands_dict['edges'])
+        first = [0]+[int(np.searchsorted(grid,edge)) for edge in inner_edges]
+        last  = first[1:]+[n_wl]
+        for ii in range(0,len(first)):
+            if last[ii]-first[ii] < 2:
+                raise RuntimeError("Skirt band "+str(ii)+" contains less than 2 wavelengths. Check 'edges' in 'SkirtBands'")
+
+        weights = bands_dict['photon_weights']
+        if weights is None:
+            #Same packets per wavelength bin, on average, as the full simulation
+            weights = [last[ii]-first[ii] for ii in range(0,len(first))]
+        if len(weights) != len(first):
+            raise RuntimeError("'photon_weights' must have one value per skirt band ("+str(len(first))+")")
+        weights = np.array(weights,dtype=float)/np.sum(weights)
+
+        self.bands = []
+        for ii in range(0,len(first)):
+            source_min = wl_min if ii == 0 else float(np.sqrt(grid[first[ii]-1]*grid[first[ii]]))
+            source_max = wl_max if ii == len(first)-1 else float(np.sqrt(grid[last[ii]-1]*grid[last[ii]]))
+            self.bands.append({
+                'index': ii,
+                'sourceRange': (source_min,source_max), #nm. Wavelengths emitted by the sources
+                'grid': (float(grid[first[ii]]),float(grid[last[ii]-1]),last[ii]-first[ii]), #Same points as the full grid
+                'photonShare': float(weights[ii]) #Of 'photon_packets'
+            })
+
+    def __initMembers(self,ensemble_dict):
+        #Seeds of the ensemble. Without ensemble, the usual seed ('0') is used
+        self.__n_members = ensemble_dict['members'] if ensemble_dict['active'] else 1
+        if self.__n_members < 1:
+            raise RuntimeError("'members' of 'SkirtEnsemble' must be 1 or more")
+        self.seeds = [str(ii) for ii in range(0,self.__n_members)]
+
+    def __initJobs(self):
+        #One skirt simulation per band and seed. Photons of each band are shared by its members
+        self.jobs = []
+        for band in self.bands:
+            band['jobs'] = []
+            for seed in self.seeds:
+                name = []
+                if self.__split_bands: name.append('band'+str(band['index']))
+                if self.__n_members > 1: name.append('seed'+seed)
+                job = dict(band)
+                job.update({'name':'_'.join(name),'seed':seed,'photonShare':band['photonShare']/self.__n_members})
+                band['jobs'].append(job)
+                self.jobs.append(job)
+
+        #Threads are shared between the jobs running at once
+        self.__n_parallel = min(len(self.jobs),self.__n_threads)
+        threads = [self.__n_threads//self.__n_parallel]*self.__n_parallel
+        for ii in range(0,self.__n_threads%self.__n_parallel):
+            threads[ii] += 1
+        for ii in range(0,len(self.jobs)):
+            self.jobs[ii]['threads'] = threads[ii%self.__n_parallel]
+
+    def __file(self,name):
+        return self.__prefix+'_'+name if name else self.__prefix
+
+    def makeSkiFiles(self,skirt_params,iteration0=False):
+        for job in self.jobs:
+            skirt_params.prepareSkiFile(iteration0,job)
+            pigs.SkirtFile(skirt_params, output_path=self.__file(job['name']))
+
+    def run(self):
+        #All jobs at once (at most one per thread). Each one writes its output in tmp_NAME.txt
+        jobs = [self.__runner.launch(["skirt","-t",str(job['threads']),self.__file(job['name'])+".ski"], stdout="tmp_"+job['name']+".txt")
+                for job in self.jobs]
+        results = self.__runner.run_all(jobs)
+        for job,result in zip(self.jobs,results):
+            if not result.ok:
+                raise RuntimeError("Skirt failed in "+job['name']+" (exit status "+str(result.returncode)+", "+str(result.elapsed)
+                                   +" s). Check tmp_"+job['name']+".txt for more details.")
+            print("Skirt "+job['name']+": "+str(job['grid'][0])+"-"+str(job['grid'][1])+" nm, seed "+job['seed']+", "
+                  +str(job['threads'])+" threads, "+str(result.elapsed)+" s")
+
+    def combine(self,probe='nuJnu_J.dat'):
+        #Writes prefix_probe as if skirt had run once (and prefix_probe_noise.dat with ensembles)
+        noise_probe = probe.replace('.dat','_noise.dat')
+        for band in self.bands:
+            if self.__n_members > 1:
+                band_name = 'band'+str(band['index']) if self.__split_bands else ''
+                self.__merge(band['jobs'],self.__file(band_name)+'_'+probe,self.__file(band_name)+'_'+noise_probe,probe)
+        if self.__split_bands:
+            self.__stitch(probe)
+            if self.__n_members > 1: self.__stitch(noise_probe)
+
+    def __merge(self,jobs,output,noise_output,probe):
+        '''
+        Photon-weighted mean of the probe of several members, and its standard error (in noise_output).
+        Positions (first 3 columns) must be the same in all of them.
+        '''
+        header = None
+        positions = None
+        values = []
+        for job in jobs:
+            job_header = []
+            job_rows = []
+            with open(self.__file(job['name'])+'_'+probe,'r') as file:
+                for line in file:
+                    if line.startswith('#'):
+                        job_header.append(line)
+                    elif line.strip():
+                        job_rows.append(line.split())
+            if header is None:
+                header = job_header
+                positions = [row[:3] for row in job_rows]
+            elif [row[:3] for row in job_rows] != positions:
+                raise RuntimeError("Positions of skirt "+job['name']+" do not match those of "+jobs[0]['name'])
+            values.append(np.array([row[3:] for row in job_rows],dtype=float).reshape(len(job_rows),-1))
+        values = np.array(values)
+        weights = np.array([job['photonShare'] for job in jobs])
+        mean = np.tensordot(weights,values,axes=1)/np.sum(weights)
+        #Each member is a sample of the field, the mean is known with this error
+        error = np.std(values,axis=0,ddof=1)/np.sqrt(len(jobs))
+
+        def write(filename,data,first_line=''):
+            rows = [' '.join(position)+' '+' '.join(['%r'%value for value in row])+'\n' for position,row in zip(positions,data.tolist())]
+            with open(filename,'w') as file:
+                file.write(first_line+''.join(header)+''.join(rows))
+        write(output,mean)
+        write(noise_output,error,"# Standard error of the mean of "+str(len(jobs))+" skirt simulations with different seeds\n")
+
+        with np.errstate(divide='ignore',invalid='ignore'):
+            relative = np.where(mean > 0.0, error/mean, np.nan)
+        per_position = [np.nanmedian(row) for row in relative if np.any(np.isfinite(row))] #Positions without field are skipped
+        if per_position:
+            print("Skirt ensemble ("+str(len(jobs))+" seeds): median relative error "+str(np.nanmedian(relative))
+                  +", worst position "+str(max(per_position))+" ("+output+")")
+
+    def __stitch(self,probe):
+        '''
+        Writes prefix_probe with the columns of every band (prefix_bandN_probe), in wavelength order.
+        Positions (first 3 columns) must be the same in all of them. Values are copied as text, without conversions.
+        '''
+        column = re.compile(r'column (\d+):')
+        header = []
+        rows = None
+        n_columns = 3
+        for band in self.bands:
+            band_header = []
+            band_rows = []
+            with open(self.__file('band'+str(band['index']))+'_'+probe,'r') as file:
+                for line in file:
+                    if line.startswith('#'):
+                        band_header.append(line)
+                    elif line.strip():
+                        band_rows.append(line.split())
+            #Header: everything from the first band, except the columns of the fields, which are renumbered
+            for line in band_header:
+                found = column.search(line)
+                if found is None or int(found.group(1)) <= 3:
+                    if band['index'] == 0: header.append(line)
+                    continue
+                n_columns += 1
+                header.append(line[:found.start()]+'column '+str(n_columns)+':'+line[found.end():])
+            if rows is None:
+                rows = band_rows
+                continue
+            if len(band_rows) != len(rows) or any([new[:3] != row[:3] for new,row in zip(band_rows,rows)]):
+                raise RuntimeError("Positions of skirt band "+str(band['index'])+" do not match those of band 0")
+            for row,new in zip(rows,band_rows):
+                row.extend(new[3:])
+
+        with open(self.__prefix+'_'+probe,'w') as file:
+            file.write(''.join(header)+''.join([' '.join(row)+'\n' for row in rows]))
@@ -10,6 +10,8 @@ import importlib
 from glob import glob
 from numpy import sort
 from os import path, getcwd
+from io import StringIO
+import re
 
 class SkirtFile(object):
     """
@@ -30,8 +32,18 @@ class SkirtFile(object):
             output = output_path+'.ski'
         else:
             output = path.join(getcwd(), 'skirt_config_file.ski')
-            
-        self.skifile = open(output, 'w+')
+        
+        #The structure is only written the first time, then the template is filled with the new values
+        if params.skiTemplate is None:
+            params.storeSkiTemplate(SkiTemplate(self.make_structure()))
+        
+        with open(output, 'w+') as skifile:
+            skifile.write(params.skiTemplate.fill(params.skiValues))
+
+        print('File saved at ', output)
+
+    def make_structure(self):
+        self.skifile = StringIO()
             
         self.skifile.write(
             '<?xml version="1.0" encoding="UTF-8"?>\n<!-- A SKIRT parameter file created by PIGS! -->\n'
@@ -46,8 +58,7 @@ class SkirtFile(object):
         self.skifile.write(             
         '    </MonteCarloSimulation>\n</skirt-simulation-hierarchy>'
                             )
-
-        print('File saved at ', output)
+        return self.skifile.getvalue()
     # def read_config(self):
     #     cfg = importlib.import_module(self.config_file)        
     #     return cfg
@@ -148,6 +159,27 @@ class SkirtFile(object):
         return lines
            
         
+class SkiTemplate(object):
+    """
+    Text of a .ski file in which the values that change between iterations
+    are written as '@@name@@'. The text is split once around them,
+    so filling it is a single join.
+    """
+    placeholder = re.compile(r'@@(\w+)@@')
+
+    def __init__(self, text):
+        #Even positions are fixed text, odd positions are names
+        self.pieces = self.placeholder.split(text)
+        self.names = set(self.pieces[1::2])
+
+    def fill(self, values):
+        missing = self.names.difference(values)
+        if missing:
+            raise RuntimeError("Values missing in the .ski template: "+", ".join(sorted(missing)))
+        pieces = list(self.pieces)
+        pieces[1::2] = [values[name] for name in pieces[1::2]]
+        return ''.join(pieces)
+
 # ...
 
 if __name__ == '__main__':
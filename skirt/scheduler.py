@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Chooses the photon packets of each skirt simulation from the convergence quantities (utils/convergence.py).
+
+Monte Carlo noise of a quantity x scales as sigma^2 = c/N (N photon packets), and it is estimated from the
+second differences of x between iterations: without physical changes, x_i - 2x_(i-1) + x_(i-2) has
+variance c*(1/N_i + 4/N_(i-1) + 1/N_(i-2)). Physical changes (the field is still far from the solution)
+are seen in the first difference x_i - x_(i-1), when it is bigger than the noise expected from c.
+
+The run starts with 'initial_packets'. Packets are only increased when, for some key and zone that has not converged yet,
+the change between iterations is explained by noise, and that noise is above 'noise_to_tolerance' times its tolerance.
+Decisions and skirt times are written in 'photon_schedule.log'.
+'''
+
+import warnings
+import numpy as np
+
+class PhotonScheduler(object):
+    def __init__(self,options_dict,logfile='photon_schedule.log'):
+        scheduler_dict = options_dict['AccuracyAndSpeed']['PhotonScheduler']
+        self.__packets = float(scheduler_dict['initial_packets'])
+        self.__max_packets = float(scheduler_dict['max_packets'])
+        self.__max_increase = scheduler_dict['max_increase']
+        self.__noise_to_tolerance = scheduler_dict['noise_to_tolerance']
+        self.__window = 4 #Number of second differences (the last ones) used to estimate the noise
+        self.__history = dict() #Packets used in the skirt simulation of each iteration
+        self.__decision = 'initial'
+        self.__noise = np.nan
+        self.__logfile = logfile
+        with open(self.__logfile,'w') as file:
+            file.write("# Column 1: iteration \n")
+            file.write("# Column 2: photon packets \n")
+            file.write("# Column 3: skirt time (s) \n")
+            file.write("# Column 4: worst relative noise / tolerance (of not converged keys and zones whose change is dominated by noise) \n")
+            file.write("# Column 5: decision \n")
+
+    def packets(self):
+        return self.__packets
+
+    def update(self,program):
+        '''
+        Photon packets of the next skirt simulation, from the data stored in 'program' (ConvergenceObject).
+        Call it after program.stop().
+        '''
+        values, tolerances, converged = program.history()
+        #Iteration 0 has no gas, so it is not comparable with the rest
+        values = values[:,1:,:]
+        packets = np.array([self.__history.get(ii,np.nan) for ii in range(1,len(values[0])+1)])
+        self.__noise = np.nan
+        if len(packets) < 3:
+            self.__decision = 'keep (few iterations)'
+            return self.__packets
+
+        with np.errstate(divide='ignore',invalid='ignore'), warnings.catch_warnings():
+            warnings.simplefilter('ignore',RuntimeWarning) #Keys and zones without data (NaN) are skipped
+            #Noise constant c (sigma^2 = c/N) from the last second differences
+            c = []
+            for ii in range(max(2,len(packets)-self.__window),len(packets)):
+                second = values[:,ii,:]-2.0*values[:,ii-1,:]+values[:,ii-2,:]
+                c.append(second**2/(1.0/packets[ii]+4.0/packets[ii-1]+1.0/packets[ii-2]))
+            c = np.nanmean(np.array(c),axis=0)
+
+            last = np.abs(values[:,-1,:])
+            change = np.abs(values[:,-1,:]-values[:,-2,:])
+            expected_change = np.sqrt(c*(1.0/packets[-1]+1.0/packets[-2]))
+            noise = np.sqrt(c/self.__packets)/last/(self.__noise_to_tolerance*tolerances[:,np.newaxis]) #1 is the target noise
+            noisy = (change <= 2.0*expected_change) & ~converged & np.isfinite(noise)
+        if not np.any(noisy):
+            self.__decision = 'keep (physics dominates or converged)'
+            return self.__packets
+
+        self.__noise = float(np.max(noise[noisy]))
+        if self.__noise <= 1.0:
+            self.__decision = 'keep (noise below target)'
+            return self.__packets
+        new_packets = min(self.__packets*min(self.__noise**2,self.__max_increase),self.__max_packets)
+        if new_packets <= self.__packets:
+            self.__decision = 'keep (max_packets reached)'
+            return self.__packets
+        self.__decision = 'increase (noise dominates)'
+        self.__packets = float(np.round(new_packets))
+        return self.__packets
+
+    def log(self,iteration,skirt_time):
+        #Call it after the skirt simulation of each iteration (its results are the data of that iteration in ConvergenceObject)
+        self.__history[iteration] = self.__packets
+        with open(self.__logfile,'a') as file:
+            file.write(str(iteration)+" "+str(self.__packets)+" "+str(skirt_time)+" "+str(self.__noise)+" "+self.__decision+" \n")
+        print("Photon packets: "+str(self.__packets)+" ("+self.__decision+"), skirt took "+str(skirt_time)+" s")
@@ -8,10 +8,14 @@ Created on Wed Aug 25 11:12:18 2021
 
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-from skirt.get_sed import get_from_folder, get_norm, get_norm_wavelength, get_optdepth_norm, get_optdepth_wavelength, get_mass_norm
+from skirt.get_sed import FolderIndex
+from skirt.adaptive import AdaptiveDistribution
+from skirt.allocation import SourceAllocation
+from skirt.spatial_grid import GeometryGrid
 from flatten_dict import flatten, unflatten
 from utils.unkeep import relist,createProbabilityFile
 import numpy as np
+from heapq import merge
 
 def iterate_over_dict(dictionary):
     for key, value in dictionary.items():
@@ -36,6 +40,30 @@ def translate_dictionary(my_dict,ii):
         dict_type = list(new_dict.keys())[0]
         return [new_dict[dict_type],dict_type]
 
+
+class IntervalIndex(object):
+    '''
+    Closed intervals [lower, upper] (e.g.: radial extent of the gas zones) indexed to find which of them contain a position.
+    Edges are sorted, so positions are placed with a binary search, and each slot (an edge or the space between two edges)
+    keeps the labels of the intervals covering it, in ascending order.
+    '''
+    def __init__(self,lower,upper,labels):
+        self.edges = np.unique(np.concatenate([lower,upper]))
+        #Slot 2k+1 is edges[k], slot 2k is the space between edges[k-1] and edges[k]
+        self.contents = [[] for s in range(0,2*len(self.edges)+1)]
+        first = 2*np.searchsorted(self.edges,lower)+1
+        last  = 2*np.searchsorted(self.edges,upper)+1
+        for ii in np.argsort(labels,kind='stable'):
+            for slot in range(first[ii],last[ii]+1):
+                self.contents[slot].append(int(labels[ii]))
+
+    def slots(self,x):
+        x = np.asarray(x,dtype=float)
+        if len(self.edges) == 0: return np.zeros(x.shape,dtype=int)
+        k = np.searchsorted(self.edges,x)
+        on_edge = self.edges[np.minimum(k,len(self.edges)-1)] == x
+        return 2*k+on_edge
+
               
 # =============================================================================
 # PARAMETER FILE FOR MAKING SKIRT .SKI FILES
@@ -46,13 +74,19 @@ class SkiParams(object):
         self.__initWavelengths(options_dict['Wavelength'])
         self.__initFolders(options_dict['FileParameters']['stars']['folder'])
         self.__initPhotons(options_dict['AccuracyAndSpeed']['photon_packets'],options_dict['AccuracyAndSpeed']['PhotonProbability'])
+        self._adaptive = AdaptiveDistribution(options_dict) if self._perRegionProbability == 'Adaptive' else None
         self.__initDetails()
         
         self.__parseData(options_dict['FileParameters']['ISM'],'Gas')
         self.__parseData(options_dict['FileParameters']['stars']['file'],'Star')
         
+        self.__initTemplates()
+        self.__initGeometryTables()
+        self._allocation = SourceAllocation(self._star_table,self._gas_table,self._skirt_ringRadius_correction) if self._perSourceAllocation == 'Contribution' else None
+        
         self.__deduceLimits()
         self.__deduceLinks()
+        self.__initGrid(options_dict['AccuracyAndSpeed']['SpatialGrid'])
         self.__checkSkirtIssues()
         self.__Positions = options_dict['FileParameters']['positions']
     
@@ -98,6 +132,8 @@ class SkiParams(object):
         self._photonPackets = n_photons
         self._perRegionProbability = probability_dic['per_region']
         self._distributionBias = probability_dic['wavelengthBias']
+        self._perSourceAllocation = probability_dic['per_source']
+        self._sourceBias = probability_dic['sourceBias']
         self._customProbabilityFile = probability_dic['customDistributionFile']
         #Details
         self._probability_folder = 'input_data/probability_distributions'
@@ -116,128 +152,104 @@ class SkiParams(object):
         self._nullMaterialFile = 'input_data/params/NullMaterial.stab' #Skirt will use this file as 'material' in the iteration0 (should be a material without absorption and scattering)
         self._nullMass = 1.0e-10 #Msun. Normalization of 'NullMaterial'. The ideal value is 0.0, but I selected a small number because skirt will not run instead
     
+    def __initTemplates(self):
+        #Compiled .ski templates (pigs.SkiTemplate), one for iteration0 and other for the rest (per wavelength band, if any)
+        self._skiTemplates = dict()
+        self._templateKey = (False, None, ())
+        self.skiTemplate = None
+        self.skiValues = dict()
+
+    def __initGeometryTables(self):
+        #Same geometries as arrays: kinds and (up to 3) parameters per zone, NaN if the geometry has less
+        def table(geometries,kinds):
+            kind = np.array([str(geometry[0]).strip() for geometry in geometries],dtype=object)
+            params = np.full((len(geometries),3),np.nan)
+            for ii in range(0,len(geometries)):
+                if kind[ii] not in kinds:
+                    raise RuntimeError("Geometry not implemented!")
+                values = geometries[ii][1:4]
+                params[ii,:len(values)] = values
+            return [kind,params]
+        self._gas_table  = table(self._gas_geometry,['shell','ring'])
+        self._star_table = table(self._star_geometry,['shell','ring','point'])
+
     def __deduceLimits(self):
         #limits are decided with gas zones.
         #We first need to find the greater radius
-        R_max = 0.0
-        z_max = 0.0
-        
-        for ii in range(0,self._gas_zones):
-            Rcan = None
-            if self._gas_geometry[ii][0] == 'shell':
-                Rcan = self._gas_geometry[ii][2] #Rout
-                zcan = Rcan #Spherical symmetry!
-            elif self._gas_geometry[ii][0] == 'ring':
-                Rcan = self._gas_geometry[ii][1] + self._gas_geometry[ii][2] #R+w
-                zcan = self._gas_geometry[ii][3]*self._z_ring_limit #h*self._z_ring_limit
-            else:
-                raise RuntimeError("Geometry not implemented!")
-            
-            if Rcan > R_max:
-                R_max = Rcan
-            if zcan > z_max:
-                z_max = zcan
-        
-        for ii in range(0,self._star_zones):
-            Rcan = None
-            if self._star_geometry[ii][0] == 'shell':
-                Rcan = self._star_geometry[ii][2] #Rout
-                zcan = Rcan #Spherical symmetry!
-            elif self._star_geometry[ii][0] == 'ring':
-                Rcan = self._star_geometry[ii][1] + self._gas_geometry[ii][2] #R+w
-                zcan = self._star_geometry[ii][3]*self._z_ring_limit #h*self._z_ring_limit
-            elif self._star_geometry[ii][0] == 'point':
-                x = self._star_geometry[ii][1]
-                y = self._star_geometry[ii][2]
-                z = self._star_geometry[ii][3]
+        gas_kind, gas = self._gas_table
+        shell = gas_kind == 'shell'
+        gas_R = np.where(shell, gas[:,1], gas[:,0]+gas[:,1]) #Rout or R+w
+        gas_z = np.where(shell, gas[:,1], gas[:,2]*self._z_ring_limit) #Spherical symmetry! or h*self._z_ring_limit
 
-                if any((x,y,z)) != 0.0:
-                    raise RuntimeError("Sorry, I have not implemented points outside the origin =( ")
-                    #It would require a change in the coordinate system used (Cylindrical coordinates are no longer valid)
-                    #And to allow that is now low priority
+        star_kind, star = self._star_table
+        shell = star_kind == 'shell'
+        point = star_kind == 'point'
+        if np.any(point & np.any(star != 0.0,axis=1)):
+            raise RuntimeError("Sorry, I have not implemented points outside the origin =( ")
+            #It would require a change in the coordinate system used (Cylindrical coordinates are no longer valid)
+            #And to allow that is now low priority
+        #Stellar rings use their own width (R+w). Versions before the geometry tables used the width of the gas zone
+        #with the same index, so maxRadius of the grid changes when both widths differ and that star ring is the outermost region
+        star_R = np.select([shell,point], [star[:,1],0.0], star[:,0]+star[:,1])
+        star_z = np.select([shell,point], [star[:,1],0.0], star[:,2]*self._z_ring_limit)
 
-                Rcan = np.sqrt(x*x+y*y+z*z)
-                zcan = z
-        
-            if Rcan > R_max:
-                R_max = Rcan
-            if zcan > z_max:
-                z_max = zcan
+        R_max = float(max(np.max(gas_R,initial=0.0),np.max(star_R,initial=0.0)))
+        z_max = float(max(np.max(gas_z,initial=0.0),np.max(star_z,initial=0.0)))
         
         self._border_r = str(R_max)+self._geometryUnits
         self._border_z = str(z_max)+self._geometryUnits
+        self._limits = (R_max, z_max)
 
     def __deduceLinks(self):
         #This function checks if stellar zones are related with gas zones.
-        for ii in range(0,self._star_zones): #Per stellar zone
-            if self._star_geometry[ii][0] == 'point':
-                x = self._star_geometry[ii][1]
-                y = self._star_geometry[ii][2]
-                z = self._star_geometry[ii][3]
-                #Check if it is inside a gas zone
-                found_link = False
-                for jj in range(0,self._gas_zones): #Per gas zone
-                    #Compute parameters
-                    r, Rmin, Rmax = None, None, None
-                    if self._gas_geometry[jj][0] == 'shell':
-                        r    = np.sqrt(x*x+y*y+z*z)
-                        Rmin = self._gas_geometry[jj][1]
-                        Rmax = self._gas_geometry[jj][2]
-                    elif self._gas_geometry[jj][0] == 'ring':
-                        r    = np.sqrt(x*x+y*y)
-                        Rmin = self._gas_geometry[jj][1]-self._gas_geometry[jj][2]
-                        Rmax = self._gas_geometry[jj][1]+self._gas_geometry[jj][2]
-                        h    = self._gas_geometry[jj][3]
-                        #false if point is above ring. Skip final if
-                        if abs(z) > h : continue
-                    else: raise RuntimeError("Geometry not implemented")
-                    #Check if related
-                    if r <= Rmax and r >= Rmin:
-                        self._stars_gas_link.append(jj)
-                        found_link = True
-                        break
-            elif self._star_geometry[ii][0] == 'shell':
-                for jj in range(0,self._gas_zones):
-                    Rmin, Rmax, W = None, None, None
-                    r = (self._star_geometry[ii][1] + self._star_geometry[ii][2]) / 2.0
-                    w = (self._star_geometry[ii][2] - self._star_geometry[ii][1])
-                    if self._gas_geometry[jj][0] == 'shell':
-                        Rmin = self._gas_geometry[jj][1]
-                        Rmax = self._gas_geometry[jj][2]
-                        W    = self._gas_geometry[jj][2] - self._gas_geometry[jj][1]
-                    elif self._gas_geometry[jj][0] == 'ring':
-                        continue #A ring is a very small region compared with a shell! There is no point!
-                    else: raise RuntimeError("Geometry not implemented")
-                    #Check if related
-                    if r <= Rmax and r >= Rmin and w <= W:
-                        self._stars_gas_link.append(jj)
-                        found_link = True
-                        break
-            elif self._star_geometry[ii][0] == 'ring':
-                Rmin, Rmax, W = None, None, None
-                r = self._star_geometry[ii][1]
-                w = self._star_geometry[ii][2]
-                h = self._star_geometry[ii][3]
-                for jj in range(0,self._gas_zones):
-                    if self._gas_geometry[jj][0] == 'shell':
-                        Rmin = self._gas_geometry[jj][1]
-                        Rmax = self._gas_geometry[jj][2]
-                        W = self._gas_geometry[jj][2] - self._gas_geometry[jj][1]
-                    elif self._gas_geometry[jj][0] == 'ring':
-                        W = self._gas_geometry[jj][2]
-                        Rmin = self._gas_geometry[jj][1]-W
-                        Rmax = self._gas_geometry[jj][1]+W
-                    #Check if related
-                    if r <= Rmax and r >= Rmin and w <= W:
-                        self._stars_gas_link.append(jj)
-                        found_link = True
-                        break
-            if not found_link:
-                self._stars_gas_link.append(None)
+        #Each stellar zone is linked with the first gas zone (in file order) that contains it:
+        #   - points: inside a shell, or inside a ring (cylindrical radius and |z| <= h)
+        #   - shells: their middle radius is inside a shell at least as wide (rings are very small regions compared with a shell! There is no point!)
+        #   - rings: their radius is inside a shell or ring at least as wide
+        #Gas shells and rings are indexed by radius, so each stellar zone only checks the gas zones at its radius.
+        gas_kind, gas = self._gas_table
+        shells = np.where(gas_kind == 'shell')[0]
+        rings  = np.where(gas_kind == 'ring')[0]
+        shell_index = IntervalIndex(gas[shells,0], gas[shells,1], shells)
+        ring_index  = IntervalIndex(gas[rings,0]-gas[rings,1], gas[rings,0]+gas[rings,1], rings)
+        gas_width  = np.where(gas_kind == 'shell', gas[:,1]-gas[:,0], gas[:,1])
+        gas_height = np.where(gas_kind == 'shell', np.inf, gas[:,2])
+
+        star_kind, star = self._star_table
+        point = star_kind == 'point'
+        shell = star_kind == 'shell'
+        ring  = star_kind == 'ring'
+        #Radius to look for in gas shells and in gas rings (NaN is never found)
+        r_shells = np.select([point,shell,ring], [np.sqrt(star[:,0]**2+star[:,1]**2+star[:,2]**2), (star[:,0]+star[:,1])/2.0, star[:,0]], np.nan)
+        r_rings  = np.select([point,ring], [np.sqrt(star[:,0]**2+star[:,1]**2), star[:,0]], np.nan)
+        #Conditions: width <= gas width and height <= gas height
+        width  = np.select([shell,ring], [star[:,1]-star[:,0], star[:,1]], -np.inf)
+        height = np.where(point, np.abs(star[:,2]), -np.inf)
+
+        shell_slots = shell_index.slots(r_shells)
+        ring_slots  = ring_index.slots(r_rings)
+        self._stars_gas_link = []
+        for ii in range(0,self._star_zones):
+            link = None #Each star starts without link. Before, a link found for the previous star could be kept by shells and rings
+            for jj in merge(shell_index.contents[shell_slots[ii]], ring_index.contents[ring_slots[ii]]):
+                if width[ii] <= gas_width[jj] and height[ii] <= gas_height[jj]:
+                    link = jj
+                    break
+            self._stars_gas_link.append(link)
 
             #And that's it
 
 
+    def __initGrid(self,grid_dict):
+        #'Linear': _resolution_r x _resolution_z cylinder. 'Geometry': mesh built from the gas zones (see skirt/spatial_grid.py)
+        self._gridType = grid_dict['type']
+        if self._gridType == 'Linear':
+            self._grid = None
+        elif self._gridType == 'Geometry':
+            self._grid = GeometryGrid(grid_dict,self._gas_table,*self._limits)
+        else:
+            raise RuntimeError("Spatial grid '"+str(self._gridType)+"' not recognized. Available options: 'Linear', 'Geometry'")
+
     def __checkSkirtIssues(self):
         #(1) If ring geometry is set and some of 'ringRadius' is 0.0
         #   Skirt crashes due they do not accept rings with R=0
@@ -291,14 +303,104 @@ class SkiParams(object):
     ### CREATE DICTIONARIES FOR SKIRT
     #Original code made by Pablo Corcho-Caballero
     
-    def prepareSkiFile(self,iteration0=False):    
+    def prepareSkiFile(self,iteration0=False,band=None):    
             
             #Mario: For legibility, I split this method in subrutines
+            #Only a few values change between iterations (gas seds and normalizations, masses and probability files)
+            #They are computed every time, and the rest of the file is compiled once in a template (see pigs.SkiTemplate)
+            #'band' restricts the simulation to a wavelength band and/or changes its seed (see skirt/parallel.py). None is the usual simulation
+            self.__setBand(band)
+            self.skiValues = self.__dynamicValues(iteration0)
+            #Regions with a probability file have other structure than those with logWavelength
+            probability_files = tuple(sorted([name for name in self.skiValues if '_probability_' in name]))
+            self._templateKey = (iteration0, None if band is None else band['name'], probability_files)
+            self.skiTemplate = self._skiTemplates.get(self._templateKey)
+            if self.skiTemplate is not None: return
+
             self.__createBasics()
             self.__createSources(iteration0)
             self.__createMedia(iteration0)
             self.__createInstruments()
             self.__createProbes()
+
+    def setPhotonPackets(self,n_photons):
+        #Photon packets of the next simulations (shared between them if skirt runs split, see skirt/parallel.py)
+        self._photonPackets = n_photons
+
+    def measureNoise(self,iteration,probe='skirt_file_nuJnu_J.dat'):
+        #Only in 'Adaptive' mode. Call it after each skirt simulation, its noise shapes the probability files of the next one
+        if self._adaptive is not None:
+            self._adaptive.update(iteration,probe)
+
+    def storeSkiTemplate(self,template):
+        #Called by pigs.SkirtFile once the template of this kind of iteration is compiled
+        self._skiTemplates[self._templateKey] = template
+        self.skiTemplate = template
+
+    def __setBand(self,band):
+        #Wavelengths where sources emit, wavelength grid of media, instruments and probes, photon packets and seed
+        if band is None:
+            self._source_min, self._source_max = self._wavelength_min, self._wavelength_max
+            self._grid_min, self._grid_max, self._grid_res = self._wavelength_min, self._wavelength_max, self._wavelength_res
+            self._packets = self._photonPackets
+            self._seed = self._montecarloSeed
+        else:
+            self._source_min, self._source_max = band['sourceRange']
+            self._grid_min, self._grid_max, self._grid_res = band['grid']
+            self._packets = float(np.round(band['photonShare']*self._photonPackets))
+            self._seed = band['seed']
+
+    def __placeholder(self,name):
+        #Dictionaries contain '@@name@@' instead of the value, which is in self.skiValues
+        if name not in self.skiValues:
+            raise RuntimeError("Value '"+name+"' of the .ski file has not been computed")
+        return '@@'+name+'@@'
+
+    def __dynamicValues(self,iteration0):
+        #Values of the .ski file that may change between iterations
+        #Each folder is listed (and its headers read) once per iteration
+        self._star_index = FolderIndex(self._star_sources_folder, self._star_files)
+        self._gas_sources_index = FolderIndex(self._gas_sources_folder)
+        self._gas_opacity_index = FolderIndex(self._gas_opacity_folder)
+        values = dict()
+        values['packets'] = str(self._packets)
+        for ii in range(0,self._star_zones):
+            filename = self.__probabilityFile(ii,iteration0=iteration0)
+            if filename is not None: values['star_probability_'+str(ii)] = str(filename)
+
+        if iteration0 == False:
+            all_gas_files       = self._gas_sources_index.paths
+            gas_norm_wavelength = self._gas_sources_index.norm_wavelength('nm')
+            gas_norm_value      = self._gas_sources_index.norm('erg/s')
+            for ii in range(0,self._gas_zones):
+                values['gas_sed_'+str(ii)]        = str(all_gas_files[ii])
+                values['gas_wavelength_'+str(ii)] = str(gas_norm_wavelength[ii])
+                values['gas_luminosity_'+str(ii)] = str(gas_norm_value[ii])
+                filename = self.__probabilityFile(ii,are_stars=False,iteration0=iteration0)
+                if filename is not None: values['gas_probability_'+str(ii)] = str(filename)
+
+        if iteration0:
+            Media_files = [self._nullMaterialFile for i in range(0,self._gas_zones)]
+            Media_norm  = self._nullMass * np.ones(self._gas_zones)
+        else:
+            Media_files = self._gas_opacity_index.paths
+            Media_norm  = self._gas_opacity_index.mass_norm('Msun') #It will check the third line of 'MeanFileDustMix', check if units are correct in your file
+        for ii in range(0,self._gas_zones):
+            values['medium_file_'+str(ii)] = str(Media_files[ii])
+            values['medium_mass_'+str(ii)] = str(Media_norm[ii])
+
+        if self._allocation is not None:
+            #Luminosities in the wavelengths emitted in this simulation
+            #Folders may have more files than zones (e.g.: leftovers of a bigger model). Zone ii is file ii, as above
+            star_luminosity = self._star_index.luminosity(self._source_min,self._source_max)[:self._star_zones]
+            gas_luminosity = None if iteration0 else self._gas_sources_index.luminosity(self._source_min,self._source_max)[:self._gas_zones]
+            star_weights, gas_weights = self._allocation.weights(star_luminosity,gas_luminosity)
+            for ii in range(0,len(star_weights)):
+                values['star_weight_'+str(ii)] = str(star_weights[ii])
+            for ii in range(0,len(gas_weights)):
+                values['gas_weight_'+str(ii)] = str(gas_weights[ii])
+
+        return values
         
     def __createBasics(self):
         # =============================================================================
@@ -310,10 +412,10 @@ class SkiParams(object):
                         'simulationMode':"ExtinctionOnly",
                         'iterateMediumState':'false',
                         'iterateSecondaryEmission':'false',
-                        'numPackets':self._photonPackets,
+                        'numPackets':self.__placeholder('packets'),
                         'random':{
                             'type':'Random',
-                            'Random':{'seed':self._montecarloSeed}
+                            'Random':{'seed':self._seed}
                                     },
                         'units':{
                             'type':'Units',
@@ -331,72 +433,75 @@ class SkiParams(object):
         #Return
         self.Basics = Basics
 
-    def __wavelengthBiasDistribution_options(self,zone,are_stars=True,iteration0=False):
+    def __sourceWeight(self,zone,are_stars=True):
+        #Same weight for every source (skirt default) unless 'per_source' is 'Contribution' (see skirt/allocation.py)
+        if self._allocation is None:
+            return "1"
+        return self.__placeholder(('star' if are_stars else 'gas')+'_weight_'+str(zone))
+
+    def __wavelengthBiasDistribution_options(self,zone,are_stars=True):
         result_dic = {
             'type' : 'WavelengthDistribution',
         }
 
-        #Two possible options to write
-        def writeSkirtDefault():
-            subresult = {
-                    'minWavelength': str(self._wavelength_min) + ' nm',
-                    'maxWavelength': str(self._wavelength_max) + ' nm'
-                }
-            return subresult
-        def writeFileDefault(filename):
-            subresult = {
-                'filename': filename
+        #The file (if any) was found by __probabilityFile() in __dynamicValues()
+        name = ('star' if are_stars else 'gas')+'_probability_'+str(zone)
+        if name in self.skiValues:
+            result_dic['FileWavelengthDistribution'] = {
+                'filename': self.__placeholder(name)
             }
-            return subresult
+        else:
+            result_dic['LogWavelengthDistribution'] = {
+                    'minWavelength': str(self._source_min) + ' nm',
+                    'maxWavelength': str(self._source_max) + ' nm'
+                }
 
+        return result_dic
 
+    def __probabilityFile(self,zone,are_stars=True,iteration0=False):
+        #Returns the file with the wavelength bias distribution of this zone, or None if skirt default (logWavelength) is used
         if self._perRegionProbability == 'Custom':
-            result_dic['FileWavelengthDistribution'] = writeFileDefault(self._customProbabilityFile)
+            return self._customProbabilityFile
         # If user has not provided its own file, then I first look for cases in which the default logWavelength distribution from skirt is used
         elif self._perRegionProbability == 'logWavelength' or iteration0:
             #This fires if
             #1- 'logWavelength' is selected in main (AccuracyAndSpeed->PhotonProbability->per_region : 'logWavelength')
             #2- iteration 0
-
-            result_dic['LogWavelengthDistribution'] = writeSkirtDefault()
+            return None
         elif self._perRegionProbability == 'Luminosity':
-            filename = ''
             # Straightforward. Just use the luminosity of each zone
-            if are_stars: filename = (get_from_folder(self._star_sources_folder, self._star_files))[zone]
-            else: filename = (get_from_folder(self._gas_sources_folder))[zone]
-
-            result_dic['FileWavelengthDistribution'] = writeFileDefault(filename)
+            if are_stars: return self._star_index.paths[zone]
+            else: return self._gas_sources_index.paths[zone]
         elif self._perRegionProbability == 'invLuminosity':
             filename = ''
             folder = ''
             # Straightforward. Just use the luminosity of each zone
             if are_stars:
                 folder = self._star_sources_folder
-                filename = (get_from_folder(folder, self._star_files))[zone]
+                filename = self._star_index.paths[zone]
             else:
                 folder = self._gas_sources_folder
-                filename = (get_from_folder(folder))[zone]
+                filename = self._gas_sources_index.paths[zone]
             #And add this extra step
-            filename = createProbabilityFile(filename,folder,self._probability_folder,invert=True)
-            result_dic['FileWavelengthDistribution'] = writeFileDefault(filename)
+            return createProbabilityFile(filename,folder,self._probability_folder,invert=True)
 
         elif are_stars and self._stars_gas_link[zone] is None:
             #An exception of following options. If region is a stellar one and DO NOT have a gas counterpart, use 'logWavelength' in them
-            result_dic['LogWavelengthDistribution'] = writeSkirtDefault()
+            return None
+        elif self._perRegionProbability == 'Adaptive':
+            #Noise of the field at the gas zone (see skirt/adaptive.py). None until it has been measured
+            true_zone = self._stars_gas_link[zone] if are_stars else zone
+            return self._adaptive.file(true_zone)
         elif self._perRegionProbability == 'Extinction':
             # Find the right media_file
             folder = self._gas_opacity_folder
             true_zone = self._stars_gas_link[zone] if are_stars else zone #self._gas_gas_link[zone] is not None because it is the previous elif
-            media_file = (get_from_folder(folder))[true_zone]
+            media_file = self._gas_opacity_index.paths[true_zone]
 
-            #filename = media_file #PLACEHOLDER!
-            filename = createProbabilityFile(media_file,folder,self._probability_folder)
-            result_dic['FileWavelengthDistribution'] = writeFileDefault(filename)
+            return createProbabilityFile(media_file,folder,self._probability_folder)
         else:
             print("Warning: Probability distribution have not been recognized, using 'logWavelength' option")
-            result_dic['LogWavelengthDistribution'] = writeSkirtDefault()
-
-        return result_dic
+            return None
 
     def __createSources(self,iteration0):
         # =============================================================================
@@ -406,10 +511,10 @@ class SkiParams(object):
         
         # Basic properties 
         Sources['SourceSystem'] = {
-                                    'minWavelength': str(self._wavelength_min)+' nm',
-                                    'maxWavelength': str(self._wavelength_max)+' nm',
+                                    'minWavelength': str(self._source_min)+' nm',
+                                    'maxWavelength': str(self._source_max)+' nm',
                                     'wavelengths': str(self._wavelength_norm)+' nm',
-                                    'sourceBias': '0.5'
+                                    'sourceBias': str(self._sourceBias)
                                     }
         
         Sources['SourceSystem']['sources'] = {'type':'Source'}
@@ -418,9 +523,9 @@ class SkiParams(object):
         n_skirt_sources_count = 0 #star+gas sources.
         
         starSource_properties = None
-        all_star_files        = get_from_folder(self._star_sources_folder, self._star_files)
-        stars_norm_wavelength = get_norm_wavelength(self._star_sources_folder, 'nm', self._star_files), #It will check the third line of 'fileSED', check if units are correct in your file
-        stars_norm_value      = get_norm(self._star_sources_folder, 'erg/s', self._star_files) #It will check the fourth line of 'fileSED',check if units are correct in your file
+        all_star_files        = self._star_index.paths
+        stars_norm_wavelength = self._star_index.norm_wavelength('nm'), #It will check the third line of 'fileSED', check if units are correct in your file
+        stars_norm_value      = self._star_index.norm('erg/s') #It will check the fourth line of 'fileSED',check if units are correct in your file
         
         #print(stars_norm_wavelength)
         for ii in range(0,self._star_zones):
@@ -436,7 +541,7 @@ class SkiParams(object):
                 
                 starSource_properties = {'GeometricSource':{ #This line indicates the type of source it is. Inside this dictionary you have ALL parameters needed for that source
                     		                'velocityMagnitude':'0 km/s', 
-                    		                'sourceWeight':"1", 
+                    		                'sourceWeight':self.__sourceWeight(ii), 
                     		                'wavelengthBias': self._distributionBias,
                     		                
                     		                'geometry':{
@@ -458,7 +563,7 @@ class SkiParams(object):
                     		                            'unitStyle':'neutralmonluminosity',
                     		                            'specificLuminosity':norm_value_ii} 
                     		                    },
-                                            'wavelengthBiasDistribution':self.__wavelengthBiasDistribution_options(ii,iteration0=iteration0)
+                                            'wavelengthBiasDistribution':self.__wavelengthBiasDistribution_options(ii)
                     		                }
                     		            }
             elif self._star_geometry[ii][0] == 'ring':
@@ -468,7 +573,7 @@ class SkiParams(object):
                 
                 starSource_properties = {'GeometricSource':{ #This line indicates the type of source it is. Inside this dictionary you have ALL parameters needed for that source
                     		                'velocityMagnitude':'0 km/s', 
-                    		                'sourceWeight':"1", 
+                    		                'sourceWeight':self.__sourceWeight(ii), 
                     		                'wavelengthBias': self._distributionBias,
                     		                
                     		                'geometry':{
@@ -490,7 +595,7 @@ class SkiParams(object):
                     		                            'unitStyle':'neutralmonluminosity',
                     		                            'specificLuminosity':norm_value_ii} 
                     		                    },
-                                            'wavelengthBiasDistribution':self.__wavelengthBiasDistribution_options(ii,iteration0=iteration0)
+                                            'wavelengthBiasDistribution':self.__wavelengthBiasDistribution_options(ii)
                     		                }
                     		            }
                 
@@ -506,7 +611,7 @@ class SkiParams(object):
                                             'velocityX': ['0 km/s'],
                                             'velocityY': ['0 km/s'],
                                             'velocityZ': ['0 km/s'],
-                                            'sourceWeight': '1',
+                                            'sourceWeight': self.__sourceWeight(ii),
                                             'wavelengthBias': self._distributionBias,
                                             'angularDistribution': {
                                                 'type':'AngularDistribution',
@@ -527,7 +632,7 @@ class SkiParams(object):
                                                         'unitStyle':'neutralmonluminosity',
                                                         'specificLuminosity':norm_value_ii}
                                                     },
-                                            'wavelengthBiasDistribution':self.__wavelengthBiasDistribution_options(ii,iteration0=iteration0)
+                                            'wavelengthBiasDistribution':self.__wavelengthBiasDistribution_options(ii)
                                             }
                                         }
             else:
@@ -548,15 +653,12 @@ class SkiParams(object):
         if iteration0 == False:
             gasSource_properties = None
             
-            all_gas_files       = get_from_folder(self._gas_sources_folder)
-            gas_norm_wavelength = get_norm_wavelength(self._gas_sources_folder, 'nm')
-            gas_norm_value      = get_norm(self._gas_sources_folder, 'erg/s')
             for ii in range(0,self._gas_zones):
                 n_skirt_sources_count += 1
                 
-                gas_file_ii   = all_gas_files[ii]
-                norm_wl_ii    = [gas_norm_wavelength[ii]]
-                norm_value_ii = [gas_norm_value[ii]]
+                gas_file_ii   = self.__placeholder('gas_sed_'+str(ii))
+                norm_wl_ii    = [self.__placeholder('gas_wavelength_'+str(ii))]
+                norm_value_ii = [self.__placeholder('gas_luminosity_'+str(ii))]
                 
                 if self._gas_geometry[ii][0] == 'shell':
                     Rin  = str(self._gas_geometry[ii][1])+self._geometryUnits #e.g.: '3.0 pc'
@@ -564,7 +666,7 @@ class SkiParams(object):
                     
                     gasSource_properties = {'GeometricSource':{
                                                 'velocityMagnitude':'0 km/s', 
-                                                'sourceWeight':"1", 
+                                                'sourceWeight':self.__sourceWeight(ii,are_stars=False), 
                                                 'wavelengthBias': self._distributionBias,
                                                 
                                                 'geometry':{
@@ -586,7 +688,7 @@ class SkiParams(object):
                                                             'unitStyle':'neutralmonluminosity',
                                                             'specificLuminosity':norm_value_ii}
                                                     },
-                                                'wavelengthBiasDistribution':self.__wavelengthBiasDistribution_options(ii,are_stars=False,iteration0=iteration0)
+                                                'wavelengthBiasDistribution':self.__wavelengthBiasDistribution_options(ii,are_stars=False)
                                                 }
                                             }
                     
@@ -597,7 +699,7 @@ class SkiParams(object):
                     
                     gasSource_properties = {'GeometricSource':{
                                                 'velocityMagnitude':'0 km/s', 
-                                                'sourceWeight':"1", 
+                                                'sourceWeight':self.__sourceWeight(ii,are_stars=False), 
                                                 'wavelengthBias': self._distributionBias,
                                                 
                                                 'geometry':{
@@ -619,7 +721,7 @@ class SkiParams(object):
                                                             'unitStyle':'neutralmonluminosity',
                                                             'specificLuminosity':norm_value_ii}
                                                     },
-                                                'wavelengthBiasDistribution':self.__wavelengthBiasDistribution_options(ii,are_stars=False,iteration0=iteration0)
+                                                'wavelengthBiasDistribution':self.__wavelengthBiasDistribution_options(ii,are_stars=False)
                                                 }
                                             }
                 else:
@@ -658,9 +760,9 @@ class SkiParams(object):
                                                                'storeRadiationField': 'true',
                                                                'radiationFieldWLG':{'type':'DisjointWavelengthGrid',
                                                                     'LogWavelengthGrid':{
-                                                                        'minWavelength': str(self._wavelength_min) + ' nm',
-                                                                        'maxWavelength': str(self._wavelength_max) + ' nm',
-                                                                        'numWavelengths': str(self._wavelength_res)
+                                                                        'minWavelength': str(self._grid_min) + ' nm',
+                                                                        'maxWavelength': str(self._grid_max) + ' nm',
+                                                                        'numWavelengths': str(self._grid_res)
                                                                         }
                                                                     }
                                                                 }
@@ -679,15 +781,9 @@ class SkiParams(object):
         # GAS CONTINUUM MEDIA (several mediums sharing the same geometry)
         
         gasMedia_properties = None
-        #Define files needed for media if iteration0 is true or not
-        Media_files = None
-        Media_norm  = None
-        if iteration0:
-            Media_files = [self._nullMaterialFile for i in range(0,self._gas_zones)]
-            Media_norm  = self._nullMass * np.ones(self._gas_zones)
-        else:
-            Media_files = get_from_folder(self._gas_opacity_folder)
-            Media_norm  = get_mass_norm(self._gas_opacity_folder,'Msun') #It will check the third line of 'MeanFileDustMix', check if units are correct in your file
+        #Files and masses of the media (null material in iteration0) are in self.skiValues
+        Media_files = [self.__placeholder('medium_file_'+str(ii)) for ii in range(0,self._gas_zones)]
+        Media_norm  = [self.__placeholder('medium_mass_'+str(ii)) for ii in range(0,self._gas_zones)]
         
         for ii in range(0,self._gas_zones): 
         
@@ -767,16 +863,38 @@ class SkiParams(object):
                                                         }
                                                     }
 
-        Media['MediumSystem']['grid'] = {'type':'SpatialGrid',
-                           'Cylinder2DSpatialGrid': {'maxRadius':self._border_r, 
-                                                     'minZ':'-'+self._border_z,
-                                                     'maxZ':self._border_z,
-                                                     'meshRadial':{'type':'Mesh',
-                                                                   'LinMesh':{'numBins':self._resolution_r}},
-                                                     'meshZ':{'type':'MoveableMesh',
-                                                              'LinMesh':{'numBins':self._resolution_z}}
-                                                     }
-                           }       
+        if self._grid is None:
+            Media['MediumSystem']['grid'] = {'type':'SpatialGrid',
+                               'Cylinder2DSpatialGrid': {'maxRadius':self._border_r, 
+                                                         'minZ':'-'+self._border_z,
+                                                         'maxZ':self._border_z,
+                                                         'meshRadial':{'type':'Mesh',
+                                                                       'LinMesh':{'numBins':self._resolution_r}},
+                                                         'meshZ':{'type':'MoveableMesh',
+                                                                  'LinMesh':{'numBins':self._resolution_z}}
+                                                         }
+                               }       
+            print("Spatial grid: Cylinder2D, "+str(self._resolution_r)+" x "+str(self._resolution_z)+" cells")
+        elif self._grid.spherical:
+            Media['MediumSystem']['grid'] = {'type':'SpatialGrid',
+                               'Sphere1DSpatialGrid': {'minRadius':'0'+self._geometryUnits,
+                                                       'maxRadius':self._border_r,
+                                                       'meshRadial':{'type':'Mesh',**GeometryGrid.listMesh(self._grid.radial)}
+                                                       }
+                               }
+            print("Spatial grid: Sphere1D, "+str(self._grid.n_cells)+" cells")
+        else:
+            #Same limits as 'Linear'
+            Media['MediumSystem']['grid'] = {'type':'SpatialGrid',
+                               'Cylinder2DSpatialGrid': {'maxRadius':self._border_r,
+                                                         'minZ':'-'+self._border_z,
+                                                         'maxZ':self._border_z,
+                                                         'meshRadial':{'type':'Mesh',**GeometryGrid.listMesh(self._grid.radial)},
+                                                         'meshZ':{'type':'MoveableMesh',**GeometryGrid.listMesh(self._grid.vertical)}
+                                                         }
+                               }
+            print("Spatial grid: Cylinder2D, "+str(len(self._grid.radial)-1)+" x "+str(len(self._grid.vertical)-1)+" = "
+                  +str(self._grid.n_cells)+" cells (Linear would use "+str(self._resolution_r*self._resolution_z)+")")
         
         #returns
         self.Media = Media
@@ -790,9 +908,9 @@ class SkiParams(object):
         Instruments['InstrumentSystem'] = {'defaultWavelengthGrid':{
                 'type':'WavelengthGrid',
                 'LogWavelengthGrid':{
-                    'minWavelength':str(self._wavelength_min)+' nm',
-                    'maxWavelength':str(self._wavelength_max)+' nm',
-                    'numWavelengths':str(self._wavelength_res)} 
+                    'minWavelength':str(self._grid_min)+' nm',
+                    'maxWavelength':str(self._grid_max)+' nm',
+                    'numWavelengths':str(self._grid_res)} 
                 }
             }
         
@@ -811,9 +929,9 @@ class SkiParams(object):
                                          'recordStatistics':'false',
                                          'wavelengthGrid':{'type':'WavelengthGrid',
                                                            'LogWavelengthGrid':{
-                                                                   'minWavelength':str(self._wavelength_min)+' nm',
-                                                                   'maxWavelength':str(self._wavelength_max)+' nm',
-                                                                   'numWavelengths':str(self._wavelength_res)
+                                                                   'minWavelength':str(self._grid_min)+' nm',
+                                                                   'maxWavelength':str(self._grid_max)+' nm',
+                                                                   'numWavelengths':str(self._grid_res)
                                                                                }
                                                    }
                                      },
@@ -834,9 +952,9 @@ class SkiParams(object):
                 'probeName':'source_lum',
                     'wavelengthGrid':{'type':'WavelengthGrid',
                      'LogWavelengthGrid':{
-                         'minWavelength':str(self._wavelength_min)+' nm',
-                         'maxWavelength':str(self._wavelength_max)+' nm',
-                         'numWavelengths':str(self._wavelength_res)
+                         'minWavelength':str(self._grid_min)+' nm',
+                         'maxWavelength':str(self._grid_max)+' nm',
+                         'numWavelengths':str(self._grid_res)
                                           }
                      }
                 },
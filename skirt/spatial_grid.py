@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+'Geometry' spatial grid (AccuracyAndSpeed->SpatialGrid->type).
+Instead of a fixed linear mesh, mesh points are placed from the gas zones:
+    - Breakpoints at the borders of every zone (Rin and Rout of shells, R-w, R and R+w of rings, and h of rings in z).
+    - Each segment between breakpoints covered by gas gets 'cells_per_zone' cells per width of the thinnest zone covering it.
+    - Segments without gas (or with the exponential tails of rings in z) get logarithmic cells, 'cells_per_decade' per factor 10.
+If every gas zone is a shell, a 1D spherical grid is used. Otherwise, a 2D cylindrical grid (symmetric in z).
+'''
+
+import numpy as np
+
+class GeometryGrid(object):
+    def __init__(self,grid_dict,gas_table,R_max,z_max):
+        self.__cells_per_zone = grid_dict['cells_per_zone']
+        self.__cells_per_decade = grid_dict['cells_per_decade']
+        kind, params = gas_table
+        shell = kind == 'shell'
+        ring = kind == 'ring'
+        self.spherical = bool(np.all(shell))
+
+        #Radial mesh. Shells cover [Rin,Rout], rings [R-w,R+w], and R is also a breakpoint
+        lower = np.where(shell, params[:,0], np.maximum(params[:,0]-params[:,1],0.0))
+        upper = np.where(shell, params[:,1], params[:,0]+params[:,1])
+        extra = params[ring,0]
+        self.radial = self.__mesh(lower,upper,upper-lower,extra,R_max)
+        if self.spherical:
+            self.vertical = None
+            self.n_cells = len(self.radial)-1
+            return
+        #Vertical mesh (z >= 0, then mirrored). Shells cover [0,Rout] and rings [0,h]
+        upper_z = np.where(shell, params[:,1], params[:,2])
+        width_z = np.where(shell, params[:,1]-params[:,0], params[:,2])
+        half = self.__mesh(np.zeros(len(kind)),upper_z,width_z,np.array([]),z_max)
+        self.vertical = np.concatenate([-half[:0:-1],half])
+        self.n_cells = (len(self.radial)-1)*(len(self.vertical)-1)
+
+    def __mesh(self,lower,upper,width,extra,border):
+        #Mesh points from 0 to border (both included)
+        breakpoints = np.unique(np.clip(np.concatenate([[0.0,border],lower,upper,extra]),0.0,border))
+        breakpoints = breakpoints[np.concatenate([[True],np.diff(breakpoints) > 1e-9*border])]
+        breakpoints[-1] = border
+        points = [breakpoints[:1]]
+        for a,b in zip(breakpoints[:-1],breakpoints[1:]):
+            middle = (a+b)/2.0
+            covering = (lower <= middle) & (upper >= middle) & (width > 0.0)
+            if np.any(covering):
+                n = int(np.ceil(self.__cells_per_zone*(b-a)/np.min(width[covering])))
+                segment = np.linspace(a,b,n+1)
+            elif a > 0.0:
+                n = int(np.ceil(self.__cells_per_decade*np.log10(b/a)))
+                segment = np.geomspace(a,b,n+1)
+            else:
+                #Empty space around the centre, there is no logarithmic scale here
+                segment = np.linspace(a,b,self.__cells_per_decade+1)
+            segment[-1] = b
+            points.append(segment[1:])
+        return np.concatenate(points)
+
+    @staticmethod
+    def listMesh(points):
+        #skirt ListMesh: points are rescaled to the extent of the grid, so they are written from 0 to 1
+        normalized = (points-points[0])/(points[-1]-points[0])
+        return {'ListMesh':{'points':', '.join([repr(value) for value in normalized.tolist()])}}
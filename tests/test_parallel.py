@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Checks of skirt/parallel.py, with probe files written here instead of running skirt. Run from the root folder (as Main.py):
+    python3 -m pytest tests
+'''
+
+import numpy as np
+import pytest
+from skirt.parallel import SkirtJobs
+
+def options(bands=False,members=1,edges=[91.2],photon_weights=None):
+    return {'Wavelength':{'minWavelength':10.0,'maxWavelength':3.0e5,'resolution':40,'normalization':550.0},
+            'AccuracyAndSpeed':{'n_threads':4,
+                                'SkirtBands':{'active':bands,'edges':edges,'photon_weights':photon_weights},
+                                'SkirtEnsemble':{'active':members > 1,'members':members}},
+            'Technical':{'skirt_timeout':None}}
+
+def writeProbe(filename,wavelength,values,positions):
+    #Same layout as the nuJnu probe of skirt: 3 columns of position and one per wavelength (micron)
+    with open(filename,'w') as file:
+        file.write("# SKIRT 9 output file\n# Mean intensity at positions\n")
+        file.write("# column 1: position x (pc)\n# column 2: position y (pc)\n# column 3: position z (pc)\n")
+        for ii in range(0,len(wavelength)):
+            file.write("# column "+str(ii+4)+": lambda*J_lambda at lambda = "+repr(wavelength[ii]*1e-3)+" micron (W/m2/sr)\n")
+        for position,row in zip(positions,values):
+            file.write(" ".join(position)+" "+" ".join(row)+"\n")
+
+def grid(jobs_options):
+    wavelength = jobs_options['Wavelength']
+    return np.logspace(np.log10(wavelength['minWavelength']),np.log10(wavelength['maxWavelength']),wavelength['resolution'])
+
+def test_bands_cover_the_grid():
+    jobs = SkirtJobs(options(bands=True,edges=[91.2,1000.0]))
+    full = grid(options())
+    assert sum([band['grid'][2] for band in jobs.bands]) == len(full)
+    assert jobs.bands[0]['grid'][0] == 10.0 and jobs.bands[-1]['grid'][1] == 3.0e5
+    assert np.isclose(sum([band['photonShare'] for band in jobs.bands]),1.0)
+    for band,next_band in zip(jobs.bands[:-1],jobs.bands[1:]):
+        #Sources of neighbour bands meet at the border between their bins
+        assert band['sourceRange'][1] == next_band['sourceRange'][0]
+        assert band['grid'][1] < band['sourceRange'][1] < next_band['grid'][0]
+
+def test_band_too_narrow():
+    with pytest.raises(RuntimeError):
+        SkirtJobs(options(bands=True,edges=[91.2,92.0]))
+
+def test_stitch(tmp_path):
+    prefix = str(tmp_path/'skirt_file')
+    jobs = SkirtJobs(options(bands=True),prefix=prefix)
+    full = grid(options())
+    positions = [['0','0','0'],['1000','0','0']]
+    rng = np.random.default_rng(1)
+    values = [['%.6e'%value for value in rng.uniform(0.0,1.0,len(full))] for position in positions]
+    writeProbe(str(tmp_path/'single.dat'),full,values,positions)
+    first = 0
+    for band in jobs.bands:
+        last = first+band['grid'][2]
+        writeProbe(prefix+'_band'+str(band['index'])+'_nuJnu_J.dat',full[first:last],[row[first:last] for row in values],positions)
+        first = last
+    jobs.combine()
+    #Same text as a single skirt simulation
+    assert open(prefix+'_nuJnu_J.dat').read() == open(str(tmp_path/'single.dat')).read()
+
+def test_stitch_positions_must_match(tmp_path):
+    prefix = str(tmp_path/'skirt_file')
+    jobs = SkirtJobs(options(bands=True),prefix=prefix)
+    full = grid(options())
+    first = 0
+    for band in jobs.bands:
+        last = first+band['grid'][2]
+        positions = [['0','0','0'],[str(band['index']),'0','0']]
+        writeProbe(prefix+'_band'+str(band['index'])+'_nuJnu_J.dat',full[first:last],[['1.0']*(last-first)]*2,positions)
+        first = last
+    with pytest.raises(RuntimeError):
+        jobs.combine()
+
+def writeMembers(jobs,prefix,full,positions,rng):
+    #Probes of every job, and the values of each member over the whole grid
+    values = rng.uniform(0.5,1.5,(len(jobs.seeds),len(positions),len(full)))
+    first = 0
+    for band in jobs.bands:
+        last = first+band['grid'][2]
+        for job in band['jobs']:
+            member = values[jobs.seeds.index(job['seed'])]
+            writeProbe(prefix+'_'+job['name']+'_nuJnu_J.dat',full[first:last],[['%r'%value for value in row[first:last]] for row in member],positions)
+        first = last
+    return values
+
+def test_jobs_of_ensemble():
+    jobs = SkirtJobs(options(bands=True,members=3))
+    assert [job['name'] for job in jobs.jobs] == ['band'+str(ii)+'_seed'+seed for ii in [0,1] for seed in ['0','1','2']]
+    assert len(set([job['seed'] for job in jobs.jobs])) == 3
+    assert np.isclose(sum([job['photonShare'] for job in jobs.jobs]),1.0)
+
+@pytest.mark.parametrize('bands',[False,True])
+def test_merge(tmp_path,bands):
+    prefix = str(tmp_path/'skirt_file')
+    jobs = SkirtJobs(options(bands=bands,members=4),prefix=prefix)
+    full = grid(options())
+    positions = [['0','0','0'],['1000','0','0'],['0','0','500']]
+    values = writeMembers(jobs,prefix,full,positions,np.random.default_rng(2))
+    jobs.combine()
+    #Members of a band have the same photons, so the mean is not weighted
+    mean = np.loadtxt(prefix+'_nuJnu_J.dat',comments='#',ndmin=2)
+    noise = np.loadtxt(prefix+'_nuJnu_J_noise.dat',comments='#',ndmin=2)
+    assert np.array_equal(mean[:,:3],np.array(positions,dtype=float))
+    assert np.allclose(mean[:,3:],np.mean(values,axis=0))
+    assert np.allclose(noise[:,3:],np.std(values,axis=0,ddof=1)/np.sqrt(4))
+    #Same header (wavelengths) as a single simulation, so it can be read as usual
+    header = [line for line in open(prefix+'_nuJnu_J.dat') if line.startswith('#')]
+    noise_header = [line for line in open(prefix+'_nuJnu_J_noise.dat') if line.startswith('#')]
+    assert noise_header[0].startswith('# Standard error') and noise_header[1:] == header
+    assert len(header) == 5+len(full)
+
+def test_merge_positions_must_match(tmp_path):
+    prefix = str(tmp_path/'skirt_file')
+    jobs = SkirtJobs(options(members=2),prefix=prefix)
+    full = grid(options())
+    for job in jobs.jobs:
+        writeProbe(prefix+'_'+job['name']+'_nuJnu_J.dat',full,[['1.0']*len(full)],[[job['seed'],'0','0']])
+    with pytest.raises(RuntimeError):
+        jobs.combine()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Checks of cloudy/ResultStore.py. Run from the root folder (as Main.py):
+    python3 -m pytest tests
+'''
+
+import json
+import os
+from cloudy.ResultStore import ResultStore
+
+def write(path,text):
+    with open(str(path),'w') as file:
+        file.write(text)
+    return str(path)
+
+def outputs(folder,text):
+    #overview, spectra, composition and tau files of a zone
+    return [write(folder/(name+'.txt'),text+' '+name) for name in ['overview','spectra','composition','tau']]
+
+def test_key(tmp_path):
+    store = ResultStore(str(tmp_path/'store'),10)
+    sed = write(tmp_path/'zone.sed',"1.0 2.0\n")
+    deck = write(tmp_path/'a.in',"title zone 0\n# comment\nhden 1.0\ntable sed \"zone.sed\"\nsave overview \"a.txt\"\n")
+    #Title, comments, outputs and the name of the sed do not change the model
+    same = write(tmp_path/'b.in',"title zone 7\nhden 1.0\ntable sed \"other.sed\"\nsave overview \"b.txt\"\n")
+    other_model = write(tmp_path/'c.in',"title zone 0\nhden 2.0\n")
+    assert store.key(deck,sed) == store.key(same,sed)
+    assert store.key(deck,sed) != store.key(other_model,sed)
+    other_sed = write(tmp_path/'other.sed',"1.0 3.0\n")
+    assert store.key(deck,sed) != store.key(deck,other_sed)
+
+def test_store_and_fetch(tmp_path):
+    store = ResultStore(str(tmp_path/'store'),10)
+    (tmp_path/'run').mkdir()
+    (tmp_path/'new').mkdir()
+    files = outputs(tmp_path/'run',"model")
+    assert not store.fetch('abcdef',[str(tmp_path/'new'/os.path.basename(f)) for f in files])
+    store.store('abcdef',files)
+    fetched = [str(tmp_path/'new'/os.path.basename(f)) for f in files]
+    assert store.fetch('abcdef',fetched)
+    assert [open(f).read() for f in fetched] == [open(f).read() for f in files]
+    assert (store.hits,store.misses) == (1,1)
+
+def test_eviction_and_stats(tmp_path):
+    folder = tmp_path/'store'
+    (tmp_path/'run').mkdir()
+    store = ResultStore(str(folder),1.0e-3) #About 1 kB, two entries of 4x200 bytes do not fit
+    store.store('aa0001',outputs(tmp_path/'run','x'*200))
+    store.store('bb0002',outputs(tmp_path/'run','y'*200))
+    #The first one was used last, so the second one is removed
+    os.utime(str(folder/'aa'/'aa0001'),(1.0e9,1.0e9))
+    os.utime(str(folder/'bb'/'bb0002'),(1.0e8,1.0e8))
+    store.report()
+    assert os.path.isdir(str(folder/'aa'/'aa0001'))
+    assert not os.path.isdir(str(folder/'bb'/'bb0002'))
+
+    store.fetch('aa0001',[str(tmp_path/'run'/('f'+str(i))) for i in range(0,4)])
+    store.fetch('bb0002',[str(tmp_path/'run'/('f'+str(i))) for i in range(0,4)])
+    store.report()
+    with open(str(folder/'stats.json'),'r') as file:
+        stats = json.load(file)
+    assert (stats['hits'],stats['misses']) == (1,1)
+    assert (store.hits,store.misses) == (0,0)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Checks of utils/runner.py, with small shell commands instead of skirt and cloudy. Run from the root folder (as Main.py):
+    python3 -m pytest tests
+'''
+
+import os
+import time
+import pytest
+from utils.runner import StageRunner
+
+def alive(pid):
+    #Killed processes may stay as zombies until somebody reaps them, that counts as dead
+    try:
+        with open('/proc/'+str(pid)+'/stat','r') as file:
+            return file.read().split(')')[-1].split()[0] != 'Z'
+    except FileNotFoundError:
+        return False
+
+needs_proc = pytest.mark.skipif(not os.path.isdir('/proc'),reason="process states are read from /proc")
+
+def test_exit_status_and_output(tmp_path):
+    output = str(tmp_path/'out.txt')
+    result = StageRunner().run(["sh","-c","echo hello; exit 3"],stdout=output)
+    assert result.returncode == 3 and not result.ok
+    assert open(output).read() == "hello\n"
+    assert StageRunner().run(["true"]).ok
+
+def test_stdin(tmp_path):
+    (tmp_path/'in.txt').write_text("from file\n")
+    result = StageRunner().run(["cat"],stdin=str(tmp_path/'in.txt'),stdout=str(tmp_path/'out.txt'))
+    assert result.ok and (tmp_path/'out.txt').read_text() == "from file\n"
+
+@needs_proc
+def test_timeout_kills_children(tmp_path):
+    #The child prints its pid and waits for a grandchild that would outlive a plain kill
+    output = str(tmp_path/'out.txt')
+    t_start = time.time()
+    result = StageRunner(timeout=0.5).run(["sh","-c","sleep 30 & echo $!; wait"],stdout=output)
+    assert result.timed_out and result.returncode is None and not result.ok
+    assert time.time()-t_start < 10.0
+    grandchild = int(open(output).read().split()[0])
+    time.sleep(0.2)
+    assert not alive(grandchild)
+
+def test_watch_stops_process(tmp_path):
+    result = StageRunner().run(["sh","-c","echo start; echo DISASTER; sleep 30"],watch=lambda line : 'DISASTER' in line)
+    assert result.stopped and result.returncode is None and not result.ok
+    assert result.elapsed < 10.0
+
+def test_run_all_order_and_parallelism():
+    runner = StageRunner(max_parallel=2)
+    t_start = time.time()
+    results = runner.run_all([runner.launch(["sh","-c","sleep "+str(t)+"; exit "+str(code)]) for t,code in [(0.6,1),(0.3,2),(0.3,3)]])
+    elapsed = time.time()-t_start
+    #Same order as the jobs, and the third one starts as soon as the second finishes
+    assert [result.returncode for result in results] == [1,2,3]
+    assert elapsed < 1.2
+
+@needs_proc
+def test_run_all_cancels_the_rest(tmp_path):
+    runner = StageRunner(max_parallel=2)
+    async def failing():
+        await runner.launch(["sleep","0.1"])
+        raise RuntimeError("zone failed")
+    pid_file = str(tmp_path/'pid.txt')
+    with pytest.raises(RuntimeError):
+        runner.run_all([runner.launch(["sh","-c","sleep 30 & echo $!; wait"],stdout=pid_file),failing()])
+    time.sleep(0.2)
+    assert not alive(int(open(pid_file).read().split()[0]))
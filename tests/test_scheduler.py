@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Checks of skirt/scheduler.py, with a fake ConvergenceObject. Run from the root folder (as Main.py):
+    python3 -m pytest tests
+'''
+
+import numpy as np
+from skirt.scheduler import PhotonScheduler
+
+class FakeProgram(object):
+    #Only what PhotonScheduler reads from ConvergenceObject: values[key,iteration,zone], tolerances[key], converged[key,zone]
+    def __init__(self,values,tolerances,converged=None):
+        self.__values = np.array(values,dtype=float)
+        self.__tolerances = np.array(tolerances,dtype=float)
+        self.__converged = np.zeros((len(values),len(values[0][0])),dtype=bool) if converged is None else np.array(converged)
+
+    def history(self):
+        return self.__values, self.__tolerances, self.__converged
+
+def scheduler(tmp_path,max_packets=1e8,max_increase=4.0):
+    options = {'AccuracyAndSpeed':{'PhotonScheduler':{'initial_packets':1e6,'max_packets':max_packets,
+                                                      'max_increase':max_increase,'noise_to_tolerance':1.0}}}
+    return PhotonScheduler(options,logfile=str(tmp_path/'photon_schedule.log'))
+
+def run(tmp_path,series,tolerance,converged=None,**kwargs):
+    #'series' of a single key and zone, including iteration 0
+    photons = scheduler(tmp_path,**kwargs)
+    for iteration in range(0,len(series)):
+        photons.log(iteration,1.0)
+    packets = photons.update(FakeProgram([[[value] for value in series]],[tolerance],converged))
+    photons.log(len(series),1.0)
+    decision = open(str(tmp_path/'photon_schedule.log')).readlines()[-1].split(None,4)[-1]
+    return packets, decision
+
+def noisy(n,scale):
+    #Alternating values: only noise, no physical change
+    return [1.0+scale*(-1)**ii for ii in range(0,n)]
+
+def test_few_iterations(tmp_path):
+    packets, decision = run(tmp_path,noisy(3,0.01),1e-3)
+    assert packets == 1e6 and decision.startswith('keep (few iterations)')
+
+def test_noise_dominates(tmp_path):
+    #Noise/tolerance ~16, so packets would grow ~260 times, but max_increase limits it
+    packets, decision = run(tmp_path,noisy(6,0.01),1e-3)
+    assert packets == 4e6 and decision.startswith('increase')
+
+def test_max_packets(tmp_path):
+    packets, decision = run(tmp_path,noisy(6,0.01),1e-3,max_packets=2e6)
+    assert packets == 2e6
+    packets, decision = run(tmp_path,noisy(6,0.01),1e-3,max_packets=1e6)
+    assert packets == 1e6 and decision.startswith('keep (max_packets reached)')
+
+def test_noise_below_target(tmp_path):
+    packets, decision = run(tmp_path,noisy(6,1e-5),1e-2)
+    assert packets == 1e6 and decision.startswith('keep (noise below target)')
+
+def test_physics_dominates(tmp_path):
+    #Steady trend: changes are not explained by noise, more photons would not help
+    packets, decision = run(tmp_path,[1.0+0.1*ii for ii in range(0,6)],1e-3)
+    assert packets == 1e6 and decision.startswith('keep (physics dominates')
+
+def test_converged(tmp_path):
+    packets, decision = run(tmp_path,noisy(6,0.01),1e-3,converged=[[True]])
+    assert packets == 1e6 and decision.startswith('keep (physics dominates or converged)')
+
+def test_log(tmp_path):
+    photons = scheduler(tmp_path)
+    photons.log(0,12.5)
+    lines = open(str(tmp_path/'photon_schedule.log')).readlines()
+    assert len([line for line in lines if line.startswith('#')]) == 5
+    assert lines[-1].split()[:3] == ['0','1000000.0','12.5']
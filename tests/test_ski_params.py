@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Checks of skirt/ski_params.py. Run from the root folder (as Main.py):
+    python3 -m pytest tests
+'''
+
+import numpy as np
+from skirt.ski_params import IntervalIndex
+
+def covering(lower,upper,labels,x):
+    #Labels of the intervals containing x, one by one
+    return sorted([int(label) for a,b,label in zip(lower,upper,labels) if a <= x <= b])
+
+def test_interval_index_random():
+    rng = np.random.default_rng(0)
+    for trial in range(0,50):
+        n = int(rng.integers(1,12))
+        #Rounded, so edges are shared between intervals and positions fall on them
+        lower = np.round(rng.uniform(0.0,10.0,n))
+        upper = lower+np.round(rng.uniform(0.0,5.0,n))
+        labels = rng.permutation(n)
+        index = IntervalIndex(lower,upper,labels)
+        x = np.concatenate([np.round(rng.uniform(-1.0,16.0,30)),rng.uniform(-1.0,16.0,30)])
+        slots = index.slots(x)
+        for x_i,slot in zip(x,slots):
+            assert index.contents[slot] == covering(lower,upper,labels,x_i)
+
+def test_interval_index_edges():
+    index = IntervalIndex(np.array([0.0,2.0]),np.array([2.0,3.0]),np.array([5,1]))
+    #Closed intervals: the shared edge belongs to both, in ascending order of labels
+    assert [index.contents[slot] for slot in index.slots([-1.0,0.0,1.0,2.0,2.5,3.0,4.0])] == [[],[5],[5],[1,5],[1],[1],[]]
+
+def test_interval_index_empty():
+    index = IntervalIndex(np.array([]),np.array([]),np.array([],dtype=int))
+    assert [index.contents[slot] for slot in index.slots([0.0,np.nan])] == [[],[]]
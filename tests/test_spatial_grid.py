@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Checks of skirt/spatial_grid.py. Run from the root folder (as Main.py):
+    python3 -m pytest tests
+'''
+
+import numpy as np
+from skirt.spatial_grid import GeometryGrid
+
+grid_dict = {'cells_per_zone':4,'cells_per_decade':10}
+
+def table(rows):
+    #Same as SkiParams: kinds and (n,3) parameters (shells: Rin, Rout; rings: R, w, h)
+    return np.array([row[0] for row in rows],dtype=object), np.array([list(row[1:])+[0.0]*(4-len(row)) for row in rows],dtype=float)
+
+def contains(mesh,points):
+    return all([np.any(np.isclose(mesh,point,rtol=0.0,atol=1e-9*mesh[-1])) for point in points])
+
+def test_shells():
+    grid = GeometryGrid(grid_dict,table([('shell',1.0,2.0),('shell',2.0,2.5)]),10.0,10.0)
+    assert grid.spherical and grid.vertical is None
+    assert grid.radial[0] == 0.0 and grid.radial[-1] == 10.0
+    assert np.all(np.diff(grid.radial) > 0.0)
+    assert contains(grid.radial,[1.0,2.0,2.5])
+    assert grid.n_cells == len(grid.radial)-1
+    #cells_per_zone cells per width of each shell
+    assert np.allclose(np.diff(grid.radial[(grid.radial >= 1.0) & (grid.radial <= 2.0)]),0.25)
+    assert np.allclose(np.diff(grid.radial[(grid.radial >= 2.0) & (grid.radial <= 2.5)]),0.125)
+    #Logarithmic cells outside the gas
+    outside = grid.radial[grid.radial >= 2.5]
+    assert np.allclose(outside[1:]/outside[:-1],outside[1]/outside[0])
+    assert len(outside)-1 == int(np.ceil(10*np.log10(10.0/2.5)))
+
+def test_rings():
+    grid = GeometryGrid(grid_dict,table([('ring',5.0,1.0,0.5),('shell',1.0,2.0)]),20.0,8.0)
+    assert not grid.spherical
+    assert contains(grid.radial,[1.0,2.0,4.0,5.0,6.0])
+    assert np.all(np.diff(grid.radial) > 0.0) and grid.radial[-1] == 20.0
+    #Symmetric in z, with the height of the ring and the shell as breakpoints
+    assert np.all(np.diff(grid.vertical) > 0.0)
+    assert np.allclose(grid.vertical,-grid.vertical[::-1])
+    assert grid.vertical[-1] == 8.0 and contains(grid.vertical,[0.0,0.5,2.0,-0.5,-2.0])
+    assert grid.n_cells == (len(grid.radial)-1)*(len(grid.vertical)-1)
+    #The thinnest zone sets the cells where zones overlap
+    assert np.allclose(np.diff(grid.vertical[(grid.vertical >= 0.0) & (grid.vertical <= 0.5)]),0.125)
+
+def test_zones_beyond_border():
+    #Zones are clipped to the grid, which still ends at its border
+    grid = GeometryGrid(grid_dict,table([('shell',1.0,50.0)]),10.0,10.0)
+    assert grid.radial[-1] == 10.0 and np.all(np.diff(grid.radial) > 0.0)
+
+def test_list_mesh():
+    mesh = GeometryGrid.listMesh(np.array([0.0,1.0,2.5,10.0]))
+    points = [float(value) for value in mesh['ListMesh']['points'].split(',')]
+    assert points == [0.0,0.1,0.25,1.0]
+    mesh = GeometryGrid.listMesh(np.array([-4.0,-1.0,0.0,1.0,4.0]))
+    assert [float(value) for value in mesh['ListMesh']['points'].split(',')] == [0.0,0.375,0.5,0.625,1.0]
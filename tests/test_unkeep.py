@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Checks of utils/unkeep.py. Run from the root folder (as Main.py):
+    python3 -m pytest tests
+'''
+
+import numpy as np
+import pytest
+from utils.unkeep import selfAbsorptionCorrection, rebinOperator, downsample
+
+def scalarCorrection(tau_shell):
+    #Self-absorption correction as it was done in CloudyToSkirt._zonesProperties() before selfAbsorptionCorrection()
+    #(unkeep sets np.seterr(all='raise'), so underflows fall back to the loop)
+    tau_shell = np.asarray(tau_shell,dtype=float)
+    try:
+        return tau_shell / ( 1. - np.exp(-tau_shell) )
+    except FloatingPointError:
+        exp_order_of_magnitude = -tau_shell / np.log(10.0) # =log10(exp(-tau))
+        thick = exp_order_of_magnitude <= -250.0
+        corrected = np.empty(tau_shell.shape)
+        corrected[thick] = tau_shell[thick]
+        for i in np.where(~thick)[0]:
+            corrected[i] = tau_shell[i] / ( 1. - np.exp(-tau_shell[i]) )
+        return corrected
+
+def test_zero_depth():
+    #The scalar path raised here (0/0), the limit is 1
+    assert np.array_equal(selfAbsorptionCorrection([0.0,0.0]),[1.0,1.0])
+
+def test_thin():
+    #1-exp(-tau) loses digits for small tau, so the scalar path is less precise than expm1
+    tau = np.array([1e-7,1e-6,1e-4,1e-2])
+    assert np.allclose(selfAbsorptionCorrection(tau),scalarCorrection(tau),rtol=1e-8,atol=0.0)
+    assert np.allclose(selfAbsorptionCorrection(tau),1.0+tau/2.0,rtol=1e-4,atol=0.0)
+
+def test_intermediate():
+    tau = np.logspace(-1,np.log10(40.0),200)
+    assert np.allclose(selfAbsorptionCorrection(tau),scalarCorrection(tau),rtol=1e-13,atol=0.0)
+
+@pytest.mark.parametrize('tau',[41.0,100.0,575.0,700.0,800.0,1e4])
+def test_thick(tau):
+    #Above 700, exp(-tau) underflows and the scalar path used its fallback
+    tau = np.array([0.5,tau])
+    assert np.allclose(selfAbsorptionCorrection(tau),scalarCorrection(tau),rtol=1e-15,atol=0.0)
+
+@pytest.mark.parametrize('threshold',[1e-8,40.0])
+def test_branch_thresholds(threshold):
+    #Both sides of the limits between branches
+    tau = np.array([np.nextafter(threshold,0.0),threshold,np.nextafter(threshold,np.inf)])
+    corrected = selfAbsorptionCorrection(tau)
+    assert np.allclose(corrected,scalarCorrection(tau),rtol=1e-8,atol=0.0)
+    assert np.all(np.diff(corrected) >= 0.0) #No jumps backwards between branches
+
+def test_shape():
+    #Same shape as the (zones, wavelengths) arrays of the converter
+    tau = np.array([[0.0,1e-9,1.0],[39.0,45.0,1e3]])
+    assert selfAbsorptionCorrection(tau).shape == tau.shape
+
+def cumulativeDownsample(x,X,Y):
+    #'Integral' downsample() as it was before rebinOperator(): interpolation of the cumulative integral
+    dX = np.diff(X)
+    F  = np.cumsum(0.5*(Y[1:]+Y[:-1])*dX)
+    f  = np.interp(x,0.5*(X[1:]+X[:-1]),F)
+    return np.diff(f)/np.diff(x)
+
+@pytest.mark.parametrize('x_range',[(2.0,900.0),(0.5,2000.0),(10.0,20.0)])
+def test_rebin_operator(x_range):
+    #Coarse grid inside, partially outside and inside a few source bins
+    X = np.logspace(0.0,3.0,400)
+    Y = np.exp(-np.log(X/30.0)**2)
+    x = np.logspace(np.log10(x_range[0]),np.log10(x_range[1]),37)
+    operator = rebinOperator(x,X)
+    assert operator.shape == (len(x)-1,len(X))
+    assert np.allclose(operator @ Y,cumulativeDownsample(x,X,Y),rtol=1e-10,atol=1e-14)
+    #Several functions at once (columns), as the converter does
+    Ys = np.column_stack([Y,X,np.ones(len(X))])
+    assert np.allclose(downsample(x,X,Ys),np.column_stack([cumulativeDownsample(x,X,Y) for Y in Ys.T]),rtol=1e-10,atol=1e-14)
+
+def test_rebin_operator_cache():
+    X = np.linspace(1.0,10.0,50)
+    x = np.linspace(2.0,9.0,8)
+    assert rebinOperator(x,X) is rebinOperator(x.copy(),X.copy())
+    assert rebinOperator(x[1:],X) is not rebinOperator(x,X)
+
+def test_rebin_keeps_integral():
+    #Bins fully inside the source grid keep the integral of the trapezoidal rule between the bin borders of mean(X)
+    X = np.linspace(0.0,10.0,101)
+    Y = X**2
+    Xm = 0.5*(X[1:]+X[:-1])
+    Ym = 0.5*(Y[1:]+Y[:-1])*np.diff(X)
+    x = Xm[[10,40,90]]
+    y = rebinOperator(x,X) @ Y
+    assert np.allclose(y*np.diff(x),[np.sum(Ym[11:41]),np.sum(Ym[41:91])],rtol=1e-12)
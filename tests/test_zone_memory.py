@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Checks of cloudy/ZoneMemory.py. Run from the root folder (as Main.py):
+    python3 -m pytest tests
+'''
+
+from cloudy.ZoneMemory import ZoneMemory
+
+def test_new_zone(tmp_path):
+    memory = ZoneMemory(str(tmp_path/'zones.json'))
+    assert memory.runtime('zone0.sed') is None
+    assert not memory.useNoQheat('zone0.sed')
+
+def test_crash_without_retry(tmp_path):
+    memory = ZoneMemory(str(tmp_path/'zones.json'))
+    memory.ranWith('zone0.sed',no_qheat=False,crashed=True)
+    for run in range(0,5):
+        assert memory.useNoQheat('zone0.sed')
+        memory.ranWith('zone0.sed',no_qheat=True)
+    assert not memory.useNoQheat('zone1.sed') #Other zones are not affected
+
+def test_retry_and_recover(tmp_path):
+    memory = ZoneMemory(str(tmp_path/'zones.json'),retry_every=2)
+    memory.ranWith('zone0.sed',no_qheat=False,crashed=True)
+    assert memory.useNoQheat('zone0.sed')
+    memory.ranWith('zone0.sed',no_qheat=True)
+    assert memory.useNoQheat('zone0.sed')
+    memory.ranWith('zone0.sed',no_qheat=True)
+    #Two runs without crashes: try qheat again
+    assert not memory.useNoQheat('zone0.sed')
+    memory.ranWith('zone0.sed',no_qheat=False)
+    assert not memory.useNoQheat('zone0.sed')
+
+def test_retry_crashes_again(tmp_path):
+    memory = ZoneMemory(str(tmp_path/'zones.json'),retry_every=1)
+    memory.ranWith('zone0.sed',no_qheat=False,crashed=True)
+    memory.ranWith('zone0.sed',no_qheat=True)
+    assert not memory.useNoQheat('zone0.sed')
+    memory.ranWith('zone0.sed',no_qheat=False,crashed=True)
+    assert memory.useNoQheat('zone0.sed') #The counter starts again
+
+def test_saved_between_runs(tmp_path):
+    filename = str(tmp_path/'zones.json')
+    memory = ZoneMemory(filename)
+    memory.setRuntime('zone0.sed',12.5)
+    memory.ranWith('zone1.sed',no_qheat=False,crashed=True)
+    memory.save()
+    memory = ZoneMemory(filename)
+    assert memory.runtime('zone0.sed') == 12.5
+    assert memory.useNoQheat('zone1.sed')
+    assert not memory.useNoQheat('zone0.sed')
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+This script measures how much of the cloudy time of an iteration is spent
+starting cloudy (reading its atomic data, grains and the incident table),
+compared with the per-zone runtimes that Mixclask remembers.
+That startup cost is the most that packing several zones into one cloudy
+invocation could save.
+
+It reruns the cloudy inputs of an iteration folder, with 'stop zone 1' and without outputs,
+so each run does little more than starting. Run it from the root folder (as Main.py):
+    python3 -m utils.cloudy_startup /path/to/your/cloudy/exe iteration1
+See 'python3 -m utils.cloudy_startup -h' for the rest of the options.
+'''
+
+import os
+import json
+import argparse
+from glob import glob
+from utils.runner import StageRunner
+
+def measureStartup(cloudy_path,iteration_folder,n_repetitions=3,n_zones=None):
+    '''
+    Mean time (s) of a cloudy launch that stops after the first zone.
+    The inputs (cloudyInputN.in) and their .sed files are those of iteration_folder.
+    Each input is started n_repetitions times. Only the first n_zones inputs are used (None uses all).
+    '''
+    runner = StageRunner()
+    inputs = sorted(glob(iteration_folder+'/cloudyInput*.in'))
+    if n_zones is not None: inputs = inputs[:n_zones]
+    if len(inputs) == 0:
+        raise RuntimeError("No cloudy inputs (cloudyInput*.in) found in "+iteration_folder)
+    benchmark_input  = iteration_folder+'/startup_benchmark.in'
+    benchmark_output = iteration_folder+'/startup_benchmark.out'
+    startup_times = []
+    for input_file in inputs:
+        #Same model, stopped after the first zone and without saving anything
+        deck = []
+        with open(input_file,'r') as file:
+            for line in file:
+                if line.startswith(('save','stop thickness')): continue
+                deck.append(line)
+        deck.append("stop zone 1 \n")
+        with open(benchmark_input,'w') as file:
+            file.writelines(deck)
+
+        for rep in range(0,n_repetitions):
+            #cloudy runs inside the folder, where the .sed files of the inputs are
+            result = runner.run(cloudy_path, stdin=benchmark_input, stdout=benchmark_output, cwd=iteration_folder)
+            if not result.ok:
+                raise RuntimeError("Cloudy failed with "+input_file+". Check "+benchmark_output+" for more details.")
+            startup_times.append(result.elapsed)
+    os.remove(benchmark_input)
+    os.remove(benchmark_output)
+
+    startup = sum(startup_times)/len(startup_times)
+    print("Cloudy startup: "+str(startup)+" s per launch (mean of "+str(len(startup_times))+" launches)")
+    return startup
+
+def compareWithZones(startup,zone_memory):
+    #Startup cost against the cloudy time of the last run of each zone (in the zone memory file of Main.py)
+    if not os.path.isfile(zone_memory):
+        print("No zone memory found in "+zone_memory+", nothing to compare with")
+        return
+    with open(zone_memory,'r') as file:
+        runtimes = [zone['runtime'] for zone in json.load(file).values() if zone['runtime'] is not None]
+    total = sum(runtimes)
+    print("Per-zone launches: "+str(len(runtimes))+" zones, "+str(total)+" s of cloudy time in their last runs")
+    if total > 0.0:
+        print("Startup is "+str(100.0*startup*len(runtimes)/total)+" % of that time")
+
+def main():
+    parser = argparse.ArgumentParser(description="Cloudy startup cost against per-zone launches")
+    parser.add_argument('cloudy_path', help="cloudy executable (same as in Main.py)")
+    parser.add_argument('iteration_folder', help="folder with the cloudy inputs (cloudyInputN.in) and their .sed files, e.g.: iteration1")
+    parser.add_argument('--zone-memory', default='cloudy_zones.json', help="same as 'cloudy_zone_memory' in Main.py (default: %(default)s)")
+    parser.add_argument('--repetitions', type=int, default=3, help="launches of each input (default: %(default)s)")
+    parser.add_argument('--zones', type=int, default=None, help="number of inputs to launch (default: all)")
+    args = parser.parse_args()
+
+    startup = measureStartup(args.cloudy_path, args.iteration_folder, args.repetitions, args.zones)
+    compareWithZones(startup, args.zone_memory)
+
+if __name__ == '__main__':
+    main()
@@ -59,7 +59,43 @@ class ConvergenceObject(object):
 
         return wavelengths, function
 
+    def __convergedMask(self,it):
+        '''
+        Returns mask[KEY][ZONE], True if that key has converged in that zone at iteration 'it' according to the convergence criteria,
+        or None if the criteria is not recognized.
+        '''
+        tolerances = np.array(self.__tolerances)[:,np.newaxis]
+        with np.errstate(invalid='ignore'):
+            if self.__criteria == 'Previous':
+                difference = np.abs(self.__convResults[:,it,:,0] - self.__convResults[:,it-1,:,0])
+                average = 0.5 * (self.__convResults[:,it,:,0] + self.__convResults[:,it-1,:,0])
+                return difference < tolerances*average
+            elif self.__criteria == 'Variance':
+                mean = self.__convResults[:,it,:,1]
+                delta_mean = np.sqrt(self.__convResults[:,it,:,2]/(it-1))
+                return delta_mean < tolerances*mean
+            elif self.__criteria == 'Median':
+                median = self.__convResults[:,it,:,3]
+                delta_median = 0.5*self.__convResults[:,it,:,4]/np.sqrt(it-1)
+                return delta_median < tolerances*median
+        return None
+
     ### PUBLIC METHODS ###
+    def history(self):
+        '''
+        Data of the iterations done so far (call it after stop()):
+            - values[KEY][ITERATION][ZONE] (computed with 'computeData' in stop())
+            - tolerances[KEY]
+            - converged[KEY][ZONE] of the last iteration (all False if it is too soon to check it)
+        '''
+        last = self.n_iterations-1
+        values = self.__convResults[:,:last+1,:,0]
+        converged = np.zeros((len(self.__names),self.__n_zones),dtype=bool)
+        if last > self.__start_iteration:
+            mask = self.__convergedMask(last)
+            if mask is not None: converged = mask
+        return values, np.array(self.__tolerances), converged
+
     def iteration(self,time_elapsed):
         print("iteration "+str(self.n_iterations)+" ("+str(time_elapsed)+" s) :")
         return self.n_iterations
@@ -99,46 +135,16 @@ class ConvergenceObject(object):
             has_converged = False
             print("Too soon to check convergence. I will iterate again.")
         else:
-            abort = False  # Changes to True when next lines find a zone for a key that has not converged yet
-                           # As long as there is ONLY ONE zone, code has not converged, so stop the loops as soon as you find that zone
-            if self.__criteria == 'Previous':
-                for zone in range(0,self.__n_zones):
-                    for key in range(0,len(self.__names)):
-                        difference = abs(self.__convResults[key][self.n_iterations][zone][0] - self.__convResults[key][self.n_iterations-1][zone][0])
-                        average = 0.5 * (self.__convResults[key][self.n_iterations][zone][0] + self.__convResults[key][self.n_iterations-1][zone][0])
-                        if not (difference < self.__tolerances[key]*average):
-                            abort = True
-                            break #break key loop
-                    if abort: break #break zone loop
-
-            elif self.__criteria == 'Variance':
-                for zone in range(0,self.__n_zones):
-                    for key in range(0,len(self.__names)):
-                        mean = self.__convResults[key][self.n_iterations][zone][1]
-                        variance = self.__convResults[key][self.n_iterations][zone][2]
-                        delta_mean = np.sqrt(variance/(self.n_iterations-1))
-                        if not (delta_mean < self.__tolerances[key]*mean):
-                            abort = True
-                            break
-                    if abort: break
-            elif self.__criteria == 'Median':
-                for zone in range(0,self.__n_zones):
-                    for key in range(0,len(self.__names)):
-                        median = self.__convResults[key][self.n_iterations][zone][3]
-                        delta_median = 0.5*self.__convResults[key][self.n_iterations][zone][4] /np.sqrt(self.n_iterations-1)
-                        if not (delta_median < self.__tolerances[key]*median):
-                            abort = True
-                            break
-                    if abort: break
-            else:
+            converged = self.__convergedMask(self.n_iterations)
+            if converged is None:
                 print("Warning: Convergence criterion not recognized! I will iterate until "+str(self.__max_iterations)+" have been done.")
             #Veredict
-            if abort:
-                has_converged = False
-                print("Convergence not reached. I will iterate again.")
-            else:
+            if converged is None or np.all(converged):
                 has_converged = True
                 print("Convergence achieved! Stopping...")
+            else:
+                has_converged = False
+                print("Convergence not reached. I will iterate again.")
 
         #Increase number of iterations
         self.n_iterations += 1
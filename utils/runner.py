@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Launcher for the external programs (skirt and cloudy).
+Each program runs as a managed subprocess: its exit status is captured,
+its output is streamed line by line (to a file and/or to a 'watch' function),
+and it can be stopped by a timeout or cancelled.
+Independent programs are launched concurrently by an asyncio event loop,
+never running more than 'max_parallel' of them at once.
+'''
+
+import asyncio
+import os
+import shlex
+import signal
+import time
+
+class ProcessResult(object):
+    def __init__(self,command,returncode,elapsed,timed_out=False,stopped=False):
+        self.command    = command
+        self.returncode = returncode #None if the process had to be killed
+        self.elapsed    = elapsed #Wall time, in seconds
+        self.timed_out  = timed_out #True if killed because of the timeout
+        self.stopped    = stopped #True if killed because 'watch' asked for it
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out and not self.stopped
+
+    def __repr__(self):
+        return "ProcessResult("+" ".join(self.command)+", returncode="+str(self.returncode)+", elapsed="+str(round(self.elapsed,2))+" s)"
+
+class StageRunner(object):
+    def __init__(self,max_parallel=1,timeout=None):
+        self.max_parallel = max_parallel if max_parallel>1 else 1
+        self.timeout = timeout #Default timeout (s) of each process, None means no limit
+
+    ### COROUTINES ###
+
+    async def launch(self,command,stdin=None,stdout=None,timeout=None,watch=None,cwd=None):
+        '''
+        Runs 'command' (a string or a list of arguments) and waits for it.
+        -stdin : filename given as standard input.
+        -stdout: filename where the output (stdout+stderr) is written while the process runs.
+        -timeout: seconds before the process is killed (self.timeout is used if None).
+        -watch : function called with every line of output. If it returns True, the process is killed.
+        Returns a ProcessResult.
+        '''
+        if isinstance(command,str): command = shlex.split(command)
+        if timeout is None: timeout = self.timeout
+
+        t_start = time.time()
+        input_file  = open(stdin,'rb') if stdin is not None else asyncio.subprocess.DEVNULL
+        output_file = open(stdout,'w') if stdout is not None else None
+        try:
+            #A new session lets us kill the program and any child it has (e.g.: if the executable is a wrapper script)
+            process = await asyncio.create_subprocess_exec(*command, stdin=input_file, cwd=cwd,
+                                                           stdout=asyncio.subprocess.PIPE,
+                                                           stderr=asyncio.subprocess.STDOUT,
+                                                           start_new_session=True)
+            stopped = False
+            async def stream():
+                nonlocal stopped
+                while True:
+                    line = await process.stdout.readline()
+                    if not line: break #EoF
+                    line = line.decode(errors='replace')
+                    if output_file is not None: output_file.write(line)
+                    if watch is not None and watch(line):
+                        stopped = True
+                        self.__signal(process)
+                        break #No need to read more
+                return await process.wait()
+
+            try:
+                returncode = await asyncio.wait_for(stream(), timeout)
+            except asyncio.TimeoutError:
+                await self.__kill(process)
+                return ProcessResult(command,None,time.time()-t_start,timed_out=True)
+            except asyncio.CancelledError:
+                #Somebody cancelled this run, do not leave the process alive
+                await self.__kill(process)
+                raise
+            if stopped: returncode = None
+            return ProcessResult(command,returncode,time.time()-t_start,stopped=stopped)
+        finally:
+            if stdin is not None: input_file.close()
+            if output_file is not None: output_file.close()
+
+    def __signal(self,process):
+        try:
+            os.killpg(process.pid,signal.SIGKILL)
+        except ProcessLookupError:
+            pass #It has just finished
+
+    async def __kill(self,process):
+        if process.returncode is None:
+            self.__signal(process)
+            await process.wait()
+
+    async def __gather(self,jobs):
+        #Jobs are started in the given order, and a new one starts as soon as another finishes
+        slots = asyncio.Semaphore(self.max_parallel)
+        async def limited(job):
+            try:
+                async with slots:
+                    return await job
+            finally:
+                job.close() #Avoids warnings for jobs cancelled before they started
+        tasks = [asyncio.ensure_future(limited(job)) for job in jobs]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            #One job failed: cancel the rest (and kill their processes) before raising
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    ### PUBLIC METHODS ###
+
+    def run(self,command,**kwargs):
+        #Blocking version of 'launch', for a single program
+        return asyncio.run(self.launch(command,**kwargs))
+
+    def run_all(self,jobs):
+        '''
+        Runs a list of coroutines (usually built on top of 'launch'), max_parallel at once.
+        Returns their results, in the same order. If one raises, the others are cancelled.
+        '''
+        return asyncio.run(self.__gather(jobs))
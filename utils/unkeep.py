@@ -7,6 +7,11 @@ Mario Romero            July 2021
 '''
 
 import os
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+from glob import glob
 import numpy as np
 np.seterr(all='raise')
 
@@ -14,8 +19,14 @@ np.seterr(all='raise')
 # ROUTINES WITH TERMINAL
 # =============================================================================
 
-move = lambda file,des : os.system("mv "+file+" -t "+des)
-copy = lambda file,des : os.system("cp "+file+" -t "+des)
+#File staging is done in python (no shell). 'file' accepts wildcards, as in terminal
+def move(file,des):
+    for path in glob(file):
+        shutil.move(path,os.path.join(des,os.path.basename(path)))
+def copy(file,des):
+    for path in glob(file):
+        shutil.copy(path,des)
+makedir = lambda des : os.makedirs(des,exist_ok=True)
 runPython = lambda script,argv='' : os.system("python3 "+script+argv)
 changedir = lambda des: os.system("cd "+des)
 
@@ -56,31 +67,98 @@ def relist(my_str):
 # =============================================================================
 
 mean = lambda array : 0.5*(array[1:] + array[:-1])
+def selfAbsorptionCorrection(tau):
+    '''
+    Returns tau/(1-exp(-tau)), the correction for the light absorbed inside a region of optical depth tau.
+    It is evaluated without underflows or 0/0 in the whole range:
+        -thin (tau < 1e-8): 1 + tau/2, its Taylor expansion
+        -thick (tau > 40): tau, as exp(-tau) is below the precision of 1
+        -otherwise: tau/(-expm1(-tau)), which is precise for small tau
+    '''
+    tau = np.asarray(tau,dtype=float)
+    result = np.empty(tau.shape)
+    thin  = np.abs(tau) < 1e-8
+    thick = tau > 40.0
+    middle = ~(thin | thick)
+    result[thin]   = 1.0 + 0.5*tau[thin]
+    result[thick]  = tau[thick]
+    result[middle] = tau[middle]/(-np.expm1(-tau[middle]))
+    return result
+def roundArray(n,x):
+    #Rounds each element of x to n significant digits.
+    #Gives the same numbers as round(x[i],digits) does with numpy floats, that is:
+    #   x*10^digits is rounded to an integer and divided back (or x/10^-digits and multiplied, if digits < 0).
+    x = np.asarray(x,dtype=float)
+    digits = (n-1) - np.floor(np.log10(np.abs(x))).astype(int)
+    #Powers of ten built as numpy does, so they are the same floats
+    powers = [1e0,1e1,1e2,1e3,1e4,1e5,1e6,1e7,1e8]
+    while len(powers) <= np.max(np.abs(digits)):
+        powers.append(1e9 if len(powers) == 9 else powers[-1]*10.)
+    scale = np.array(powers)[np.abs(digits)]
+    result = np.empty_like(x)
+    positive = digits >= 0
+    result[positive]  = np.rint(x[positive]*scale[positive])/scale[positive]
+    result[~positive] = np.rint(x[~positive]/scale[~positive])*scale[~positive]
+    return result
 def downsample(x,X,Y,interp_type='Integral'): 
     #Note that len(y) = len(x)-1. use x=mean(x) later if you want x to have same length
+    #Y can be a matrix, where each column is a different function of X
     ### Generate interpolation ###
     
-    X = np.array(X)
-    Y = np.array(Y)
+    X = np.asarray(X,dtype=float)
+    Y = np.asarray(Y,dtype=float)
     y = []
     
     if interp_type != 'Integral':
         #Do the interpolation
         y = np.interp(x,X,Y)
     else:
-        #Compute the integral F = int(Y*dX)
-        dX = np.diff(X)
-        X  = mean(X)
-        Y  = mean(Y)
-        F  = np.cumsum(Y*dX)
-        #Compute the interpolation OF THE INTEGRAL, f
-        f = np.interp(x,X,F)
-        #Compute the derivative of f to get y
-        y = np.diff(f)/np.diff(x)
-        #x = mean(x)
-        #print(len(f),len(x),len(y))
+        #The integral method is linear in Y, see rebinOperator()
+        y = rebinOperator(np.asarray(x,dtype=float),X) @ Y
     return y
 
+_rebin_cache = {} #(x,X) -> operator. Grids of cloudy and skirt never change during a run, so it holds a few operators and is never emptied
+def rebinOperator(x,X):
+    '''
+    Sparse matrix R that gives downsample(x,X,Y) = R @ Y. That is:
+        -Compute the integral F = int(Y*dX) (trapezoidal rule, at mean(X))
+        -Interpolate it at x, giving f
+        -Derive f to get y = diff(f)/diff(x)
+    The rows of R are built directly, so the integral of each bin does not come from the difference of two big cumulative sums.
+    Operators are cached, so each pair of grids is built once.
+    Zones are converted in threads: entries are only added (never removed), and a single get() reads them.
+    Two threads may build the same operator at once, which is harmless (both are equal).
+    '''
+    key = (x.tobytes(),X.tobytes())
+    operator = _rebin_cache.get(key)
+    if operator is not None: return operator
+    from scipy import sparse
+    N  = len(X)
+    dX = np.diff(X)
+    Xm = mean(X)
+    #f(x) = sum_i dX_i*mean(Y)_i*c(i), where c(i) is 1 below the interpolation interval [Xm_a,Xm_a+1] of x, t at a+1 and 0 above
+    a = np.clip(np.searchsorted(Xm,x,side='right')-1,0,N-2)
+    t = np.zeros(len(x))
+    inside = (x > Xm[0]) & (x < Xm[-1])
+    t[inside] = (x[inside]-Xm[a[inside]])/(Xm[a[inside]+1]-Xm[a[inside]])
+    a[x >= Xm[-1]] = N-2 #Beyond the last point, f is the whole integral
+    #Bin j of y takes the source points between the intervals of x[j] and x[j+1]
+    rows = []
+    cols = []
+    values = []
+    for j in range(0,len(x)-1):
+        i = np.arange(a[j]+1,min(a[j+1]+2,N-1))
+        upper = np.where(i <= a[j+1],1.0,t[j+1]) #c(i) of x[j+1]
+        lower = np.where(i == a[j]+1,t[j],0.0) #c(i) of x[j]
+        rows.append(np.full(len(i),j))
+        cols.append(i)
+        values.append((upper-lower)*dX[i]/(x[j+1]-x[j]))
+    W = sparse.csr_matrix((np.concatenate(values),(np.concatenate(rows),np.concatenate(cols))),shape=(len(x)-1,N-1))
+    #Trapezoidal mean of Y
+    A = sparse.diags([np.full(N-1,0.5),np.full(N-1,0.5)],[0,1],shape=(N-1,N))
+    operator = (W @ A).tocsr()
+    _rebin_cache[key] = operator
+    return operator
 
 def testDownsample(x,y,X,Y):
     #make sure that len(x)=len(y)
@@ -130,30 +208,44 @@ def integrate(x_lim,x,y):
 # ROUTINES WITH FILES
 # =============================================================================    
 
+#(file,columns) -> [(modification time,size),data], least recently used first.
+#Bounded in memory: files of old iterations are dropped as new ones are read. Converter threads share it, hence the lock
+_column_cache = OrderedDict()
+_column_cache_bytes = 0
+_column_cache_max_bytes = 64*1024*1024
+_column_cache_lock = threading.Lock()
 def readColumn(filename,column):
     '''
     This returns the column selected (in python notation, so column 1 is '0' 
     and so on) from the file.
     column can be a list if you want to extract multiple columns, although
     data will have a different format.
+    Lines starting with '#' (headers and comments) are skipped, and so are the columns not selected
+    (e.g.: line labels in cloudy continuum files).
+    The file is read in one go, and the result is kept until the file changes (or until it is the least recently used
+    when the cache is full). So several readings of the same file are parsed once. Returned arrays are read-only: copy them before modifying.
     '''
-    file = open(filename,'r')
-    
-    data = []
-    while True:
-        line = file.readline()
-        if not line: break #EoF
-        elif line[0] == '#': continue #commented line
-        
-        line_data = line.split()
-        if not isinstance(column,(list,tuple)):
-            data.append(float(line_data[column]))
-        else:
-            row = [float(line_data[col]) for col in column]
-            data.append(row)
+    global _column_cache_bytes
+    columns = tuple(column) if isinstance(column,(list,tuple)) else column
+    key = (os.path.abspath(filename),columns)
+    stat = os.stat(filename)
+    stamp = (stat.st_mtime_ns,stat.st_size)
+    with _column_cache_lock:
+        cached = _column_cache.get(key)
+        if cached is not None and cached[0] == stamp:
+            _column_cache.move_to_end(key)
+            return cached[1]
     
-    file.close()
-    return np.array(data)
+    data = np.loadtxt(filename,comments='#',usecols=columns,ndmin=2 if isinstance(columns,tuple) else 1)
+    data.setflags(write=False)
+    with _column_cache_lock:
+        old = _column_cache.pop(key,None)
+        if old is not None: _column_cache_bytes -= old[1].nbytes
+        _column_cache[key] = [stamp,data]
+        _column_cache_bytes += data.nbytes
+        while _column_cache_bytes > _column_cache_max_bytes and len(_column_cache) > 1:
+            _column_cache_bytes -= _column_cache.popitem(last=False)[1][1].nbytes
+    return data
 
 def addColumn(matrix,column):
     #Here you add column to matrix.
@@ -181,44 +273,52 @@ def findNormalization(x_value,x,y):
                 return np.array([x[i+1],y[i+1]])
     raise RuntimeError("Normalization not found!")
 
+_probability_cache = {} #output file -> hash of the source (and 'invert') it was made from
 def createProbabilityFile(original_file_path,original_folder,probability_folder='',invert=False):
     #This creates a probability file from 'original_file'.
     #For skirt reasons, they need a file with two columns: One for wavelengths, other for its probability density.
     #Probability density does not need to be normalized, but it needs to be given in luminosity units or skirt crashes.
+    #The file is only written again if the content of 'original_file' changed since the last time.
 
     original_file = original_file_path.replace(original_folder+'/','')
     output_name = original_file.replace('.stab','_probability.stab')
     output_name = output_name.replace('.txt', '_probability.stab')
     output_name = output_name.replace('.dat', '_probability.stab')
+    output_path = os.path.join(probability_folder,output_name)
+
+    with open(original_file_path,'rb') as source:
+        label = hashlib.sha1(source.read())
+    label.update(str(invert).encode())
+    label = label.hexdigest()
+    key = os.path.abspath(output_path)
+    if _probability_cache.get(key) == label and os.path.isfile(output_path):
+        return probability_folder+'/'+output_name
 
-    # Create file header
-    output = open(output_name,'w')
-    output.write("# Column 1: wavelength (nm) \n")
-    output.write("# Column 2: probability density (erg/s) \n")
-    output.write("# luminosity units are required for skirt to work. Probability density has no units \n")
     # Extract columns
     columns = readColumn(original_file_path, [0, 1])
     wavelength = columns[:,0]
     density = columns[:,1]
     if invert:
-        try:
-            density = 1.0/density
-        except FloatingPointError or ZeroDivisionError:
-            #Slow mode removing zeros then...
-            new_wavelength = []
-            new_density = []
-            for i in range(0,len(wavelength)):
-                if density[i] != 0.0:
-                    new_wavelength.append(wavelength[i])
-                    new_density.append(density[i])
-            wavelength = np.array(new_wavelength)
-            density = 1.0/np.array(new_density)
-
-    #Write file
-    for l in range(0,len(wavelength)):
-        output.write(str(wavelength[l])+" "+str(density[l])+" \n")
-
-    output.close()
-    #Move output to probability file
-    move(output_name,probability_folder)
+        #Zeros are removed
+        nonzero = density != 0.0
+        wavelength = wavelength[nonzero]
+        density = 1.0/density[nonzero]
+
+    writeProbabilityFile(output_path,wavelength,density)
+    _probability_cache[key] = label
     return probability_folder+'/'+output_name
+
+def writeProbabilityFile(output_path,wavelength,density):
+    #Probability file for skirt (FileWavelengthDistribution). wavelength in nm
+    # Create file header
+    lines = ["# Column 1: wavelength (nm) \n",
+             "# Column 2: probability density (erg/s) \n",
+             "# luminosity units are required for skirt to work. Probability density has no units \n"]
+    #repr() of python floats is the same text as str() of numpy floats
+    lines.extend(['%r %r \n'%(w,d) for w,d in zip(np.asarray(wavelength,dtype=float).tolist(),np.asarray(density,dtype=float).tolist())])
+
+    #Write next to the output and rename it, so skirt never finds half-written files
+    tmp_path = output_path+'.tmp'+str(os.getpid())
+    with open(tmp_path,'w') as output:
+        output.write(''.join(lines))
+    os.replace(tmp_path,output_path)